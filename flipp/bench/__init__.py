@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark harness for the pipeline: synthetic images (:mod:`.synthetic`),
+stand-ins for sextractor/solve-field (:mod:`.stubs`) and APASS
+(:mod:`.apass_server`), and the ``flippbench`` command (:mod:`.run`).
+"""
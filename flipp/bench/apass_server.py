@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+A local stand-in for the AAVSO APASS download service.
+
+Answers ``cgi-bin/apass_download.pl?ra=..&dec=..&radius=..&outtype=1`` with
+the CSV the real service returns, built from the fake sky in
+:mod:`flipp.bench.sky`; about one star in twenty has no Sloan i' ("NA"),
+as in the real catalog.  Point ``APASS_HOST`` at :attr:`FakeAPASS.url`.
+
+Example
+-------
+.. code-block::
+
+    server = FakeAPASS(latency=0.5).start()
+    print(server.url)  # http://127.0.0.1:54321/
+    ...
+    server.stop()
+"""
+
+from __future__ import unicode_literals, division, print_function
+
+import time
+import threading
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:  # Python 3
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+from flipp.bench import sky
+from flipp.bench.stubs import parse_sexagesimal
+
+COLUMNS = ("radeg", "raerr", "decdeg", "decerr", "Number_of_Obs",
+           "Johnson_V", "Verr", "Johnson_B", "Berr", "Sloan_g", "gerr",
+           "Sloan_r", "rerr", "Sloan_i", "ierr")
+
+
+def apass_csv(ra, dec, radius):
+    """CSV text of the fake stars within ``radius`` degrees."""
+    stars = sky.stars_in_cone(ra, dec, radius)
+    n = len(stars["ra"])
+    missing = sky._uniform(np.round(stars["ra"] * 1e6),
+                           np.round(stars["dec"] * 1e6), 5) < 0.05
+    lines = [",".join(COLUMNS)]
+    for k in range(n):
+        i_mag = "NA" if missing[k] else "{:.3f}".format(stars["i"][k])
+        i_err = "NA" if missing[k] else "0.050"
+        lines.append(
+            "{:.6f},0.100,{:.6f},0.100,4,{:.3f},0.030,{:.3f},0.040,"
+            "{:.3f},0.030,{:.3f},0.030,{},{}".format(
+                stars["ra"][k], stars["dec"][k], stars["V"][k],
+                stars["B"][k], stars["g"][k], stars["r"][k], i_mag, i_err))
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        query = parse_qs(urlparse(self.path).query)
+        try:
+            ra = parse_sexagesimal(query["ra"][0], hours=":" in query["ra"][0])
+            dec = parse_sexagesimal(query["dec"][0])
+            radius = float(query["radius"][0])
+        except (KeyError, ValueError):
+            self.send_error(400, "ra, dec and radius are required")
+            return
+        body = apass_csv(ra, dec, radius).encode("ascii")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+class FakeAPASS(object):
+    """Serve the fake APASS catalog from a background thread.
+
+    ``latency`` adds that many seconds to every response, to mimic the
+    round trip to AAVSO.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.):
+        self.server = _Server((host, port), _Handler)
+        self.server.latency = latency
+        self.server.requests = 0
+        self.server.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}/".format(host, port)
+
+    @property
+    def requests(self):
+        """Number of queries answered so far."""
+        return self.server.requests
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        name="flipp-fake-apass")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
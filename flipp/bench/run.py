@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+``flippbench`` : throughput benchmarks that run without astrometry.net
+indexes, sextractor or the AAVSO web service.
+
+``flippbench pipeline`` generates synthetic images once, then for every
+requested batch size runs ``flipprun`` over that many of them in a fresh
+output folder and database, with ``SEXTRACTORPATH``/``SOLVEFIELDPATH``
+pointing at :mod:`flipp.bench.stubs` and ``APASS_HOST`` at a local
+:class:`flipp.bench.apass_server.FakeAPASS`.  It reports images/sec per
+batch and the per-stage latency percentiles from ``flipp_metrics.jsonl``.
+
+Example
+-------
+.. code-block::
+
+    flippbench pipeline --sizes 1 100 10000 -j 8 --report bench.json
+
+``flippbench lzw`` compares opening ``.Z`` images through ``zcat`` with the
+in-process decoder in :mod:`flipp.libs.lzw`.
+
+``flippbench catalog`` compares reading sextractor's ASCII_HEAD and
+FITS_LDAC catalogs, with every default.param column and with just
+``SEXTRACTOR_PARAMETERS``.
+"""
+
+from __future__ import unicode_literals, print_function, division
+
+import os
+import sys
+import json
+import stat
+import time
+import shutil
+import argparse
+import subprocess
+
+import numpy as np
+
+from collections import OrderedDict
+from tempfile import mkdtemp
+
+from flipp.bench.apass_server import FakeAPASS
+from flipp.pipeline.results import ImageResult, summarize
+from flipp.pipeline.metrics import summarize_metrics
+
+# Lets the stub wrappers import flipp.bench even when it is not installed.
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+WRAPPER = """#!/bin/sh
+PYTHONPATH="{root}${{PYTHONPATH:+:$PYTHONPATH}}" exec "{python}" -m flipp.bench.stubs {cmd} "$@"
+"""
+
+SETTINGS = """# Generated by flippbench; do not edit.
+SEXTRACTORPATH = {sextractor!r}
+SOLVEFIELDPATH = {solve_field!r}
+APASS_HOST = {apass!r}
+DB_URL = {db_url!r}
+OUTPUT_ROOT = {output!r}
+CACHE_ROOT = {cache!r}
+"""
+
+
+def write_stubs(bindir):
+    """Executable ``sextractor`` and ``solve-field`` wrappers in ``bindir``."""
+    if not os.path.exists(bindir):
+        os.makedirs(bindir)
+    paths = {}
+    for cmd in ("sextractor", "solve-field"):
+        path = os.path.join(bindir, cmd)
+        with open(path, "w") as f:
+            f.write(WRAPPER.format(root=REPO_ROOT, python=sys.executable,
+                                   cmd=cmd))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP |
+                 stat.S_IXOTH)
+        paths[cmd] = path
+    return paths
+
+
+def write_settings(path, stubs, apass_url, output):
+    """A FLIPP_CONF file sending everything to the stand-ins and ``output``."""
+    db_url = "sqlite:///{}".format(os.path.join(output, "bench.sqlite"))
+    with open(path, "w") as f:
+        f.write(SETTINGS.format(sextractor=str(stubs["sextractor"]),
+                                solve_field=str(stubs["solve-field"]),
+                                apass=str(apass_url), db_url=str(db_url),
+                                output=str(output),
+                                cache=str(os.path.join(output, "cache"))))
+
+
+def load_results(output):
+    """ImageResults rebuilt from a run's ``flipp_metrics.jsonl``."""
+    results = []
+    path = os.path.join(output, "flipp_metrics.jsonl")
+    if not os.path.exists(path):  # flipprun died before the first image
+        return results
+    with open(path) as f:
+        for line in f:
+            r = json.loads(line)
+            results.append(ImageResult(r["path"], r["status"],
+                                       elapsed=r["elapsed"],
+                                       metrics=r["stages"]))
+    return results
+
+
+def bench_pipeline(args):
+    from flipp.bench.synthetic import make_images
+
+    workdir = os.path.abspath(args.workdir or mkdtemp(prefix="flippbench-"))
+    print("Working in {}".format(workdir))
+    stubs = write_stubs(os.path.join(workdir, "bin"))
+
+    t0 = time.time()
+    images = make_images(os.path.join(workdir, "images"), max(args.sizes),
+                         args.telescope, args.image_size)
+    print("{} synthetic {} images ready ({:.1f}s)".format(
+        len(images), args.telescope, time.time() - t0))
+
+    server = FakeAPASS(latency=args.apass_latency).start()
+    report = OrderedDict([("telescope", args.telescope),
+                          ("jobs", args.jobs),
+                          ("staged", args.staged),
+                          ("image_size", args.image_size),
+                          ("runs", [])])
+    try:
+        for n in args.sizes:
+            run_dir = os.path.join(workdir, "run-{}".format(n))
+            if os.path.exists(run_dir):
+                shutil.rmtree(run_dir)
+            inputs = os.path.join(run_dir, "input")
+            output = os.path.join(run_dir, "output")
+            os.makedirs(inputs)
+            os.makedirs(output)
+            for path in images[:n]:
+                os.symlink(path, os.path.join(inputs, os.path.basename(path)))
+            conf = os.path.join(run_dir, "bench_settings.py")
+            write_settings(conf, stubs, server.url, output)
+
+            cmd = [sys.executable, "-c",
+                   "from flipp.pipeline import console_run; console_run()",
+                   "-o", output, "-t", args.telescope, "-j", str(args.jobs),
+                   inputs]
+            if args.staged:
+                cmd.append("--staged")
+            env = dict(os.environ, FLIPP_CONF=conf)
+            env["PYTHONPATH"] = os.pathsep.join(
+                filter(None, [REPO_ROOT, env.get("PYTHONPATH")]))
+            requests_before = server.requests
+            print("\n=== {} image(s) ===".format(n))
+            with open(os.path.join(run_dir, "flipprun.log"), "w") as log:
+                start = time.time()
+                code = subprocess.call(cmd, env=env, stdout=log,
+                                       stderr=subprocess.STDOUT)
+                wall = time.time() - start
+            results = load_results(output)
+            done = sum(r.ok for r in results)
+            print(summarize(results))
+            print("{:.1f}s wall, {:.2f} images/sec, {} APASS queries{}".format(
+                wall, n / wall, server.requests - requests_before,
+                "" if code == 0 else " (flipprun exited with {})".format(code)))
+            table = summarize_metrics(results)
+            if table:
+                print(table)
+            report["runs"].append(OrderedDict([
+                ("images", n), ("done", done), ("wall", wall),
+                ("images_per_sec", n / wall),
+                ("stages", _stage_percentiles(results))]))
+    finally:
+        server.stop()
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir)
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+        print("\nWrote {}".format(args.report))
+    return report
+
+
+def _stage_percentiles(results, percentiles=(50, 90, 99)):
+    walls = OrderedDict()
+    for r in results:
+        for name, s in (r.metrics or {}).items():
+            walls.setdefault(name, []).append(s["wall"])
+    return OrderedDict(
+        (name, OrderedDict(("p{}".format(p), float(v)) for p, v in
+                           zip(percentiles, np.percentile(w, percentiles))))
+        for name, w in walls.items())
+
+
+def _best_of(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times), np.median(times)
+
+
+def bench_lzw(args):
+    """Time opening ``.Z`` images in-process against the ``zcat`` pipe."""
+    from cStringIO import StringIO
+    from astropy.io import fits
+    from flipp.libs.fileio import get_zipped_fitsfile
+    from flipp.conf import settings
+
+    paths = args.files or [os.path.join(settings.FIXTURE_DIR, "kait",
+                                        "badkait.fts.Z")]
+
+    def with_zcat(path):
+        raw = subprocess.check_output(["zcat", path])
+        hdu = fits.open(StringIO(raw))
+        hdu.verify('silentfix+ignore')
+        return hdu[0].data.sum()
+
+    def in_process(path):
+        return get_zipped_fitsfile(path)[0].data.sum()
+
+    print("{:<30} {:>10} {:>12} {:>12} {:>8}".format(
+        "file", "MB", "zcat ms", "lzw ms", "speedup"))
+    for path in paths:
+        size = os.path.getsize(path) / 1e6
+        zcat = _best_of(lambda: with_zcat(path), args.repeat)[0]
+        lzw = _best_of(lambda: in_process(path), args.repeat)[0]
+        print("{:<30} {:>10.2f} {:>12.1f} {:>12.1f} {:>7.2f}x".format(
+            os.path.basename(path)[:30], size, zcat * 1e3, lzw * 1e3,
+            zcat / lzw))
+
+
+def bench_catalog(args):
+    """Time reading sextractor catalogs: ASCII_HEAD against FITS_LDAC."""
+    from flipp.bench.stubs import (read_params, write_ascii_head,
+                                   write_fits_ldac)
+    from flipp.libs.sextractor import read_catalog, default_param
+    from flipp.conf import settings
+
+    rng = np.random.RandomState(0)
+    workdir = mkdtemp(prefix="flippbench-")
+    params = [("all", read_params(default_param)),
+              ("pipeline", list(settings.SEXTRACTOR_PARAMETERS))]
+    print("{:>8} {:<9} {:>10} {:>10} {:>12} {:>12} {:>8}".format(
+        "sources", "columns", "ascii KB", "ldac KB", "ascii ms", "ldac ms",
+        "speedup"))
+    try:
+        for n in args.sources:
+            cols = dict((p, rng.uniform(0, 1000, n))
+                        for p in read_params(default_param))
+            cols["NUMBER"] = np.arange(1, n + 1)
+            cols["FLAGS"] = np.zeros(n, dtype=int)
+            for label, names in params:
+                ascii = os.path.join(workdir, "{}-{}.txt".format(label, n))
+                ldac = os.path.join(workdir, "{}-{}.fits".format(label, n))
+                write_ascii_head(ascii, names, cols)
+                write_fits_ldac(ldac, names, cols)
+                t_ascii = _best_of(lambda: read_catalog(ascii, "ASCII_HEAD"),
+                                   args.repeat)[0]
+                t_ldac = _best_of(lambda: read_catalog(ldac, "FITS_LDAC"),
+                                  args.repeat)[0]
+                print("{:>8} {:<9} {:>10.1f} {:>10.1f} {:>12.1f} {:>12.1f} "
+                      "{:>7.1f}x".format(
+                          n, label, os.path.getsize(ascii) / 1e3,
+                          os.path.getsize(ldac) / 1e3, t_ascii * 1e3,
+                          t_ldac * 1e3, t_ascii / t_ldac))
+    finally:
+        shutil.rmtree(workdir)
+
+
+def console_bench():
+    """Console script entry-point for ``flippbench``."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the flipp pipeline against synthetic images "
+                    "and stand-in external tools.")
+    commands = parser.add_subparsers(dest="command")
+
+    sub = commands.add_parser(
+        "pipeline", help="Images/sec and per-stage latency of flipprun.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    sub.add_argument("--sizes", type=int, nargs="+", default=[1, 100, 10000],
+                     metavar="N", help="Batch sizes to time.")
+    sub.add_argument("-t", "--telescope", default="kait",
+                     choices=["kait", "nickel", "nickelOld"])
+    sub.add_argument("-j", "--jobs", type=int, default=1)
+    sub.add_argument("--staged", action="store_true")
+    sub.add_argument("--image-size", type=int, default=256, metavar="pixels")
+    sub.add_argument("--apass-latency", type=float, default=0.,
+                     metavar="seconds",
+                     help="Delay added to every fake APASS response.")
+    sub.add_argument("--workdir", default=None,
+                     help="Keep images and outputs here (reused across "
+                          "runs) instead of a temporary folder.")
+    sub.add_argument("--keep", action="store_true",
+                     help="Do not delete the temporary folder.")
+    sub.add_argument("--report", default=None, metavar="file.json",
+                     help="Also write the numbers as JSON, for comparing "
+                          "runs.")
+    sub.set_defaults(func=bench_pipeline)
+
+    sub = commands.add_parser(
+        "lzw", help="Opening .Z images: zcat pipe vs in-process decoder.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    sub.add_argument("files", nargs="*",
+                     help=".Z images (default: the badkait.fts.Z fixture)")
+    sub.add_argument("--repeat", type=int, default=5,
+                     help="Best-of-N timing.")
+    sub.set_defaults(func=bench_lzw)
+
+    sub = commands.add_parser(
+        "catalog", help="Reading sextractor catalogs: ASCII_HEAD vs "
+                        "FITS_LDAC.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    sub.add_argument("--sources", type=int, nargs="+",
+                     default=[100, 1000, 10000], metavar="N",
+                     help="Catalog sizes to time.")
+    sub.add_argument("--repeat", type=int, default=5,
+                     help="Best-of-N timing.")
+    sub.set_defaults(func=bench_catalog)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    console_bench()
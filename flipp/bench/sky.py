@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+A deterministic fake sky shared by the synthetic images, the stub
+source-extractor and the fake APASS server, so that all three agree on
+where the stars are without talking to each other.
+
+The sky is cut into declination bands ``CELL`` degrees high, each band into
+cells roughly ``CELL`` degrees wide, and every cell holds one star whose
+position and magnitudes are a hash of the cell's indices.
+
+Only numpy is used here, so the stub executables start up quickly.
+"""
+
+from __future__ import unicode_literals, division
+
+import numpy as np
+
+CELL = 0.5 / 60.  # degrees; about one star per 0.25 square arcmin
+
+_M1 = np.uint64(0xbf58476d1ce4e5b9)
+_M2 = np.uint64(0x94d049bb133111eb)
+
+
+def _uniform(i, j, salt):
+    """Uniform [0, 1) deviates hashed from integer arrays ``i``, ``j``."""
+    with np.errstate(over='ignore'):
+        z = (np.asarray(i, dtype=np.int64).astype(np.uint64) *
+             np.uint64(0x9e3779b97f4a7c15) +
+             np.asarray(j, dtype=np.int64).astype(np.uint64) *
+             np.uint64(0x632be59bd9b4e019) +
+             np.uint64(salt))
+        z = (z ^ (z >> np.uint64(30))) * _M1
+        z = (z ^ (z >> np.uint64(27))) * _M2
+        z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """Great-circle distance in degrees (haversine)."""
+    ra1, dec1, ra2, dec2 = map(np.radians, (ra1, dec1, ra2, dec2))
+    h = (np.sin((dec2 - dec1) / 2) ** 2 +
+         np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2) ** 2)
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(h, 0, 1))))
+
+
+def stars_in_cone(ra, dec, radius):
+    """All fake stars within ``radius`` degrees of (``ra``, ``dec``).
+
+    Returns a dict of arrays : ra, dec, V, B, g, r, i.
+    """
+    bands = np.arange(int(np.floor((dec - radius) / CELL)),
+                      int(np.floor((dec + radius) / CELL)) + 1)
+    bands = bands[(bands >= -90 / CELL) & (bands < 90 / CELL)]
+    I, J, RA, DEC = [], [], [], []
+    for b in bands:
+        center = (b + 0.5) * CELL
+        ncells = max(1, int(360. / (CELL / max(np.cos(np.radians(center)),
+                                               1e-3))))
+        width = 360. / ncells
+        half = min(180., radius / max(np.cos(np.radians(abs(dec) + radius)),
+                                      1e-3))
+        k = np.arange(int(np.floor((ra - half) / width)),
+                      int(np.floor((ra + half) / width)) + 1)
+        k = np.unique(k % ncells)
+        I.append(np.repeat(b, len(k)))
+        J.append(k)
+        RA.append((k + _uniform(b, k, 1)) * width)
+        DEC.append((b + _uniform(b, k, 2)) * CELL)
+    if not I:
+        return {k: np.array([]) for k in ("ra", "dec", "V", "B", "g", "r",
+                                           "i")}
+    I, J = np.concatenate(I), np.concatenate(J)
+    RA, DEC = np.concatenate(RA), np.concatenate(DEC)
+    keep = angular_separation(ra, dec, RA, DEC) <= radius
+    I, J, RA, DEC = I[keep], J[keep], RA[keep], DEC[keep]
+    V = 12. + 7. * _uniform(I, J, 3)
+    color = 0.2 + 0.8 * _uniform(I, J, 4)
+    return {"ra": RA, "dec": DEC, "V": V, "B": V + color,
+            "g": V + 0.5 * color, "r": V - 0.2 * color, "i": V - 0.4 * color}
+
+
+def tan_world2pix(ra, dec, crval, crpix, cd):
+    """Gnomonic (RA---TAN/DEC--TAN) projection, 1-based FITS pixels."""
+    ra, dec = np.radians(ra), np.radians(dec)
+    a0, d0 = np.radians(crval[0]), np.radians(crval[1])
+    cos_c = (np.sin(d0) * np.sin(dec) +
+             np.cos(d0) * np.cos(dec) * np.cos(ra - a0))
+    xi = np.degrees(np.cos(dec) * np.sin(ra - a0) / cos_c)
+    eta = np.degrees((np.cos(d0) * np.sin(dec) -
+                      np.sin(d0) * np.cos(dec) * np.cos(ra - a0)) / cos_c)
+    inv = np.linalg.inv(np.asarray(cd, dtype=float))
+    x = inv[0, 0] * xi + inv[0, 1] * eta + crpix[0]
+    y = inv[1, 0] * xi + inv[1, 1] * eta + crpix[1]
+    return x, y
+
+
+def tan_pix2world(x, y, crval, crpix, cd):
+    """Inverse of :func:`tan_world2pix`."""
+    cd = np.asarray(cd, dtype=float)
+    dx, dy = np.asarray(x) - crpix[0], np.asarray(y) - crpix[1]
+    xi = np.radians(cd[0, 0] * dx + cd[0, 1] * dy)
+    eta = np.radians(cd[1, 0] * dx + cd[1, 1] * dy)
+    a0, d0 = np.radians(crval[0]), np.radians(crval[1])
+    denom = np.cos(d0) - eta * np.sin(d0)
+    ra = a0 + np.arctan2(xi, denom)
+    dec = np.arctan2(np.sin(d0) + eta * np.cos(d0), np.hypot(xi, denom))
+    return np.degrees(ra) % 360., np.degrees(dec)
+
+
+def cd_matrix(scale):
+    """CD matrix for ``scale`` arcsec/pixel, north up and east left."""
+    s = scale / 3600.
+    return [[-s, 0.], [0., s]]
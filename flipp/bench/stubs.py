@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-ins for the ``sextractor`` and ``solve-field`` executables.
+
+They accept the command lines :class:`flipp.libs.sextractor.Sextractor` and
+:class:`flipp.libs.astrometry.Astrometry` build, read and write the same
+files the real programs do, and answer deterministically from the fake sky
+in :mod:`flipp.bench.sky`:
+
+- ``sextractor`` finds local maxima above the background, measures them
+  and writes the catalog (ASCII_HEAD or FITS_LDAC) and check-images;
+- ``solve-field`` "solves" every image (or xylist, given ``--width`` and
+  ``--height``) at the given pointing and the middle of the given scale
+  range (or takes the ``--verify`` solution as it is), and writes the
+  ``--new-fits`` image (images only) plus the ``.wcs``/``.solved`` files.
+
+Only numpy is imported (FITS is read and written by hand), so that process
+start-up does not dominate the numbers.  The benchmark harness points
+``SEXTRACTORPATH``/``SOLVEFIELDPATH`` at small shell wrappers around
+
+.. code-block::
+
+    python -m flipp.bench.stubs sextractor image.fits -CATALOG_NAME out.cat
+    python -m flipp.bench.stubs solve-field image.fits -L 0.79 -H 0.8 ...
+"""
+
+from __future__ import unicode_literals, division, print_function
+
+import os
+import sys
+import shutil
+
+import numpy as np
+
+from flipp.bench import sky
+
+BLOCK = 2880
+CARD = 80
+
+BITPIX_DTYPES = {8: ">u1", 16: ">i2", 32: ">i4", 64: ">i8", -32: ">f4",
+                 -64: ">f8"}
+
+
+# ============
+# FITS helpers
+# ============
+def read_header(f):
+    """Read one header from the open file ``f``.
+
+    Returns (cards, values) where ``cards`` are the raw 80-char cards
+    (without END) and ``values`` maps keywords to parsed values.
+    """
+    cards, values = [], {}
+    while True:
+        block = f.read(BLOCK)
+        if len(block) < BLOCK:
+            raise IOError("Truncated FITS header")
+        for i in range(0, BLOCK, CARD):
+            card = block[i:i + CARD].decode("ascii", "replace")
+            key = card[:8].strip()
+            if key == "END":
+                return cards, values
+            cards.append(card)
+            if card[8:10] == "= ":
+                values[key] = _parse_value(card[10:])
+
+
+def _parse_value(s):
+    s = s.strip()
+    if s.startswith("'"):
+        end = s.find("'", 1)
+        while end != -1 and s[end + 1:end + 2] == "'":  # Escaped quote
+            end = s.find("'", end + 2)
+        return s[1:end].replace("''", "'").rstrip()
+    s = s.split("/")[0].strip()
+    if s in ("T", "F"):
+        return s == "T"
+    for cast in (int, float):
+        try:
+            return cast(s)
+        except ValueError:
+            pass
+    return s
+
+
+def format_card(key, value):
+    if isinstance(value, bool):
+        v = "{:>20}".format("T" if value else "F")
+    elif isinstance(value, (int, np.integer)):
+        v = "{:>20d}".format(int(value))
+    elif isinstance(value, (float, np.floating)):
+        v = "{:>20}".format(repr(float(value)).upper())
+    else:
+        v = "'{:<8}'".format(str(value).replace("'", "''"))
+    return "{:<8}= {}".format(key, v)[:CARD].ljust(CARD)
+
+
+def header_bytes(cards):
+    text = "".join(c.ljust(CARD)[:CARD] for c in cards) + "END".ljust(CARD)
+    text += " " * (-len(text) % BLOCK)
+    return text.encode("ascii")
+
+
+def read_image(path):
+    """Primary HDU of ``path`` as (cards, values, float64 data)."""
+    with open(path, "rb") as f:
+        cards, values = read_header(f)
+        shape = tuple(values["NAXIS{}".format(i)]
+                      for i in range(values["NAXIS"], 0, -1))
+        dtype = np.dtype(BITPIX_DTYPES[values["BITPIX"]])
+        count = int(np.prod(shape)) if shape else 0
+        data = np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+    data = data.astype(np.float64)
+    data *= values.get("BSCALE", 1.)
+    data += values.get("BZERO", 0.)
+    return cards, values, data
+
+
+def write_image(path, data, cards=()):
+    """Write ``data`` as a float32 primary HDU with extra ``cards``."""
+    data = np.asarray(data, dtype=">f4")
+    head = [format_card("SIMPLE", True), format_card("BITPIX", -32),
+            format_card("NAXIS", data.ndim)]
+    head += [format_card("NAXIS{}".format(i + 1), n)
+             for i, n in enumerate(reversed(data.shape))]
+    with open(path, "wb") as f:
+        f.write(header_bytes(head + list(cards)))
+        f.write(data.tobytes())
+        f.write(b"\0" * (-data.nbytes % BLOCK))
+
+
+def parse_sexagesimal(s, hours=False):
+    s = str(s).strip()
+    try:
+        value = float(s)
+    except ValueError:
+        sign = -1. if s.startswith("-") else 1.
+        parts = [abs(float(p)) for p in s.replace(" ", ":").split(":") if p]
+        value = sign * sum(p / 60. ** i for i, p in enumerate(parts))
+        if hours:
+            value *= 15.
+    return value
+
+
+# ==========
+# sextractor
+# ==========
+def _parse_options(argv, flags=()):
+    """Split ``argv`` into positional arguments and ``-KEY value`` options
+    (keyed without the leading dashes); ``flags`` are options that take no
+    value.  Values may start with a dash, e.g. ``-4 -05:12:00``.
+    """
+    args, options = [], {}
+    i = 0
+    while i < len(argv):
+        a = argv[i]
+        if a.startswith("-") and len(a) > 1:
+            if a in flags or i + 1 == len(argv):
+                options[a.lstrip("-")] = None
+                i += 1
+            else:
+                options[a.lstrip("-")] = argv[i + 1]
+                i += 2
+        else:
+            args.append(a)
+            i += 1
+    return args, options
+
+
+def read_sex_config(path):
+    """``KEY value`` pairs of a sextractor configuration file."""
+    config = {}
+    with open(path) as f:
+        for line in f:
+            line = line.split("#")[0].split()
+            if len(line) >= 2:
+                config[line[0]] = line[1]
+    return config
+
+
+def read_params(path):
+    params = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#")[0].split()
+            if line:
+                params.append(line[0])
+    return params
+
+
+def detect(data, nsigma=5., box=3):
+    """Background, noise and a measurement dict of the local maxima more
+    than ``nsigma`` above the background.
+    """
+    bkg = np.median(data)
+    rms = 1.4826 * np.median(np.abs(data - bkg)) or 1.
+    ny, nx = data.shape
+    peak = data > bkg + nsigma * rms
+    padded = np.pad(data, 1, mode="edge")
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dx or dy:
+                peak &= data >= padded[1 + dy:1 + dy + ny, 1 + dx:1 + dx + nx]
+    ys, xs = np.nonzero(peak)
+    inside = ((xs >= box) & (xs < nx - box) & (ys >= box) & (ys < ny - box))
+    ys, xs = ys[inside], xs[inside]
+    offs = np.arange(-box, box + 1)
+    cut = data[ys[:, None, None] + offs[None, :, None],
+               xs[:, None, None] + offs[None, None, :]] - bkg
+    flux = cut.sum(axis=(1, 2))
+    good = flux > 0
+    cut, flux, xs, ys = cut[good], flux[good], xs[good], ys[good]
+    w = np.clip(cut, 0, None)
+    wsum = w.sum(axis=(1, 2))
+    dx = (w * offs[None, None, :]).sum(axis=(1, 2)) / wsum
+    dy = (w * offs[None, :, None]).sum(axis=(1, 2)) / wsum
+    var = ((w * (offs[None, None, :] - dx[:, None, None]) ** 2 +
+            w * (offs[None, :, None] - dy[:, None, None]) ** 2).sum(axis=(1, 2))
+           / wsum / 2.)
+    npix = (2 * box + 1) ** 2
+    fluxerr = np.sqrt(npix * rms ** 2 + flux)
+    return bkg, rms, {"X_IMAGE_DBL": xs + dx + 1., "Y_IMAGE_DBL": ys + dy + 1.,
+                      "FLUX_AUTO": flux, "FLUXERR_AUTO": fluxerr,
+                      "FWHM_IMAGE": 2.3548 * np.sqrt(np.clip(var, 0.1, None))}
+
+
+def measure(data, values, nsigma=5.):
+    """Background, detection threshold and sextractor-like catalog columns
+    for the image ``data``.
+    """
+    bkg, rms, cols = detect(data, nsigma)
+    n = len(cols["FLUX_AUTO"])
+    cols["NUMBER"] = np.arange(1, n + 1)
+    cols["X_IMAGE"], cols["Y_IMAGE"] = cols["X_IMAGE_DBL"], cols["Y_IMAGE_DBL"]
+    cols["MAG_AUTO"] = -2.5 * np.log10(cols["FLUX_AUTO"])
+    cols["MAGERR_AUTO"] = 1.0857 * cols["FLUXERR_AUTO"] / cols["FLUX_AUTO"]
+    cols["KRON_RADIUS"] = np.full(n, 3.5)
+    cols["BACKGROUND"] = np.full(n, bkg)
+    cols["THRESHOLD"] = np.full(n, nsigma * rms)
+    cols["FLAGS"] = np.zeros(n, dtype=int)
+    cols["CLASS_STAR"] = np.full(n, 0.98)
+    if "CRVAL1" in values:
+        crval = (values["CRVAL1"], values["CRVAL2"])
+        crpix = (values["CRPIX1"], values["CRPIX2"])
+        cd = [[values.get("CD1_1", 0.), values.get("CD1_2", 0.)],
+              [values.get("CD2_1", 0.), values.get("CD2_2", 0.)]]
+        ra, dec = sky.tan_pix2world(cols["X_IMAGE_DBL"], cols["Y_IMAGE_DBL"],
+                                    crval, crpix, cd)
+        scale = np.sqrt(abs(np.linalg.det(np.asarray(cd))))
+    else:
+        ra, dec, scale = np.zeros(n), np.zeros(n), 0.
+    cols["ALPHA_J2000"] = cols["X_WORLD"] = ra
+    cols["DELTA_J2000"] = cols["Y_WORLD"] = dec
+    cols["FWHM_WORLD"] = cols["FWHM_IMAGE"] * scale
+    return bkg, nsigma * rms, cols
+
+
+def write_ascii_head(path, params, cols):
+    n = len(cols["NUMBER"])
+    columns = [np.asarray(cols.get(p, np.zeros(n))) for p in params]
+    with open(path, "w") as f:
+        for i, p in enumerate(params):
+            f.write("#{:>4d} {:<22}\n".format(i + 1, p))
+        for row in zip(*columns):
+            f.write(" ".join("{:.10g}".format(v) for v in row) + "\n")
+
+
+def _bintable(extname, columns):
+    """Header and data bytes of a BINTABLE extension; ``columns`` are
+    (name, tform, values) with tform "J", "D" or "<n>A".
+    """
+    dtypes = [(name, ">i4" if tform == "J" else ">f8" if tform == "D"
+               else "S{}".format(tform[:-1])) for name, tform, _ in columns]
+    nrows = len(columns[0][2]) if columns else 0
+    rows = np.zeros(nrows, dtype=dtypes)
+    for name, _, values in columns:
+        rows[name] = values
+    cards = [format_card("XTENSION", "BINTABLE"), format_card("BITPIX", 8),
+             format_card("NAXIS", 2), format_card("NAXIS1", rows.itemsize),
+             format_card("NAXIS2", nrows), format_card("PCOUNT", 0),
+             format_card("GCOUNT", 1), format_card("TFIELDS", len(columns))]
+    for i, (name, tform, _) in enumerate(columns):
+        cards += [format_card("TTYPE{}".format(i + 1), name),
+                  format_card("TFORM{}".format(i + 1), tform)]
+    cards.append(format_card("EXTNAME", extname))
+    data = rows.tobytes()
+    return header_bytes(cards) + data + b"\0" * (-len(data) % BLOCK)
+
+
+def write_fits_ldac(path, params, cols, image_cards=()):
+    """Write a FITS_LDAC catalog: an empty primary HDU, the image header
+    (LDAC_IMHEAD) and the objects table (LDAC_OBJECTS).
+    """
+    n = len(cols["NUMBER"])
+    imhead = header_bytes(image_cards).decode("ascii")
+    objects = [(p, "J" if p in ("NUMBER", "FLAGS") else "D",
+                np.asarray(cols.get(p, np.zeros(n)))) for p in params]
+    primary = [format_card("SIMPLE", True), format_card("BITPIX", 8),
+               format_card("NAXIS", 0), format_card("EXTEND", True)]
+    with open(path, "wb") as f:
+        f.write(header_bytes(primary))
+        f.write(_bintable("LDAC_IMHEAD", [
+            ("Field Header Card", "{}A".format(len(imhead)),
+             [imhead.encode("ascii")])]))
+        f.write(_bintable("LDAC_OBJECTS", objects))
+
+
+def sextractor(argv):
+    args, options = _parse_options(argv)
+    config = {}
+    if "c" in options:
+        config = read_sex_config(options["c"])
+        confdir = os.path.dirname(os.path.abspath(options["c"]))
+    else:
+        confdir = os.getcwd()
+    config.update(options)
+    params = config.get("PARAMETERS_NAME", "default.param")
+    if not os.path.isabs(params):
+        params = os.path.join(confdir, params)
+    params = read_params(params)
+
+    cards, values, data = read_image(args[0])
+    bkg, threshold, cols = measure(data, values)
+    catalog = config.get("CATALOG_NAME", "test.cat")
+    if config.get("CATALOG_TYPE", "ASCII_HEAD") == "FITS_LDAC":
+        write_fits_ldac(catalog, params, cols, cards)
+    else:
+        write_ascii_head(catalog, params, cols)
+
+    types = config.get("CHECKIMAGE_TYPE", "NONE").split(",")
+    names = config.get("CHECKIMAGE_NAME", "check.fits").split(",")
+    for kind, name in zip(types, names):
+        if kind == "BACKGROUND":
+            write_image(name, np.full(data.shape, bkg))
+        elif kind == "OBJECTS":
+            write_image(name, np.where(data > bkg + threshold,
+                                       data - bkg, 0.))
+    return 0
+
+
+# ===========
+# solve-field
+# ===========
+SOLVE_FIELD_FLAGS = {"-O", "--overwrite", "--no-plots", "-2",
+                     "--no-fits2fits", "-g", "--guess-scale", "--no-verify",
+                     "--crpix-center", "--no-remove-lines",
+                     "--no-background-subtraction", "--continue",
+                     "--skip-solved", "--downsample"}
+
+
+def wcs_cards(crval, crpix, cd):
+    return [format_card("WCSAXES", 2),
+            format_card("CTYPE1", "RA---TAN"),
+            format_card("CTYPE2", "DEC--TAN"),
+            format_card("EQUINOX", 2000.),
+            format_card("CRVAL1", float(crval[0])),
+            format_card("CRVAL2", float(crval[1])),
+            format_card("CRPIX1", float(crpix[0])),
+            format_card("CRPIX2", float(crpix[1])),
+            format_card("CD1_1", float(cd[0][0])),
+            format_card("CD1_2", float(cd[0][1])),
+            format_card("CD2_1", float(cd[1][0])),
+            format_card("CD2_2", float(cd[1][1]))]
+
+
+def solve_field(argv):
+    args, options = _parse_options(argv, SOLVE_FIELD_FLAGS)
+
+    def opt(*names):
+        for n in names:
+            if options.get(n) is not None:
+                return options[n]
+
+    path = args[0]
+    base = os.path.splitext(os.path.basename(path))[0]
+    outdir = opt("D", "dir") or os.path.dirname(os.path.abspath(path))
+    newfits = opt("N", "new-fits") or os.path.join(outdir, base + ".new")
+    wcsfile = opt("W", "wcs") or os.path.join(outdir, base + ".wcs")
+
+    with open(path, "rb") as f:
+        cards, values = read_header(f)
+        offset = f.tell()
+    xylist = not values.get("NAXIS")  # The table is in an extension
+    if xylist:
+        values["NAXIS1"] = int(opt("w", "width"))
+        values["NAXIS2"] = int(opt("e", "height"))
+    ra, dec = opt("3", "ra"), opt("4", "dec")
+    if ra is None or dec is None:  # Blind solving is beyond a stub
+        print("Did not solve (no --ra/--dec given).")
+        return 0
+    low, high = float(opt("L", "scale-low")), float(opt("H", "scale-high"))
+    crval = (parse_sexagesimal(ra, hours=":" in str(ra)),
+             parse_sexagesimal(dec))
+    crpix = ((values["NAXIS1"] + 1) / 2., (values["NAXIS2"] + 1) / 2.)
+    wcs = wcs_cards(crval, crpix, sky.cd_matrix((low + high) / 2.))
+    guess = opt("V", "verify")
+    if guess:  # An earlier solution of the field always verifies here
+        with open(guess, "rb") as f:
+            wcs = [c for c in read_header(f)[0]
+                   if c[:8].strip() not in ("SIMPLE", "BITPIX", "NAXIS")]
+
+    if not xylist:
+        keep = [c for c in cards if c[:8].strip() not in
+                {w[:8].strip() for w in wcs}]
+        with open(newfits, "wb") as out, open(path, "rb") as f:
+            out.write(header_bytes(keep + wcs))
+            f.seek(offset)
+            shutil.copyfileobj(f, out)
+    with open(wcsfile, "wb") as f:
+        f.write(header_bytes([format_card("SIMPLE", True),
+                              format_card("BITPIX", 8),
+                              format_card("NAXIS", 0)] + wcs))
+    with open(os.path.join(outdir, base + ".solved"), "wb") as f:
+        f.write(b"\1")
+    print("Field center: (RA,Dec) = ({:.6f}, {:.6f}) deg.".format(*crval))
+    return 0
+
+
+COMMANDS = {"sextractor": sextractor, "solve-field": solve_field}
+
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if not argv or argv[0] not in COMMANDS:
+        print("usage: python -m flipp.bench.stubs {} ...".format(
+            "|".join(sorted(COMMANDS))), file=sys.stderr)
+        return 2
+    return COMMANDS[argv[0]](argv[1:])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
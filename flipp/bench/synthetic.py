@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic star-field images with the headers the pipeline expects from each
+telescope (see ``TELESCOPES[...]["HEADER_MAPS"]``).
+"""
+
+from __future__ import unicode_literals, division
+
+import os
+import numpy as np
+
+from datetime import datetime, timedelta
+from astropy.io import fits
+from astropy.coordinates import Angle
+from astropy import units
+
+from flipp.bench import sky
+from flipp.conf import settings
+
+# Header values for the cards named in HEADER_MAPS, per telescope.
+FILTERS = {"kait": "clear", "nickel": "V", "nickelOld": "2373"}
+INSTRUMENTS = {"kait": "KAIT", "nickel": "Nickel Direct Camera",
+               "nickelOld": "Nickel Direct Camera"}
+
+ZEROPOINT = 25.  # Instrumental zeropoint of the fake camera
+FWHM = 3.  # pixels
+BACKGROUND = 1000.  # counts
+
+
+def pixel_scale(telescope):
+    """Mean arcsec/pixel from the telescope's astrometry settings."""
+    opts = settings.TELESCOPES[telescope]["ASTROMETRY_OPTIONS"]
+    return (opts["L"] + opts["H"]) / 2.
+
+
+def field_centers(n, seed=0):
+    """``n`` repeatable pointings spread over the northern sky."""
+    rs = np.random.RandomState(seed)
+    return list(zip(rs.uniform(0, 360, n), rs.uniform(-20, 70, n)))
+
+
+def make_header(telescope, ra, dec, size, obstime, index):
+    maps = settings.TELESCOPES[telescope]["HEADER_MAPS"]
+    header = fits.Header()
+    header["INSTRUME"] = INSTRUMENTS.get(telescope, telescope)
+    values = {"FILTER": FILTERS.get(telescope, "V"),
+              "DATE": "{:%d/%m/%Y}".format(obstime),
+              "TIME": "{:%H:%M:%S}".format(obstime),
+              "OBJECT": "bench{:05d}".format(index % 10000),
+              "DATID": "d{:03d}".format(index % 1000)}
+    for key, card in maps.items():
+        header[card] = values[key]
+    header["RA"] = Angle(ra * units.deg).to_string(unit=units.hour, sep=":",
+                                                   precision=2)
+    header["DEC"] = Angle(dec * units.deg).to_string(unit=units.deg, sep=":",
+                                                     precision=1,
+                                                     alwayssign=True)
+    header["EXPTIME"] = 60.
+    return header
+
+
+def make_image(telescope, ra, dec, size=256, seed=0, index=0,
+               obstime=None):
+    """A fake ``size`` x ``size`` exposure of the sky around (ra, dec).
+
+    Like raw telescope frames, the header only carries the pointing (RA,
+    DEC); the pixel grid is the one the stub solve-field reports, i.e.
+    centred on the pointing with north up and east left.
+    """
+    obstime = obstime or datetime(2016, 1, 1) + timedelta(minutes=index)
+    header = make_header(telescope, ra, dec, size, obstime, index)
+    scale = pixel_scale(telescope)
+    radius = size * scale / 3600. / np.sqrt(2)
+    stars = sky.stars_in_cone(ra, dec, radius)
+    band = {"clear": "r"}.get(FILTERS.get(telescope), "V")
+    x, y = sky.tan_world2pix(stars["ra"], stars["dec"], (ra, dec),
+                             ((size + 1) / 2., (size + 1) / 2.),
+                             sky.cd_matrix(scale))
+    flux = 10 ** (-0.4 * (stars[band] - ZEROPOINT))
+
+    rs = np.random.RandomState(seed)
+    data = rs.normal(BACKGROUND, np.sqrt(BACKGROUND), (size, size))
+    sigma = FWHM / 2.3548
+    half = int(4 * sigma) + 1
+    for xi, yi, f in zip(x - 1, y - 1, flux):  # 0-based from here
+        cx, cy = int(round(xi)), int(round(yi))
+        x0, x1 = max(cx - half, 0), min(cx + half + 1, size)
+        y0, y1 = max(cy - half, 0), min(cy + half + 1, size)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        yy, xx = np.mgrid[y0:y1, x0:x1]
+        data[y0:y1, x0:x1] += (f / (2 * np.pi * sigma ** 2) *
+                               np.exp(-((xx - xi) ** 2 + (yy - yi) ** 2) /
+                                      (2 * sigma ** 2)))
+    data = np.clip(data, 0, 65535).astype(np.uint16)
+    hdu = fits.PrimaryHDU(data=data, header=header)
+    return fits.HDUList([hdu])
+
+
+def make_images(outdir, n, telescope="kait", size=256, nfields=50):
+    """Write ``n`` images, cycling over ``nfields`` pointings the way a
+    monitoring program revisits its targets.  Returns the file paths.
+    """
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    fields = field_centers(nfields)
+    paths = []
+    for i in range(n):
+        ra, dec = fields[i % nfields]
+        path = os.path.join(outdir, "bench{:06d}.fits".format(i))
+        if not os.path.exists(path):
+            make_image(telescope, ra, dec, size, seed=i, index=i).writeto(path)
+        paths.append(path)
+    return paths
@@ -23,6 +23,19 @@ SEXCONFPATH = os.path.join(PROJECT_DIR, "libs", "sextractor_config")
 # PATH TO SOURCE-EXTRACTOR BINARY
 SEXTRACTORPATH = "/usr/bin/sextractor"
 
+# CATALOG FORMAT SOURCE-EXTRACTOR WRITES: "FITS_LDAC" (BINARY, READ AS A
+# MEMORY-MAPPED FITS TABLE) OR "ASCII_HEAD" (TEXT, MUCH SLOWER TO PARSE ON
+# CROWDED FIELDS).
+SEXTRACTOR_CATALOG_TYPE = "FITS_LDAC"
+
+# THE ONLY CATALOG COLUMNS FLIPP USES.  A PARAMETERS_NAME FILE LISTING JUST
+# THESE IS WRITTEN FOR EACH RUN; SET TO None TO MEASURE EVERYTHING IN
+# default.param INSTEAD.
+SEXTRACTOR_PARAMETERS = ["ALPHA_J2000", "DELTA_J2000",
+                         "X_IMAGE_DBL", "Y_IMAGE_DBL",
+                         "FLUX_AUTO", "MAG_AUTO", "MAGERR_AUTO",
+                         "FLAGS", "FWHM_IMAGE", "CLASS_STAR"]
+
 
 # =================================
 # GLOBAL ASTROMETRY CONFIG SETTINGS
@@ -37,6 +50,45 @@ ASTROMETRYCONF = os.path.join(PROJECT_DIR, "libs", "astrometry.cfg")
 # PATH TO ASTROMETRY.NET'S solve-field BINARY
 SOLVEFIELDPATH = "/usr/bin/solve-field"
 
+# GIVE solve-field A BACKEND CONFIG (WRITTEN UNDER CACHE_ROOT) LISTING ONLY THE
+# INDEX FILES OF ASTROMETRYCONF WHOSE SKY TILE AND QUAD SCALES CAN MATCH THE
+# IMAGE, INSTEAD OF EVERY INDEX ASTROMETRYCONF LOADS.  SEE flipp/libs/indexes.py
+ASTROMETRY_SELECT_INDEXES = True
+
+# LOAD THOSE INDEXES "inparallel" WHEN THEY ADD UP TO NO MORE THAN THIS
+# FRACTION OF THE MEMORY AVAILABLE AT THE TIME.  0 NEVER DOES.
+ASTROMETRY_INPARALLEL_MEMORY = 0.5
+
+# HOW solve-field IS TRIED ON EACH IMAGE (flipp/pipeline/ladder.py) : RUNGS IN
+# ORDER, EACH ONLY FOR IMAGES THE ONE BEFORE FAILED ON.  "radius" IS THE
+# SEARCH RADIUS AROUND THE HEADER POINTING IN DEGREES (None : WHOLE SKY),
+# "scale_margin" WIDENS THE TELESCOPE'S L/H PIXEL SCALES BY THAT FRACTION
+# (None : ANY SCALE), "tweak" IS THE SIP ORDER FITTED AND "timeout" THE MOST
+# SECONDS THE RUNG MAY TAKE.
+ASTROMETRY_LADDER = [
+    {"name": "narrow", "radius": 0.15, "scale_margin": 0., "tweak": 1,
+     "timeout": 30},
+    {"name": "wide", "radius": 1., "scale_margin": 0.1, "tweak": 2,
+     "timeout": 60},
+    {"name": "blind", "radius": None, "scale_margin": None, "tweak": 2,
+     "timeout": 300},
+]
+
+# ONCE A RUNG HAS SOLVED ASTROMETRY_TIMEOUT_SAMPLES IMAGES OF A TELESCOPE, ITS
+# TIMEOUT BECOMES ASTROMETRY_TIMEOUT_FACTOR TIMES THE
+# ASTROMETRY_TIMEOUT_PERCENTILE-TH PERCENTILE OF THE LAST
+# ASTROMETRY_TIMEOUT_HISTORY SOLVE TIMES, BUT NEVER LESS THAN
+# ASTROMETRY_TIMEOUT_MIN SECONDS NOR MORE THAN THE RUNG'S "timeout".
+ASTROMETRY_TIMEOUT_SAMPLES = 20
+ASTROMETRY_TIMEOUT_HISTORY = 200
+ASTROMETRY_TIMEOUT_PERCENTILE = 95
+ASTROMETRY_TIMEOUT_FACTOR = 2.
+ASTROMETRY_TIMEOUT_MIN = 5
+
+# COPY IMAGES THAT FAIL EVERY RUNG OF ASTROMETRY_LADDER TO
+# OUTPUT_ROOT/REVIEW/<date>/, TO BE LOOKED AT BY HAND
+ASTROMETRY_SAVE_REVIEW = True
+
 # ===========================
 # OUTPUT/APP RELATED SETTINGS
 # ===========================
@@ -48,11 +100,129 @@ SOLVEFIELDPATH = "/usr/bin/solve-field"
 OUTPUT_ROOT = os.path.abspath(os.path.join(os.path.expanduser('~'),
                                            "FLIPPOUT"))
 
+# IF True, sextractor AND solve-field EACH WORK ON THEIR OWN TEMPORARY COPY OF
+# EVERY IMAGE.  BY DEFAULT PLAIN FITS FILES ARE READ WHERE THEY ARE, AND ONE
+# TEMPORARY COPY IS ONLY WRITTEN FOR COMPRESSED (.Z) IMAGES OR HEADERS THAT
+# NEED FIXING.  ORIGINAL IMAGES ARE NEVER MODIFIED OR DELETED EITHER WAY.
+COPY_INPUT_IMAGES = False
+
+# HOW ImageParser.validate COUNTS SOURCES TO REJECT BLANK OR GARBAGE FRAMES:
+# "numpy" DETECTS THEM IN-PROCESS (flipp/libs/detect.py, MILLISECONDS);
+# "sextractor" USES THE FULL SOURCE-EXTRACTOR CATALOG.
+VALIDATION_DETECTOR = "numpy"
+
+# PRE-FLIGHT TRIAGE (flipp/pipeline/triage.py) : FRAMES BREAKING ANY OF THESE
+# RULES ARE REJECTED BEFORE sextractor OR solve-field EVER SEE THEM.  A
+# TELESCOPE CAN OVERRIDE ANY OF THEM WITH A "TRIAGE" ENTRY IN TELESCOPES.
+# RULES SET TO None ARE NOT CHECKED.
+TRIAGE_RULES = {
+    # HEADER CARD -> REGULAR EXPRESSION (CASE-INSENSITIVE) MARKING NON-SCIENCE
+    # FRAMES
+    "HEADER_PATTERNS": {
+        "IMAGETYP": "flat|dark|bias|zero",
+        "OBJECT": "^(flat|dark|bias|dome|twilight|zero)",
+    },
+    "SATURATION_LEVEL": 60000,  # ADU
+    "MAX_SATURATED_FRACTION": 0.05,
+    "MIN_BACKGROUND": None,  # ADU
+    "MAX_BACKGROUND": 40000,  # ADU; CLOUDS AND TWILIGHT
+    "MIN_DYNAMIC_RANGE": None,  # (99.9TH PERCENTILE - MEDIAN) / RMS
+    "MIN_STARS": 3,  # IN THE BINNED CENTRAL CUTOUT
+    "SAMPLE_SIZE": 256,  # PIXELS ON A SIDE OF THE SAMPLE THE RULES LOOK AT
+}
+
+# REUSE THE WCS OF EARLIER IMAGES OF A FIELD (flipp/pipeline/wcscache.py):
+# A CACHED SOLUTION WHOSE POINTING IS WITHIN WCS_CACHE_RADIUS DEGREES IS
+# VERIFIED AGAINST THE NEW IMAGE BY solve-field --verify, GIVING UP AFTER
+# WCS_VERIFY_CPULIMIT CPU SECONDS; ONLY THEN IS THE IMAGE SOLVED BLIND.
+WCS_CACHE = True
+WCS_CACHE_RADIUS = 0.1
+WCS_VERIFY_CPULIMIT = 10
+
+# WHERE EACH IMAGE'S SCRATCH WORKSPACE (TEMPORARY COPIES, CATALOGS, CHECK IMAGES
+# AND solve-field OUTPUTS) IS CREATED.  None USES THE SYSTEM TEMP DIRECTORY;
+# A TMPFS SUCH AS "/dev/shm" KEEPS ALL OF THAT TRAFFIC OFF THE DISK.
+SCRATCH_ROOT = None
+
+# WHERE FLIPP KEEPS FILES WORTH REUSING FROM ONE RUN TO THE NEXT, E.G. THE
+# PER-FIELD solve-field BACKEND CONFIGS.
+CACHE_ROOT = os.path.join(os.path.expanduser('~'), ".cache", "flipp")
+
+# NUMBER OF IMAGES flipprun PROCESSES IN PARALLEL (ONE WORKER PROCESS EACH).
+# SET TO THE NUMBER OF CORES TO KEEP solve-field/sextractor BUSY.
+PIPELINE_JOBS = 1
+
+# SECONDS AFTER WHICH A PARALLEL WORKER (AND ANY solve-field/sextractor IT
+# STARTED) IS KILLED AND THE IMAGE REPORTED AS TIMED OUT.  None TO DISABLE.
+PIPELINE_IMAGE_TIMEOUT = 900
+
+# WORKER THREADS PER STAGE FOR flipprun --staged.  TRIAGE IS A QUICK LOOK AT
+# THE HEADER AND A PIXEL SAMPLE, EXTRACTION (sextractor) AND ASTROMETRY
+# (solve-field, THE SLOWEST) ARE CPU-BOUND SUBPROCESSES, ZEROPOINTING WAITS ON
+# THE APASS WEB SERVICE AND INGEST IS BOUND BY DATABASE LOCKS, SO THEY ARE
+# SIZED INDEPENDENTLY.
+PIPELINE_STAGE_WORKERS = {
+    "triage": 1,
+    "extract": 2,
+    "solve": 4,
+    "zeropoint": 4,
+    "ingest": 1,
+}
+
+# MAXIMUM NUMBER OF IMAGES WAITING IN FRONT OF EACH STAGE.  A FULL QUEUE
+# STALLS THE STAGE FEEDING IT, WHICH BOUNDS MEMORY USE.
+PIPELINE_STAGE_QUEUE_SIZE = 8
+
 # DATABASE URI TO RECORD BRIGHTNESS/SOURCE INFORMATION
 # SEE http://docs.sqlalchemy.org/en/latest/core/engines.html FOR OPTIONS
 # TO USE MySQL : "mysql://db_usr:db_psw@db_host/db_name"
 DB_URL = "sqlite://"
 
+# flipp watch : SECONDS BETWEEN LOOKING FOR NEW FILES, AND HOW LONG A FILE'S
+# SIZE AND MODIFICATION TIME MUST STAY UNCHANGED BEFORE IT IS CONSIDERED
+# COMPLETELY WRITTEN.
+WATCH_INTERVAL = 5
+WATCH_SETTLE = 10
+
+# BASE URL OF THE AAVSO APASS DOWNLOAD SERVICE USED FOR ZEROPOINTS.
+# flippbench POINTS THIS AT A LOCAL FAKE (flipp.bench.apass_server).
+APASS_HOST = "https://www.aavso.org/"
+
+# WHERE ZEROPOINTING GETS ITS APASS STARS (SEE flipp/libs/refcat.py):
+# "service" ASKS THE AAVSO WEB SERVICE FOR EVERY IMAGE; "cache" KEEPS WHAT IT
+# FETCHES UNDER CACHE_ROOT (BELOW); "offline" READS THE CATALOG BUILT BY
+# flipp build-catalog IN REFCAT_PATH AND NEVER TOUCHES THE NETWORK.
+REFCAT = "cache"
+REFCAT_PATH = None
+
+# THE "cache" REFCAT KEEPS THE APASS STARS ON DISK, UNDER CACHE_ROOT/apass, IN
+# FIXED TILES OF SKY APASS_TILE_SIZE DEGREES ACROSS, SO REPEAT FIELDS NEED NO
+# NETWORK.  TILES OLDER THAN APASS_CACHE_MAX_AGE SECONDS ARE FETCHED AGAIN AND
+# THE LEAST RECENTLY USED ONES ARE DELETED BEYOND APASS_CACHE_MAX_BYTES.
+# SEE flipp/libs/refcache.py
+APASS_TILE_SIZE = 1.
+APASS_CACHE_MAX_BYTES = 2 * 1024 ** 3
+APASS_CACHE_MAX_AGE = 180 * 24 * 3600
+
+# APASS REQUESTS ARE MADE OVER A POOLED HTTP SESSION; FAILED ONES ARE RETRIED
+# APASS_HTTP_RETRIES TIMES, WAITING APASS_HTTP_BACKOFF * 2 ** n SECONDS BETWEEN
+# TRIES.  A REQUEST IS GIVEN UP ON AFTER APASS_TIMEOUT SECONDS OF SILENCE.
+APASS_TIMEOUT = 60
+APASS_HTTP_RETRIES = 3
+APASS_HTTP_BACKOFF = 0.5
+
+# flipp prefetch (AND flipprun --prefetch) READ THE HEADERS OF A BATCH AND
+# FETCH THE APASS TILES OF EVERY FIELD BEFORE ANY IMAGE IS PROCESSED, AT MOST
+# APASS_PREFETCH_JOBS REQUESTS AT A TIME.  FIELDS ARE TAKEN TO REACH
+# APASS_PREFETCH_MARGIN DEGREES PAST THE IMAGE CORNERS, FOR POINTING ERRORS.
+APASS_PREFETCH_JOBS = 8
+APASS_PREFETCH_MARGIN = 0.05
+
+# DATABASE URI FOR THE PIPELINE'S OWN BOOKKEEPING (E.G. WHICH FILES HAVE
+# ALREADY BEEN PROCESSED, FOR flipprun --resume).  None KEEPS A SQLITE FILE,
+# "flipp_state.sqlite", IN THE OUTPUT DIRECTORY OF EACH RUN.
+STATE_DB_URL = None
+
 # FITS-HEADERS TO USE TO ATTEMPT TO FIGURE OUT TELESCOPE NAMES
 # IF YOU HAVE FITS HEADERS THAT DESCRIBE THE INSTRUMENT NAME, THEY
 # SHOULD GO HERE, OR ELSE YOU'LL HAVE TO EXPLICITLY PASS IN THE
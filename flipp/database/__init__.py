@@ -3,10 +3,78 @@
 from __future__ import unicode_literals
 from builtins import str
 
-from sqlalchemy import create_engine
+import numpy as np
+
+from sqlalchemy import create_engine, inspect, select, bindparam
 
 from flipp.conf import settings
-from .models import Base
+from flipp.libs import healpix
+from .models import Base, Source, HPIX_NSIDE
 
 engine = create_engine(settings.DB_URL)
 Base.metadata.create_all(engine)
+
+_indexed = set()  # Engines whose Sources all have their hpix
+
+
+class SourcesNotIndexed(Exception):
+    """``flipp_source`` has Sources without their ``hpix``: cone searches
+    would silently miss them."""
+
+
+def check_sources_indexed(engine=engine):
+    """Raise :class:`SourcesNotIndexed` if ``flipp_source`` was made before
+    ``Source.hpix`` and ``flipp index-sources`` has not been run on it.
+
+    Checked once per engine: Sources inserted since always get an ``hpix``.
+    """
+    if engine in _indexed:
+        return
+    table = Source.__table__
+    if ("hpix" not in [c["name"] for c in
+                       inspect(engine).get_columns(table.name)] or
+            engine.execute(select([table.c.pk]).where(
+                table.c.hpix == None).limit(1)).first() is not None):
+        raise SourcesNotIndexed(
+            "{} at {} has Sources without their HEALPix cell; run "
+            "`flipp index-sources` before ingesting".format(
+                table.name, engine.url))
+    _indexed.add(engine)
+
+
+def index_sources(engine=engine, chunk=100000):
+    """Bring a ``flipp_source`` table made before ``Source.hpix`` up to date:
+    add the column, fill it in for every Source, ``chunk`` rows per
+    transaction, and create its index.  Safe to rerun.
+
+    Returns the number of Sources filled in.
+    """
+    table = Source.__table__
+    if "hpix" not in [c["name"] for c in
+                      inspect(engine).get_columns(table.name)]:
+        engine.execute("ALTER TABLE {} ADD COLUMN hpix BIGINT".format(
+            table.name))
+    update = table.update().where(table.c.pk == bindparam("b_pk")).values(
+        hpix=bindparam("b_hpix"))
+    n, last = 0, None
+    while True:
+        query = select([table.c.pk, table.c.ra, table.c.decl]).where(
+            table.c.hpix == None).order_by(table.c.pk).limit(chunk)
+        if last is not None:
+            query = query.where(table.c.pk > last)
+        rows = engine.execute(query).fetchall()
+        if not rows:
+            break
+        pk, ra, dec = zip(*rows)
+        cells = healpix.nested(HPIX_NSIDE, np.asarray(ra, dtype=float),
+                               np.asarray(dec, dtype=float))
+        with engine.begin() as conn:
+            conn.execute(update, [{"b_pk": p, "b_hpix": int(c)}
+                                  for p, c in zip(pk, cells)])
+        n += len(rows)
+        last = pk[-1]
+    existing = [i["name"] for i in inspect(engine).get_indexes(table.name)]
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(engine)
+    return n
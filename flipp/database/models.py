@@ -4,10 +4,22 @@ from __future__ import unicode_literals
 from builtins import str
 
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
-from sqlalchemy import Column, Integer, String, Float, ForeignKey
+from sqlalchemy import (Column, Integer, BigInteger, String, Float,
+                        ForeignKey, Index)
+
+from flipp.libs import healpix
 
 Base = declarative_base()
 
+HPIX_NSIDE = 2 ** 16
+"""HEALPix resolution of ``Source.hpix`` (pixels about 3 arcsec across)."""
+
+
+def source_hpix(context):
+    """``Source.hpix`` of the row being inserted, from its ra/decl."""
+    params = context.current_parameters
+    return int(healpix.nested(HPIX_NSIDE, params['ra'], params['decl']))
+
 class FlippModel(object):
 
     @declared_attr
@@ -31,6 +43,11 @@ class Source(FlippModel, Base):
     classification = Column(String(length = 255, convert_unicode=True))
     ra = Column(Float(precision=53), index=True)
     decl = Column(Float(precision=53), index=True)
+    # NESTED HEALPix pixel at HPIX_NSIDE, for cone searches by pixel ranges
+    # (see flipp.libs.healpix.cone_ranges); filled in on every insert
+    hpix = Column(BigInteger, default=source_hpix)
+
+    __table_args__ = (Index("ix_flipp_source_hpix", "hpix", "ra", "decl"),)
 
 
 class Image(FlippModel, Base):
@@ -0,0 +1,106 @@
+# -*- coding:utf-8 -*-
+"""
+Bookkeeping the pipeline keeps for itself, as opposed to the photometry
+in ``settings.DB_URL``.
+
+This lives in its own (by default SQLite) database next to the pipeline
+outputs, so that a run's memory of what it has already done never has to go
+through, or be cleaned out of, the shared science database.
+"""
+
+from __future__ import unicode_literals
+from builtins import str
+
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import Column, Integer, String, Float, BigInteger, Text
+
+from flipp.conf import settings
+from .models import FlippModel
+
+StateBase = declarative_base()
+
+_sessionmakers = {}
+
+
+class ProcessedFile(FlippModel, StateBase):
+    """Manifest entry : what happened the last time we saw an input file."""
+
+    path = Column(String(length=999, convert_unicode=True), unique=True,
+                  index=True)
+    size = Column(BigInteger)
+    mtime = Column(Float(precision=53))
+    checksum = Column(String(length=40))  # sha1, only if requested
+    stage = Column(String(length=32))  # Last stage completed
+    outcome = Column(String(length=32))  # See flipp.pipeline.results.STATUSES
+    output_file = Column(String(length=999, convert_unicode=True))
+    message = Column(String(length=999, convert_unicode=True))
+    updated = Column(Float(precision=53))
+
+
+class CachedSolution(FlippModel, StateBase):
+    """WCS solution of a field, tried first on later images of it; see
+    :mod:`flipp.pipeline.wcscache`.
+    """
+
+    telescope = Column(String(length=32), index=True)
+    object = Column(String(length=255, convert_unicode=True), index=True)
+    ra = Column(Float(precision=53))  # Header pointing, degrees
+    dec = Column(Float(precision=53))
+    width = Column(Integer)
+    height = Column(Integer)
+    header = Column(Text)  # solve-field's --wcs output
+    hits = Column(Integer, default=0)  # Times it was verified on a new image
+    updated = Column(Float(precision=53))
+
+
+class SolveAttempt(FlippModel, StateBase):
+    """One run of solve-field on an image; see :mod:`flipp.pipeline.ladder`."""
+
+    path = Column(String(length=999, convert_unicode=True))
+    telescope = Column(String(length=32), index=True)
+    rung = Column(String(length=32), index=True)  # Name of the ladder rung
+    outcome = Column(String(length=32))  # "solved", "failed" or "timeout"
+    elapsed = Column(Float)
+    timeout = Column(Float)  # The (learned) limit it ran under
+    created = Column(Float(precision=53))
+
+
+def state_url(output_root):
+    """Database URI of the state database used for ``output_root``."""
+    return settings.STATE_DB_URL or "sqlite:///{}".format(
+        os.path.join(os.path.abspath(output_root), "flipp_state.sqlite"))
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # The parent process and its workers may share the file; wait on locks
+    # instead of failing, and don't fsync on every manifest update.
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+def get_state_session(output_root):
+    """New session on the state database for ``output_root``, creating the
+    database and its tables on first use.
+    """
+    url = state_url(output_root)
+    if url not in _sessionmakers:
+        if url.startswith("sqlite"):
+            engine = create_engine(url, connect_args={"timeout": 60})
+            event.listen(engine, "connect", _set_sqlite_pragmas)
+        else:
+            engine = create_engine(url)
+        StateBase.metadata.create_all(engine)
+        _sessionmakers[url] = sessionmaker(bind=engine)
+    return _sessionmakers[url]()
+
+
+def dispose_state_engines():
+    """Drop pooled connections, e.g. after forking a worker process."""
+    for maker in _sessionmakers.values():
+        maker.kw["bind"].dispose()
@@ -3,12 +3,18 @@
 from __future__ import unicode_literals
 from builtins import str
 
+import os
 import warnings
 import requests
+import numpy as np
 from astropy.table import Table
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 from StringIO import StringIO
 
+from flipp.conf import settings
+
 class Client(object):
     """FLIPP Python client for accessing and querying the APASS database.
 
@@ -22,10 +28,32 @@ class Client(object):
         print(APASS.query(5, 5, 1.))
     """
 
-    host = "https://www.aavso.org/"
+    host = settings.APASS_HOST
     endpoint = "cgi-bin/apass_download.pl"
-    # __cache = {}
     agent = "UC Berkeley Filippenko Group's Photometry Pipeline"
+    timeout = settings.APASS_TIMEOUT
+    _session = None
+    _session_pid = None
+
+    @classmethod
+    def session(cls):
+        """Pooled HTTP session that retries failed requests with backoff
+        (``APASS_HTTP_RETRIES``, ``APASS_HTTP_BACKOFF``); one per process,
+        so forked workers never share connections.
+        """
+        if cls._session is None or cls._session_pid != os.getpid():
+            retries = Retry(total=settings.APASS_HTTP_RETRIES,
+                            backoff_factor=settings.APASS_HTTP_BACKOFF,
+                            status_forcelist=(500, 502, 503, 504))
+            adapter = HTTPAdapter(max_retries=retries,
+                                  pool_connections=1,
+                                  pool_maxsize=settings.APASS_PREFETCH_JOBS)
+            session = requests.Session()
+            session.headers['User-Agent'] = cls.agent
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            cls._session, cls._session_pid = session, os.getpid()
+        return cls._session
 
     @classmethod
     def _build_url(cls, **kwargs):
@@ -39,13 +67,9 @@ class Client(object):
 
     @classmethod
     def _get(cls, ra, dec, radius, outtype=1):
-        # cachekey = (ra, dec, radius)
-        # if cachekey in cls.__cache:
-        #     return cls.__cache[cachekey]
+        # Repeat fields are cached on disk instead; see flipp.libs.refcache
         url = cls._build_url(ra=ra, dec=dec, radius=radius, outtype=outtype)
-        r = requests.get(url, headers={'User-Agent' : cls.agent})
-        # cls.__cache[cachekey] = r
-        return r
+        return cls.session().get(url, timeout=cls.timeout)
 
     @classmethod
     def query(cls, ra, dec, radius, outtype='1'):
@@ -78,9 +102,14 @@ class Client(object):
         """
         r = cls._get(ra, dec, radius, outtype)
         assert r.status_code == 200, "Invalid query"
-        # replace all values labeled 'NA' with NaN, so numpy can handle it
-        text = r.text.replace('NA','NaN')
+        # Missing values are 'NA'; read them as masked, then NaN, so numpy
+        # can handle them (without touching 'NA' inside other fields)
         with warnings.catch_warnings():
             warnings.simplefilter('ignore')
-            out = Table.read(StringIO(text), format="ascii.csv")
+            out = Table.read(StringIO(r.text), format="ascii.csv",
+                             fill_values=[("NA", "nan")])
+        for name in out.colnames:
+            column = out[name]
+            if hasattr(column, "filled") and column.dtype.kind == "f":
+                out[name] = column.filled(np.nan)
         return out
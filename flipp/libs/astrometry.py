@@ -22,16 +22,23 @@ from __future__ import unicode_literals
 from builtins import str
 
 import os
+import re
 import argparse
 import glob
+import shutil
+import numpy as np
 
 from collections import OrderedDict
 
-from tempfile import mktemp
-
+from astropy import units as u
+from astropy.coordinates import Angle
 from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
 
+from flipp.libs import indexes
 from flipp.libs.utils import shMixin, FitsIOMixin
+from flipp.libs.workspace import Workspace
 from flipp.conf import settings
 
 SEXCONFPATH = settings.SEXCONFPATH
@@ -39,6 +46,16 @@ SEXTRACTORPATH = settings.SEXTRACTORPATH
 ASTROMETRYCONF = settings.ASTROMETRYCONF
 SOLVEFIELDPATH = settings.SOLVEFIELDPATH
 TELESCOPES = settings.TELESCOPES
+ASTROMETRY_SELECT_INDEXES = settings.ASTROMETRY_SELECT_INDEXES
+
+SEARCH_RADIUS = 0.3
+"""Degrees around the header pointing solve-field searches (--radius)."""
+
+WCS_KEYWORD_RE = re.compile(
+    r"^(WCSAXES|CTYPE\d|CUNIT\d|CRVAL\d|CRPIX\d|CDELT\d|CROTA\d|CD\d_\d|"
+    r"PC\d_\d|[AB]P?_(ORDER|\d+_\d+)|EQUINOX|EPOCH|RADESYS|RADECSYS|LONPOLE|"
+    r"LATPOLE|IMAGEW|IMAGEH)$")
+"""Header keywords that belong to a WCS solution."""
 
 
 class Astrometry(shMixin, FitsIOMixin):
@@ -47,7 +64,7 @@ class Astrometry(shMixin, FitsIOMixin):
     required_config_keys = ("H", "L",)  # For FitsIOMixin
     timeout = 60
 
-    def __init__(self, fp_or_buffer, telescope=None):
+    def __init__(self, fp_or_buffer, telescope=None, workspace=None):
         """Runs atrometry on a single fits file/image.
 
         Parameters
@@ -56,8 +73,13 @@ class Astrometry(shMixin, FitsIOMixin):
             filepath to image or astropy fits image
         telescope_config : str
             'kait', 'nickel' or user specified config
+        workspace : flipp.libs.workspace.Workspace, optional
+            where solve-field writes; the solved image stays there until
+            the workspace is cleaned up
         """
-        name, path, image = self._parse_input(fp_or_buffer)
+        self.workspace = workspace or Workspace(prefix="SOLVE-")
+        name, path, image = self._parse_input(fp_or_buffer,
+                                              workspace=self.workspace)
         telescope = telescope or self.get_telescope(image[0].header)
         telescope_config = self._parse_telescope_config(
             telescope, 'ASTROMETRY_OPTIONS')
@@ -67,6 +89,28 @@ class Astrometry(shMixin, FitsIOMixin):
         self.telescope = telescope_config
         self.last_cmd = None
         self.success = False
+        self.scratch_dir = None  # solve-field's --dir, made fresh per solve
+        self._backend_configs = {}
+
+    def backend_config(self, radius=SEARCH_RADIUS, scale_low=None,
+                       scale_high=None):
+        """Backend config listing only the index files that can solve this
+        image within ``radius`` degrees of its header pointing at the given
+        pixel scales (see :mod:`flipp.libs.indexes`), or ``ASTROMETRYCONF``
+        if that can't be narrowed down (e.g. for a blind solve).
+        """
+        key = (radius, scale_low, scale_high)
+        if key not in self._backend_configs:
+            config = ASTROMETRYCONF
+            header = self.image[0].header
+            where = pointing(header)
+            if (ASTROMETRY_SELECT_INDEXES and where is not None and
+                    None not in key):
+                config = indexes.backend_config(
+                    ASTROMETRYCONF, where[0], where[1], radius, scale_low,
+                    scale_high, header["NAXIS1"], header["NAXIS2"])
+            self._backend_configs[key] = config
+        return self._backend_configs[key]
 
     @property
     def defaults(self):
@@ -78,12 +122,12 @@ class Astrometry(shMixin, FitsIOMixin):
                           ('2', None),  # --no-fits2fits
                           ("3", self.image[0].header["RA"].strip()),  # --ra
                           ("4", self.image[0].header["DEC"].strip()),  # --dec
-                          ("5", 0.3),  # --radius
+                          ("5", SEARCH_RADIUS),  # --radius
                           ("L", self.telescope['L']),  # --scale-low
                           ("H", self.telescope['H']),  # --scale-high
-                          ("D", os.path.dirname(os.path.abspath(self.path))),  # --dir
-                          ("N", mktemp(prefix="SOLVED-",
-                                       suffix="%s" % (self.name))),  # --new-fits
+                          ("D", self.scratch_dir),  # --dir
+                          ("N", self.workspace.join(
+                              "SOLVED-%s" % (self.name))),  # --new-fits
                           ("-sextractor-path", SEXTRACTORPATH),
                           )
         return OrderedDict(default_values)
@@ -93,6 +137,29 @@ class Astrometry(shMixin, FitsIOMixin):
             config_dict = dict(self.defaults)
         return config_dict['N'] or config_dict['--new-fits'] or None
 
+    def _run(self, path, defaults, args, kwargs):
+        """Run solve-field on ``path``; returns the options used.  Options
+        given as False in ``kwargs`` are left out altogether.
+        """
+        # solve-field names its side outputs (.axy, .wcs, .solved, ...)
+        # after the input, so keep them in a directory of their own rather
+        # than next to an input image that may be the original.
+        self.scratch_dir = self.workspace.mkdir(prefix="SOLVE-")
+        try:
+            defaults["D"] = self.scratch_dir
+            args = self.update_args([path], args)
+            options = self.update_kwargs(defaults, kwargs)
+            options = {k: v for k, v in options.items() if v is not False}
+            if options.get("b") == ASTROMETRYCONF:
+                options["b"] = self.backend_config(
+                    options.get("5"), options.get("L"), options.get("H"))
+            self.last_cmd = self.configure(*args, **options)
+            output = self.sh(*args, **options)
+        finally:
+            # Only the --new-fits or --wcs output is of any further use
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+        return options
+
     def solve(self, *args, **kwargs):
         """Run astrometry on given file input.
 
@@ -100,22 +167,133 @@ class Astrometry(shMixin, FitsIOMixin):
         ----
         Refer to man-page
         """
-        args = self.update_args([self.path], args)
-        options = self.update_kwargs(self.defaults, kwargs)
+        options = self._run(self.path, self.defaults, args, kwargs)
         outpath = self.get_output_path(options)
         self.outpath = outpath
-        self.last_cmd = self.configure(*args, **options)
-        output = self.sh(*args, **options)
-        # Delete all temporary files
-        tempfiles = glob.glob('{}*'.format(os.path.splitext(self.path)[0]))
-        for f in tempfiles:
-            os.remove(f)
         if os.path.exists(outpath):
             self.success = True
             return fits.open(outpath)
         else:
             self.success = False
 
+    def write_xylist(self, sources):
+        """Write the pixel positions of ``sources`` (a sextractor catalog),
+        brightest first, as a solve-field xylist.
+        """
+        order = np.argsort(np.asarray(sources['FLUX_AUTO']))[::-1]
+        xylist = Table([np.asarray(sources['X_IMAGE_DBL'])[order],
+                        np.asarray(sources['Y_IMAGE_DBL'])[order],
+                        np.asarray(sources['FLUX_AUTO'])[order]],
+                       names=("X", "Y", "FLUX"))
+        path = self.workspace.join("XYLIST-{}.xyls".format(
+            os.path.splitext(self.name)[0]))
+        xylist.write(path, format="fits", overwrite=True)
+        return path
+
+    def solve_xylist(self, sources, *args, **kwargs):
+        """Run astrometry on already extracted ``sources`` rather than on
+        the image, so that solve-field skips its own source detection.
+
+        Returns the header of the solution (see :func:`update_wcs`), or
+        None if the field was not solved.
+        """
+        header = self.image[0].header
+        defaults = self.defaults
+        for k in ("N", "-sextractor-path"):  # No image to write or extract
+            defaults.pop(k, None)
+        defaults.update((("-width", header["NAXIS1"]),
+                         ("-height", header["NAXIS2"]),
+                         ("-x-column", "X"),
+                         ("-y-column", "Y"),
+                         ("-sort-column", "FLUX"),
+                         ("W", self.workspace.join("SOLVED-{}.wcs".format(
+                             os.path.splitext(self.name)[0]))),  # --wcs
+                         ))
+        options = self._run(self.write_xylist(sources), defaults, args,
+                            kwargs)
+        outpath = options["W"]
+        self.outpath = outpath
+        if os.path.exists(outpath):
+            self.success = True
+            return fits.getheader(outpath)
+        else:
+            self.success = False
+
+    def verify_xylist(self, sources, guess, cpulimit=None, *args, **kwargs):
+        """:meth:`solve_xylist`, starting from ``guess`` (a WCS header, e.g.
+        the solution of an earlier image of the field): solve-field checks
+        and tweaks it against ``sources`` first, and only searches its
+        indexes if it does not fit, for at most ``cpulimit`` CPU seconds.
+        """
+        path = self.workspace.join("GUESS-{}.wcs".format(
+            os.path.splitext(self.name)[0]))
+        with open(path, 'wb') as f:
+            f.write(guess.tostring().encode('ascii'))
+        kwargs["V"] = path  # --verify
+        if cpulimit:
+            kwargs["l"] = cpulimit  # --cpulimit
+        return self.solve_xylist(sources, *args, **kwargs)
+
+
+def pointing(header):
+    """(ra, dec) in degrees from the RA/DEC cards of ``header``, or None.
+    Sexagesimal RA is in hours, decimal RA in degrees.
+    """
+    try:
+        ra, dec = header["RA"], header["DEC"]
+        if isinstance(ra, basestring):
+            ra = Angle(ra.strip(), unit=u.hourangle).degree
+        if isinstance(dec, basestring):
+            dec = Angle(dec.strip(), unit=u.deg).degree
+        return float(ra), float(dec)
+    except (KeyError, ValueError, TypeError, u.UnitsError):
+        return None
+
+
+def update_wcs(header, solution):
+    """A copy of image ``header`` with its WCS replaced by the one in
+    ``solution`` (e.g. solve-field's ``--wcs`` output).  Only the WCS cards
+    of the solution are taken; the rest of what solve-field writes (its
+    ``DATE``, the COMMENT log of its run, ...) would duplicate the image's
+    own cards.
+    """
+    header = header.copy()
+    for key in list(header.keys()):
+        if WCS_KEYWORD_RE.match(key):
+            del header[key]
+    for card in solution.cards:
+        if WCS_KEYWORD_RE.match(card.keyword):
+            header.append(card)
+    return header
+
+
+def write_solved(src, dst, header):
+    """Copy the fitsfile ``src`` to ``dst`` with ``header`` as its primary
+    header; the data is copied byte for byte.
+    """
+    with fits.open(src) as hdul:
+        data_start = hdul.fileinfo(0)['datLoc']
+    with open(src, 'rb') as f, open(dst, 'wb') as out:
+        out.write(header.tostring().encode('ascii'))
+        f.seek(data_start)
+        shutil.copyfileobj(f, out)
+
+
+def reproject(sources, header):
+    """Recompute the sky positions of sextractor ``sources`` from their
+    pixel positions and the WCS in ``header``.
+    """
+    wcs = WCS(header)
+    ra, dec = wcs.all_pix2world(np.asarray(sources['X_IMAGE_DBL']),
+                                np.asarray(sources['Y_IMAGE_DBL']), 1)
+    sources = sources.copy()
+    for ra_col, dec_col in (("ALPHA_J2000", "DELTA_J2000"),
+                            ("X_WORLD", "Y_WORLD")):
+        if ra_col in sources.colnames:
+            sources[ra_col] = ra
+            sources[dec_col] = dec
+    return sources
+
 
 def flippsolve():
     """Console script entry-point for flipp."""
@@ -0,0 +1,153 @@
+# -*- coding:utf-8 -*-
+"""
+Fast positional crossmatching of source lists.
+
+Positions are turned into unit vectors once, so distances are chords in
+3-d and nothing special happens at RA = 0/360 or at the poles.  A
+:class:`Catalog` indexes them for nearest-neighbour and within-radius
+queries, with ``scipy.spatial.cKDTree`` when scipy is installed and with
+binary searches on a declination-sorted copy otherwise.  Either way a
+query of thousands of positions is vectorized, with none of the
+per-call overhead of ``SkyCoord.match_to_catalog_sky``.
+
+Example
+-------
+.. code-block::
+
+    from flipp.libs.crossmatch import Catalog
+
+    catalog = Catalog(apass["radeg"], apass["decdeg"])
+    idx, sep = catalog.nearest(ra, dec, max_sep=10. / 3600)
+    # idx is -1 where nothing is within 10"
+"""
+
+from __future__ import unicode_literals, division
+
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+
+def unit_vectors(ra, dec):
+    """(N, 3) unit vectors of ``ra``, ``dec`` in degrees."""
+    ra = np.radians(np.atleast_1d(np.asarray(ra, dtype=float)))
+    dec = np.radians(np.atleast_1d(np.asarray(dec, dtype=float)))
+    cosd = np.cos(dec)
+    return np.column_stack((cosd * np.cos(ra), cosd * np.sin(ra),
+                            np.sin(dec)))
+
+
+def to_chord(angle):
+    """Chord length of an ``angle`` in degrees, on the unit sphere."""
+    return 2. * np.sin(np.radians(np.minimum(angle, 180.)) / 2.)
+
+
+def to_angle(chord):
+    """Angle in degrees subtended by a ``chord`` of the unit sphere."""
+    return np.degrees(2. * np.arcsin(np.clip(chord / 2., 0., 1.)))
+
+
+def bounding_cone(ra, dec):
+    """(ra, dec, radius) in degrees of a cone around all the positions,
+    centred on their mean direction (so fields across RA = 0 come out
+    right).
+    """
+    xyz = unit_vectors(ra, dec)
+    centre = xyz.mean(axis=0)
+    centre /= np.sqrt((centre ** 2).sum())
+    ra_c = np.degrees(np.arctan2(centre[1], centre[0])) % 360.
+    dec_c = np.degrees(np.arcsin(np.clip(centre[2], -1., 1.)))
+    radius = to_angle(np.sqrt(((xyz - centre) ** 2).sum(axis=1)).max())
+    return float(ra_c), float(dec_c), float(radius)
+
+
+class Catalog(object):
+    """Positions ``ra``, ``dec`` (degrees) indexed for crossmatching."""
+
+    def __init__(self, ra, dec):
+        self.xyz = unit_vectors(ra, dec)
+        self._tree = None
+        self._sorted = None
+
+    def __len__(self):
+        return len(self.xyz)
+
+    @property
+    def tree(self):
+        """The KD-tree of the positions, built on first use."""
+        if self._tree is None:
+            self._tree = cKDTree(self.xyz)
+        return self._tree
+
+    def _by_z(self):
+        """Positions sorted by z (i.e. declination), for the fallback."""
+        if self._sorted is None:
+            order = np.argsort(self.xyz[:, 2], kind="mergesort")
+            self._sorted = order, self.xyz[order]
+        return self._sorted
+
+    def _candidates(self, xyz, chord):
+        """Index arrays of the positions within ``chord`` of each of
+        ``xyz``, without scipy: only the band of z within ``chord`` is
+        compared.
+        """
+        order, points = self._by_z()
+        lo = np.searchsorted(points[:, 2], xyz[:, 2] - chord, side="left")
+        hi = np.searchsorted(points[:, 2], xyz[:, 2] + chord, side="right")
+        out = []
+        for v, a, b in zip(xyz, lo, hi):
+            d = np.sqrt(((points[a:b] - v) ** 2).sum(axis=1))
+            out.append((order[a:b][d <= chord], d[d <= chord]))
+        return out
+
+    def nearest(self, ra, dec, max_sep=None):
+        """Nearest position to each of ``ra``, ``dec``.
+
+        Returns
+        -------
+        (idx, sep) : (numpy.ndarray, numpy.ndarray)
+            index into this catalog and separation in degrees; with
+            ``max_sep`` (degrees), idx is -1 and sep inf where nothing is
+            that close.
+        """
+        xyz = unit_vectors(ra, dec)
+        idx = np.full(len(xyz), -1, dtype=int)
+        sep = np.full(len(xyz), np.inf)
+        if not len(self) or not len(xyz):
+            return idx, sep
+        chord = np.inf if max_sep is None else to_chord(max_sep)
+        if cKDTree is not None:
+            d, i = self.tree.query(xyz, distance_upper_bound=chord)
+            found = np.isfinite(d)
+            idx[found], sep[found] = i[found], to_angle(d[found])
+        else:
+            if max_sep is None:
+                chord = 2.
+            for k, (i, d) in enumerate(self._candidates(xyz, chord)):
+                if len(i):
+                    best = np.argmin(d)
+                    idx[k], sep[k] = i[best], to_angle(d[best])
+        return idx, sep
+
+    def within(self, ra, dec, radius):
+        """Index arrays of the positions within ``radius`` degrees of each
+        of ``ra``, ``dec``.
+        """
+        xyz = unit_vectors(ra, dec)
+        if not len(self):
+            return [np.empty(0, dtype=int) for _ in xyz]
+        chord = to_chord(radius)
+        if cKDTree is not None:
+            return [np.asarray(sorted(i), dtype=int)
+                    for i in self.tree.query_ball_point(xyz, chord)]
+        return [np.sort(i) for i, _ in self._candidates(xyz, chord)]
+
+
+def match(ra1, dec1, ra2, dec2, max_sep):
+    """For each position 1, the index of the nearest position 2 within
+    ``max_sep`` degrees (or -1), and the separation in degrees.
+    """
+    return Catalog(ra2, dec2).nearest(ra1, dec1, max_sep)
@@ -0,0 +1,130 @@
+# -*- coding:utf-8 -*-
+"""
+Quick, in-process source detection.
+
+This does not replace sextractor for measuring sources; it answers "does
+this frame have stars in it at all?" in milliseconds, without a
+subprocess, a temp copy or a catalog to parse:
+
+1. The background and its RMS are estimated from the median and median
+   absolute deviation of ``box`` x ``box`` cells, each sub-sampled.
+2. Pixels more than ``nsigma`` RMS above the (cell-wise) background are
+   grouped into 8-connected components, with ``scipy.ndimage`` when it is
+   installed and a run-length union-find in numpy otherwise.
+3. Components of at least ``minarea`` pixels are counted as sources.
+
+Example
+-------
+.. code-block::
+
+    from astropy.io import fits
+    from flipp.libs.detect import count_sources
+
+    count_sources(fits.getdata("goodkait.fits"))
+"""
+
+from __future__ import unicode_literals, division
+
+import numpy as np
+
+try:
+    from scipy import ndimage
+except ImportError:
+    ndimage = None
+
+BOX = 64
+"""Background cell size, in pixels."""
+NSIGMA = 5.
+MINAREA = 3
+SUBSAMPLE = 4
+"""Only every SUBSAMPLE-th pixel of a cell goes into its statistics."""
+
+
+def _plane(data):
+    """The first 2-d image plane of ``data``, as floats."""
+    data = np.asarray(data)
+    if data.ndim > 2:
+        data = data.reshape((-1,) + data.shape[-2:])[0]
+    return data.astype(np.float32)
+
+
+def background(data, box=BOX):
+    """Background map (same shape as ``data``) and RMS of the image."""
+    data = _plane(data)
+    ny, nx = data.shape
+    by, bx = min(box, ny), min(box, nx)
+    gy, gx = ny // by, nx // bx
+    cells = data[:gy * by, :gx * bx].reshape(gy, by, gx, bx)
+    cells = cells.transpose(0, 2, 1, 3).reshape(gy, gx, by * bx)
+    cells = cells[:, :, ::SUBSAMPLE]
+    med = np.median(cells, axis=2)
+    mad = np.median(np.abs(cells - med[:, :, np.newaxis]), axis=2)
+    rms = 1.4826 * float(np.median(mad))
+    bkg = np.repeat(np.repeat(med, by, axis=0), bx, axis=1)
+    bkg = np.pad(bkg, ((0, ny - bkg.shape[0]), (0, nx - bkg.shape[1])),
+                 mode="edge")
+    return bkg, rms
+
+
+def _runs(mask):
+    """(row, start, end) of every horizontal run of True in ``mask``."""
+    ny, nx = mask.shape
+    padded = np.zeros((ny, nx + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    step = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(step == 1)
+    _, ends = np.nonzero(step == -1)  # Exclusive; same row-major order
+    return rows, starts, ends
+
+
+def _label_areas(mask):
+    """Pixel areas of the 8-connected components of ``mask``, found by
+    joining overlapping runs of neighbouring rows.
+    """
+    rows, starts, ends = _runs(mask)
+    n = len(rows)
+    parent = np.arange(n)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    first = np.searchsorted(rows, np.arange(mask.shape[0] + 1))
+    for r in range(1, mask.shape[0]):
+        i, i_end = first[r - 1], first[r]  # Runs of the row above
+        j, j_end = first[r], first[r + 1]
+        while i < i_end and j < j_end:
+            # Runs touch, diagonals included, if each starts no later
+            # than one pixel past the other's end.
+            if starts[i] <= ends[j] and starts[j] <= ends[i]:
+                a, b = find(i), find(j)
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+            if ends[i] < ends[j]:
+                i += 1
+            else:
+                j += 1
+    roots = np.array([find(k) for k in range(n)], dtype=int)
+    return np.bincount(roots, weights=ends - starts)[np.unique(roots)]
+
+
+def detect(data, nsigma=NSIGMA, minarea=MINAREA, box=BOX):
+    """Pixel areas of the sources in ``data``."""
+    data = _plane(data)
+    bkg, rms = background(data, box)
+    if not rms > 0:  # Constant (e.g. saturated or empty) frame
+        return np.zeros(0)
+    mask = data - bkg > nsigma * rms
+    if ndimage is not None:
+        labels, n = ndimage.label(mask, structure=np.ones((3, 3)))
+        areas = np.bincount(labels.ravel())[1:]
+    else:
+        areas = _label_areas(mask)
+    return areas[areas >= minarea]
+
+
+def count_sources(data, nsigma=NSIGMA, minarea=MINAREA, box=BOX):
+    """Number of sources detected in ``data``."""
+    return len(detect(data, nsigma, minarea, box))
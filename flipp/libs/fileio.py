@@ -3,20 +3,20 @@
 -Isaac, Feb. 5
 """
 
+import io
 import os
 import re
+import mmap
 import numpy as np
 import matplotlib.pyplot as plt
 
 import astropy
 from astropy.io import fits as pf
-from cStringIO import StringIO
 from matplotlib import cm
 from matplotlib.colors import LogNorm
-from subprocess import Popen, PIPE
-from fabric.api import local, hide
 
 
+from flipp.libs import lzw
 from flipp.conf import settings
 
 FIXTURE_DIR = settings.FIXTURE_DIR
@@ -24,6 +24,9 @@ FIXTURE_DIR = settings.FIXTURE_DIR
 def get_zipped_fitsfile(pathname):
     """Open a zipped fits file.
 
+    The file is decompressed in-process (see :mod:`flipp.libs.lzw`) into a
+    single buffer, which is opened in memory.
+
     Parameters
     ----------
     pathname : str
@@ -34,15 +37,95 @@ def get_zipped_fitsfile(pathname):
     hdu : astropy.io.fits.hdu.image.PrimaryHDU
         pyFits object
     """
-    with hide("everything"):
-        img = local("zcat {}".format(pathname), capture=True)
-    hdu = pf.open(StringIO(img))
+    with open(pathname, 'rb') as f:
+        buf = lzw.decompress_file(f)
+    hdu = pf.open(io.BytesIO(buf))
     # avoid some dumb bugs, not important
     hdu.verify('silentfix+ignore')
     return hdu
 
+BLOCK = 2880
+"""FITS files are written in blocks of this many bytes."""
+CARD = 80
+END_CARD = b"END" + b" " * (CARD - 3)
+
+
+def _find_end(buf, start=0):
+    """Offset just past the END card in ``buf``, or None if it is not
+    there yet.  Cards are only looked for from ``start``, a multiple of
+    the card length, so a growing buffer can be rescanned cheaply.
+    """
+    for pos in range(start, len(buf) - CARD + 1, CARD):
+        if buf[pos:pos + CARD] == END_CARD:
+            return pos + CARD
+    return None
+
+
+def read_header(pathname):
+    """Read only the primary header of a (possibly .Z compressed) fitsfile.
+
+    Plain files are memory-mapped and scanned for the END card, so no
+    pixel data is ever read.  Compressed files are decompressed just far
+    enough to reach the END card, and the rest of the stream is never
+    touched.
+
+    Parameters
+    ----------
+    pathname : str
+        filepath to fitsfile
+
+    Returns
+    -------
+    header : astropy.io.fits.Header
+    """
+    with open(pathname, 'rb') as f:
+        compressed = lzw.is_compressed(f.read(2))
+        f.seek(0)
+        if compressed:
+            buf = bytearray()
+            end = None
+            for piece in lzw.iter_decompress(f, chunk_size=BLOCK * 2):
+                scanned = len(buf) - len(buf) % CARD
+                buf += piece
+                end = _find_end(buf, scanned)
+                if end:
+                    break
+            head = bytes(buf[:end]) if end else None
+        else:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # Empty file
+                mm = None
+            head = None
+            if mm is not None:
+                try:
+                    end = _find_end(mm)
+                    if end:
+                        head = mm[:end]
+                finally:
+                    mm.close()
+    if head is None:
+        raise IOError("No FITS header found in {}".format(pathname))
+    header = pf.Header.fromstring(head)
+    # as get_zipped_fitsfile does: KAIT writes some unparsable cards
+    for card in header.cards:
+        card.verify('silentfix+ignore')
+    return header
+
+def open_image(pathname):
+    """Open a (possibly .Z compressed) fitsfile for reading, without
+    writing any copy of it.  Plain files are memory-mapped, unless their
+    data is scaled (BZERO/BSCALE, as in every 16-bit KAIT or Nickel frame),
+    which astropy then reads into memory.
+    """
+    with open(pathname, 'rb') as f:
+        compressed = lzw.is_compressed(f.read(2))
+    if compressed:
+        return get_zipped_fitsfile(pathname)
+    return pf.open(pathname)
+
 def get_head(pathname):
-    """Pull the header out of a fitsfile.
+    """Pull the header out of a fitsfile, without reading its data.
 
     Parameters
     ----------
@@ -51,15 +134,10 @@ def get_head(pathname):
 
     Returns
     -------
-    hdu : astropy.io.fits.hdu.image.PrimaryHDU
-        pyFits object
+    header : astropy.io.fits.Header
+        see :func:`read_header`
     """
-    try:
-        hdu = pf.open(pathname)
-    except IOError:
-        # probably a zcatted image
-        hdu = get_zipped_fitsfile(pathname)
-    return hdu[0].header
+    return read_header(pathname)
 
 exampleIm = os.path.join(FIXTURE_DIR, 'nickel', 'tfn150609.d206.sn2014c.V.fit')
 def plot_one_image(image=exampleIm, title=None, normalize='auto'):
@@ -122,8 +200,8 @@ def parse_insgenlog(pathname):
     """
     outd = {}
     if '.Z' in pathname:
-        p = Popen(["zcat", pathname], stdout=PIPE)
-        s = p.communicate()[0]
+        with open(pathname, 'rb') as f:
+            s = str(lzw.decompress_file(f))
     else:
         s = open(pathname,'r').read()
     for line in s.split('\n'):
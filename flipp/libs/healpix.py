@@ -0,0 +1,158 @@
+# -*- coding:utf-8 -*-
+"""
+HEALPix pixel numbers of sky positions, in numpy.
+
+Only what flipp needs: the base pixel ("face", 0-11) and the position
+(``x``, ``y``) within it of the pixel holding a given RA/Dec, at a
+power-of-two ``nside``, following Gorski et al. (2005) and the HEALPix C++
+library.  From those,
+
+- :func:`nested` gives the standard NESTED pixel number;
+- :func:`xy` gives astrometry.net's "xy" numbering, used for the tiles of
+  its index files (``index-5206-13.fits`` is tile 13 at the index's
+  ``HPNSIDE``);
+- :func:`cone_ranges` gives the ranges of NESTED pixel numbers covering a
+  cone, for range queries on a column of them.
+
+Example
+-------
+.. code-block::
+
+    from flipp.libs import healpix
+
+    healpix.nested(64, ra, dec)  # ra, dec in degrees; scalars or arrays
+"""
+
+from __future__ import unicode_literals, division
+
+import numpy as np
+
+
+def _check_nside(nside):
+    if nside < 1 or nside & (nside - 1):
+        raise ValueError("nside must be a power of 2, not {}".format(nside))
+
+
+def xyf(nside, ra, dec):
+    """(x, y, face) of the pixels holding ``ra``, ``dec`` (degrees)."""
+    _check_nside(nside)
+    ra = np.asarray(ra, dtype=float)
+    z = np.sin(np.radians(np.asarray(dec, dtype=float)))
+    ra, z = np.broadcast_arrays(ra, z)
+    za = np.abs(z)
+    tt = np.mod(np.radians(ra), 2 * np.pi) / (np.pi / 2)  # In [0, 4)
+    x = np.empty(z.shape, dtype=np.int64)
+    y = np.empty(z.shape, dtype=np.int64)
+    face = np.empty(z.shape, dtype=np.int64)
+
+    eq = za <= 2. / 3.
+    if eq.any():
+        t1 = nside * (0.5 + tt[eq])
+        t2 = nside * 0.75 * z[eq]
+        jp = (t1 - t2).astype(np.int64)  # Index of ascending edge line
+        jm = (t1 + t2).astype(np.int64)  # Index of descending edge line
+        ifp, ifm = jp // nside, jm // nside
+        face[eq] = np.where(ifp == ifm, ifp | 4,
+                            np.where(ifp < ifm, ifp, ifm + 8))
+        x[eq] = jm % nside
+        y[eq] = nside - jp % nside - 1
+
+    polar = ~eq
+    if polar.any():
+        ntt = np.minimum(tt[polar].astype(np.int64), 3)
+        tp = tt[polar] - ntt
+        tmp = nside * np.sqrt(3 * (1 - za[polar]))
+        jp = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+        jm = np.minimum(((1 - tp) * tmp).astype(np.int64), nside - 1)
+        north = z[polar] >= 0
+        face[polar] = np.where(north, ntt, ntt + 8)
+        x[polar] = np.where(north, nside - jm - 1, jp)
+        y[polar] = np.where(north, nside - jp - 1, jm)
+    return x, y, face
+
+
+def _spread(v):
+    """Interleave zeros between the bits of ``v``."""
+    v = np.asarray(v, dtype=np.int64)
+    out = np.zeros_like(v)
+    for bit in range(31):
+        out |= ((v >> bit) & 1) << (2 * bit)
+    return out
+
+
+def nested(nside, ra, dec):
+    """NESTED pixel numbers of ``ra``, ``dec`` (degrees) at ``nside``."""
+    x, y, face = xyf(nside, ra, dec)
+    return face * nside * nside + _spread(x) + (_spread(y) << 1)
+
+
+def xy(nside, ra, dec):
+    """astrometry.net's tile numbers of ``ra``, ``dec`` (degrees)."""
+    x, y, face = xyf(nside, ra, dec)
+    return (face * nside + x) * nside + y
+
+
+def disc_points(ra, dec, radius, n=36):
+    """Sample positions (the centre and two rings) covering a circle of
+    ``radius`` degrees around ``ra``, ``dec``, for finding the pixels it
+    touches when they are much larger than it.
+    """
+    angles = np.linspace(0., 2 * np.pi, n, endpoint=False)
+    r = np.concatenate([[0.], np.repeat([radius / 2., radius], n)])
+    a = np.concatenate([[0.], angles, angles])
+    d = np.clip(dec + r * np.sin(a), -90., 90.)
+    cosd = max(np.cos(np.radians(dec)), 1e-6)
+    return np.mod(ra + r * np.cos(a) / cosd, 360.), d
+
+
+def pixel_size(nside):
+    """Typical width of the pixels at ``nside``, in degrees."""
+    return np.degrees(np.sqrt(np.pi / 3.) / nside)
+
+
+def destination(ra, dec, distance, bearing):
+    """Positions ``distance`` degrees from ``ra``, ``dec`` towards
+    ``bearing`` (radians, east of north); exact at the poles too.
+    """
+    ra, dec, distance = (np.radians(np.asarray(v, dtype=float))
+                         for v in (ra, dec, distance))
+    sin_dec = (np.sin(dec) * np.cos(distance) +
+               np.cos(dec) * np.sin(distance) * np.cos(bearing))
+    dec2 = np.arcsin(np.clip(sin_dec, -1., 1.))
+    ra2 = ra + np.arctan2(np.sin(bearing) * np.sin(distance) * np.cos(dec),
+                          np.cos(distance) - np.sin(dec) * sin_dec)
+    return np.mod(np.degrees(ra2), 360.), np.degrees(dec2)
+
+
+def cone_ranges(nside, ra, dec, radius, n=72):
+    """Sorted ``(start, stop)`` ranges of the NESTED pixel numbers at
+    ``nside`` that cover the cone of ``radius`` degrees around ``ra``,
+    ``dec`` (with some to spare).
+
+    The cone is covered by the pixels of the coarsest level still at least
+    ``radius`` across, so there are at most a few ranges whatever its size;
+    they are found from positions sampled densely enough that each of those
+    pixels touching the cone holds one.
+    """
+    _check_nside(nside)
+    coarse = nside
+    while coarse > 1 and pixel_size(coarse) < radius:
+        coarse //= 2
+    step = pixel_size(coarse)
+    distances = np.minimum(
+        np.append(np.linspace(0., radius, 5)[1:], radius + step / 2.), 180.)
+    distance, bearing = np.meshgrid(
+        distances, np.linspace(0., 2 * np.pi, n, endpoint=False))
+    sample_ra, sample_dec = destination(ra, dec, distance.ravel(),
+                                        bearing.ravel())
+    pixels = np.unique(nested(coarse, np.append(sample_ra, ra),
+                              np.append(sample_dec, dec)))
+    scale = (nside // coarse) ** 2
+    ranges = []
+    for p in pixels:
+        start, stop = int(p) * scale, (int(p) + 1) * scale
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], stop)
+        else:
+            ranges.append((start, stop))
+    return ranges
@@ -0,0 +1,207 @@
+# -*- coding:utf-8 -*-
+"""
+Backend configs for solve-field that list only the index files a field
+can use.
+
+``settings.ASTROMETRYCONF`` typically ``autoindex``-es a whole directory of
+index files, all of which astrometry-engine opens (or scans, with
+``inparallel``) for every image, although flipp always passes the pointing
+and pixel scale.  Index files cover a range of quad sizes and, for the finer
+scales, one HEALPix tile of the sky (astrometry.net's ``HPNSIDE`` and
+``HEALPIX`` header cards, ``SCALE_L``/``SCALE_U`` in arcseconds), so only a
+handful can ever match a given field:
+
+- quads between a tenth of the shorter image side at the lowest pixel
+  scale and the image diagonal at the highest (solve-field's own limits);
+- tiles touched by the search circle plus half the field diagonal.
+
+:func:`backend_config` writes a copy of the base config listing just
+those, with ``inparallel`` when they fit comfortably in the available
+memory, under ``settings.CACHE_ROOT``.  Files are named after their
+contents, so every image of a field shares one.
+
+Example
+-------
+.. code-block::
+
+    path = backend_config(settings.ASTROMETRYCONF, 150.1, 2.2, 0.3,
+                          0.79, 0.80, 500, 500)
+"""
+
+from __future__ import unicode_literals, division
+
+import io
+import os
+import glob
+import hashlib
+
+import numpy as np
+
+from collections import namedtuple
+from tempfile import mkstemp
+
+from flipp.libs import healpix
+from flipp.libs.fileio import read_header
+from flipp.libs.utils import mkdir
+from flipp.conf import settings
+
+CACHE_ROOT = settings.CACHE_ROOT
+INPARALLEL_MEMORY = settings.ASTROMETRY_INPARALLEL_MEMORY
+
+IndexFile = namedtuple("IndexFile", ("path", "nside", "healpix",
+                                     "scale_low", "scale_high", "size"))
+"""An index file; ``healpix`` is None for all-sky indexes and the scales
+(arcsec) are None if the header does not say.
+"""
+
+_catalogs = {}  # Scanned index files, by config and directory mtimes
+_configs = {}  # (path, text) of generated configs, by what they load
+
+
+def read_config(path):
+    """(lines, index paths) of the backend config at ``path``; the index
+    paths are those its ``index`` and ``autoindex`` lines load.
+    """
+    with io.open(path, encoding="utf-8") as f:
+        lines = [l.rstrip("\n") for l in f]
+    dirs, names, auto = [], [], False
+    for line in lines:
+        words = line.split("#")[0].split()
+        if not words:
+            continue
+        if words[0] == "add_path" and len(words) > 1:
+            dirs.append(words[1])
+        elif words[0] == "index" and len(words) > 1:
+            names.append(words[1])
+        elif words[0] == "autoindex":
+            auto = True
+    paths = []
+    for name in names:
+        candidates = [name] if os.path.isabs(name) else \
+            [os.path.join(d, name) for d in dirs]
+        for c in candidates:
+            for p in (c, c + ".fits"):
+                if os.path.isfile(p):
+                    paths.append(p)
+                    break
+    if auto:
+        for d in dirs:
+            paths.extend(sorted(glob.glob(os.path.join(d, "*.fits"))))
+    seen = set()
+    return lines, [p for p in paths if not (p in seen or seen.add(p))]
+
+
+def _index_file(path):
+    try:
+        header = read_header(path)
+    except (IOError, OSError, ValueError):
+        return None
+    if "SCALE_U" not in header and "HEALPIX" not in header:
+        return None  # Not an index file
+    hp = header.get("HEALPIX", -1)
+    scale_low, scale_high = header.get("SCALE_L"), header.get("SCALE_U")
+    return IndexFile(path, int(header.get("HPNSIDE", 1)),
+                     int(hp) if hp is not None and hp >= 0 else None,
+                     float(scale_low) if scale_low is not None else None,
+                     float(scale_high) if scale_high is not None else None,
+                     os.path.getsize(path))
+
+
+def scan(config):
+    """Every index file the backend ``config`` loads, as :class:`IndexFile`.
+    Headers are only read again when a directory changes.
+    """
+    lines, paths = read_config(config)
+    key = (config, os.path.getmtime(config)) + tuple(
+        sorted((d, os.path.getmtime(d))
+               for d in set(os.path.dirname(p) for p in paths)))
+    if key not in _catalogs:
+        _catalogs[key] = [ix for ix in map(_index_file, paths)
+                          if ix is not None]
+    return _catalogs[key]
+
+
+def select(indexes, ra, dec, radius, scale_low, scale_high, width, height):
+    """The ``indexes`` that can solve a ``width`` x ``height`` image at
+    ``scale_low``-``scale_high`` arcsec/pixel within ``radius`` degrees of
+    ``ra``, ``dec``.
+    """
+    quad_low = 0.1 * min(width, height) * scale_low
+    quad_high = np.hypot(width, height) * scale_high
+    reach = radius + quad_high / 3600. / 2.
+    points = healpix.disc_points(ra, dec, reach)
+    tiles = {}
+    chosen = []
+    for ix in indexes:
+        if ix.scale_high is not None and (ix.scale_high < quad_low or
+                                          ix.scale_low > quad_high):
+            continue
+        if ix.healpix is not None:
+            if ix.nside not in tiles:
+                try:
+                    tiles[ix.nside] = set(healpix.xy(ix.nside, *points)
+                                          .tolist())
+                except ValueError:  # Not a power of 2; can't tell
+                    tiles[ix.nside] = None
+            if tiles[ix.nside] is not None and \
+                    ix.healpix not in tiles[ix.nside]:
+                continue
+        chosen.append(ix)
+    return chosen
+
+
+def available_memory():
+    """Bytes of memory available to new processes, or None if unknown."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def _write(path, text):
+    """Write ``text`` to ``path`` atomically; workers may race for it."""
+    fd, tmp = mkstemp(dir=os.path.dirname(path), prefix=".backend-")
+    with io.open(fd, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.rename(tmp, path)
+
+
+def backend_config(config, ra, dec, radius, scale_low, scale_high, width,
+                   height, cache_root=None):
+    """Path of a copy of the backend ``config`` that loads only the index
+    files :func:`select` picks, or ``config`` itself if it loads none that
+    could be told apart.
+    """
+    indexes = scan(config)
+    chosen = select(indexes, ra, dec, radius, scale_low, scale_high, width,
+                    height)
+    if not chosen or len(chosen) == len(indexes):
+        return config
+    memory = available_memory()
+    inparallel = bool(memory and INPARALLEL_MEMORY and
+                      sum(ix.size for ix in chosen) <=
+                      INPARALLEL_MEMORY * memory)
+    key = (config, tuple(ix.path for ix in chosen), inparallel)
+    if key not in _configs:
+        lines, _ = read_config(config)
+        keep = [l for l in lines if l.split("#")[0].split()[:1] not in
+                (["add_path"], ["autoindex"], ["index"], ["inparallel"])]
+        keep.append("# Indexes for this field only; written by flipp "
+                    "from {}".format(config))
+        if inparallel:
+            keep.append("inparallel")
+        keep.extend("index {}".format(ix.path) for ix in chosen)
+        text = "\n".join(keep) + "\n"
+        directory = os.path.join(cache_root or CACHE_ROOT, "astrometry")
+        mkdir(directory)
+        path = os.path.join(directory, "backend-{}.cfg".format(
+            hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]))
+        _configs[key] = path, text
+    path, text = _configs[key]
+    if not os.path.exists(path):
+        _write(path, text)
+    return path
@@ -0,0 +1,323 @@
+# -*- coding:utf-8 -*-
+"""
+On-disk cache of the APASS catalog, in fixed tiles of sky.
+
+Zeropointing asks AAVSO for the stars around every image, although KAIT and
+Nickel observe the same fields over and over.  :class:`TileCache` instead
+splits the sky into fixed tiles -- declination bands ``TILE`` degrees high,
+cut into cells about ``TILE`` degrees wide -- and answers a cone query from
+the tiles it overlaps, fetching only those it does not have yet (one cone
+query per tile).  Once a field's tiles are cached, zeropointing it needs no
+network at all.
+
+Tiles are stored as ``.npy`` files of a structured array, sorted by
+declination, under ``settings.CACHE_ROOT``/apass, with an SQLite index of
+when each was fetched and last used:
+
+- tiles older than ``max_age`` seconds are fetched again (the stale copy
+  is still used if the service can't be reached);
+- when the tiles add up to more than ``max_bytes``, the least recently
+  used ones are deleted.
+
+Example
+-------
+.. code-block::
+
+    from flipp.libs.refcache import TileCache
+
+    stars = TileCache().cone(150.1, 2.2, 0.1)  # numpy structured array
+"""
+
+from __future__ import unicode_literals, division
+
+import os
+import time
+import sqlite3
+
+import numpy as np
+
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from tempfile import mkstemp
+
+from flipp.libs.utils import mkdir
+from flipp.conf import settings
+
+CACHE_ROOT = settings.CACHE_ROOT
+TILE = settings.APASS_TILE_SIZE
+MAX_BYTES = settings.APASS_CACHE_MAX_BYTES
+MAX_AGE = settings.APASS_CACHE_MAX_AGE
+
+COLUMNS = ("radeg", "raerr", "decdeg", "decerr", "Number_of_Obs",
+           "Johnson_V", "Verr", "Johnson_B", "Berr", "Sloan_g", "gerr",
+           "Sloan_r", "rerr", "Sloan_i", "ierr")
+"""The APASS columns kept; missing values are NaN."""
+DTYPE = np.dtype([(str(c), np.float64) for c in COLUMNS])
+
+
+def separation(ra1, dec1, ra2, dec2):
+    """Angular distance(s) in degrees (haversine)."""
+    ra1, dec1, ra2, dec2 = (np.radians(x) for x in (ra1, dec1, ra2, dec2))
+    h = (np.sin((dec2 - dec1) / 2) ** 2 +
+         np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2) ** 2)
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(h, 0., 1.))))
+
+
+def _cells(band, size=TILE):
+    """Number of RA cells in declination ``band``; cells are ``size``
+    degrees wide (or less) along its edge nearest the equator.
+    """
+    lo, hi = -90. + band * size, -90. + (band + 1) * size
+    nearest = 0. if lo < 0. < hi else min(abs(lo), abs(hi))
+    return max(1, int(360. * np.cos(np.radians(nearest)) / size))
+
+
+def tile_of(ra, dec, size=TILE):
+    """(band, cell) of the tile holding ``ra``, ``dec``."""
+    band = min(int((dec + 90.) // size), int(np.ceil(180. / size)) - 1)
+    n = _cells(band, size)
+    return band, min(int((ra % 360.) / (360. / n)), n - 1)
+
+
+def tile_bounds(tile, size=TILE):
+    """(ra_lo, ra_hi, dec_lo, dec_hi) of ``tile``."""
+    band, cell = tile
+    width = 360. / _cells(band, size)
+    dec_lo = -90. + band * size
+    return cell * width, (cell + 1) * width, dec_lo, min(dec_lo + size, 90.)
+
+
+def tile_cone(tile, size=TILE):
+    """(ra, dec, radius) of a cone containing all of ``tile``."""
+    ra_lo, ra_hi, dec_lo, dec_hi = tile_bounds(tile, size)
+    ra, dec = (ra_lo + ra_hi) / 2., (dec_lo + dec_hi) / 2.
+    edge_ra = np.array([ra_lo, ra_hi, ra_lo, ra_hi, ra, ra, ra_lo, ra_hi])
+    edge_dec = np.array([dec_lo, dec_lo, dec_hi, dec_hi, dec_lo, dec_hi,
+                         dec, dec])
+    return ra, dec, float(separation(ra, dec, edge_ra, edge_dec).max())
+
+
+def tiles_for_cone(ra, dec, radius, size=TILE):
+    """Every tile that overlaps the cone."""
+    if abs(dec) + radius >= 90.:  # Around a pole: every RA
+        span = None
+    else:  # Half the RA range of the cone, exactly
+        span = np.degrees(np.arcsin(min(1., np.sin(np.radians(radius)) /
+                                        np.cos(np.radians(dec)))))
+    tiles = []
+    first_band = tile_of(0., max(dec - radius, -90.), size)[0]
+    last_band = tile_of(0., min(dec + radius, 90.), size)[0]
+    for band in range(first_band, last_band + 1):
+        n = _cells(band, size)
+        if span is None:
+            tiles.extend((band, c) for c in range(n))
+            continue
+        width = 360. / n
+        lo = int(np.floor((ra - span) / width))
+        hi = int(np.floor((ra + span) / width))
+        tiles.extend((band, c % n) for c in range(lo, min(hi, lo + n - 1) + 1))
+    return sorted(set(tiles))
+
+
+def fetch_apass(ra, dec, radius):
+    """APASS stars within ``radius`` degrees, from the AAVSO service, as a
+    structured array of :data:`COLUMNS`.
+    """
+    from flipp.libs.apass import Client
+    return as_records(Client.query(ra, dec, radius))
+
+
+def as_records(table):
+    """The :data:`COLUMNS` of an APASS ``table`` as a structured array."""
+    out = np.empty(len(table), dtype=DTYPE)
+    for c in COLUMNS:
+        if c in table.colnames:
+            out[c] = np.ma.filled(np.ma.asarray(table[c], dtype=float),
+                                  np.nan)
+        else:
+            out[c] = np.nan
+    return out
+
+
+class TileCache(object):
+    """Cone queries of a reference catalog, served from cached tiles.
+
+    Parameters
+    ----------
+    root : str, optional
+        Directory of the tiles and their index (``CACHE_ROOT``/apass).
+    fetch : callable, optional
+        ``fetch(ra, dec, radius)`` returning a structured array with
+        ``radeg`` and ``decdeg`` columns; defaults to the APASS service.
+    max_bytes, max_age : optional
+        Eviction size and staleness limits, defaulting to
+        ``APASS_CACHE_MAX_BYTES`` and ``APASS_CACHE_MAX_AGE``.
+    """
+
+    def __init__(self, root=None, fetch=None, max_bytes=None, max_age=None,
+                 size=TILE):
+        self.root = root or os.path.join(CACHE_ROOT, "apass")
+        self.fetch = fetch or fetch_apass
+        self.max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+        self.max_age = MAX_AGE if max_age is None else max_age
+        self.size = size
+        self.fetched = 0  # Tiles fetched by this instance
+        mkdir(self.root)
+        with self._index() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS tiles ("
+                       "band INTEGER, cell INTEGER, path TEXT, "
+                       "nbytes INTEGER, fetched REAL, used REAL, "
+                       "PRIMARY KEY (band, cell))")
+
+    @contextmanager
+    def _index(self):
+        """Connection to the tile index; commits and closes on exit."""
+        db = sqlite3.connect(os.path.join(self.root, "index.sqlite"),
+                             timeout=60)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            yield db
+            db.commit()
+        finally:
+            db.close()
+
+    def _path(self, tile):
+        return os.path.join(self.root, "{:03d}".format(tile[0]),
+                            "{:03d}-{:04d}.npy".format(*tile))
+
+    def _fetch(self, tile):
+        """Download ``tile``, keeping only its own stars, and save it.
+        Returns the stars and the tile's index row.
+        """
+        ra, dec, radius = tile_cone(tile, self.size)
+        stars = self.fetch(ra, dec, radius)
+        ra_lo, ra_hi, dec_lo, dec_hi = tile_bounds(tile, self.size)
+        inside = ((stars["decdeg"] >= dec_lo) & (stars["decdeg"] < dec_hi) &
+                  (stars["radeg"] % 360. >= ra_lo) &
+                  (stars["radeg"] % 360. < ra_hi))
+        if dec_hi >= 90.:
+            inside |= stars["decdeg"] >= 90.
+        stars = np.sort(np.asarray(stars[inside], dtype=DTYPE),
+                        order=str("decdeg"))
+        path = self._path(tile)
+        mkdir(os.path.dirname(path))
+        fd, tmp = mkstemp(dir=os.path.dirname(path), suffix=".npy")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, stars)
+        os.rename(tmp, path)  # Other workers may be reading the old one
+        now = time.time()
+        return stars, tile + (path, os.path.getsize(path), now, now)
+
+    def _known(self, tiles):
+        """{tile: (path, fetched)} of those of ``tiles`` on disk."""
+        known = {}
+        with self._index() as db:
+            for tile in tiles:
+                row = db.execute("SELECT path, fetched FROM tiles WHERE "
+                                 "band=? AND cell=?", tile).fetchone()
+                if row is not None and os.path.exists(row[0]):
+                    known[tile] = row
+        return known
+
+    def _due(self, row, now):
+        """Whether a tile with index ``row`` (or None) needs fetching."""
+        return row is None or bool(self.max_age and
+                                   now - row[1] > self.max_age)
+
+    def _record(self, fetched=(), used=()):
+        """Index the ``fetched`` rows and mark the ``used`` tiles used."""
+        now = time.time()
+        with self._index() as db:
+            db.executemany("INSERT OR REPLACE INTO tiles VALUES "
+                           "(?, ?, ?, ?, ?, ?)", fetched)
+            db.executemany("UPDATE tiles SET used=? WHERE band=? AND cell=?",
+                           [(now,) + tuple(tile) for tile in used])
+        self.fetched += len(fetched)
+        if fetched:
+            self.evict()
+
+    def tiles(self, ra, dec, radius):
+        """The arrays of the tiles overlapping the cone, fetching those
+        that are missing or stale.  The index is not locked while fetching.
+        """
+        now = time.time()
+        wanted = tiles_for_cone(ra, dec, radius, self.size)
+        known = self._known(wanted)
+        out, fetched, used = [], [], []
+        for tile in wanted:
+            row = known.get(tile)
+            stars = None
+            if self._due(row, now):
+                try:
+                    stars, index_row = self._fetch(tile)
+                except (IOError, AssertionError):
+                    if row is None:
+                        raise
+                    # Stale beats nothing
+                else:
+                    fetched.append(index_row)
+            if stars is None:
+                try:
+                    stars = np.load(row[0])
+                except (IOError, OSError):  # Evicted by another process
+                    stars, index_row = self._fetch(tile)
+                    fetched.append(index_row)
+                else:
+                    used.append(tile)
+            out.append(stars)
+        self._record(fetched, used)
+        return out
+
+    def prefetch(self, tiles, jobs=1):
+        """Fetch those of ``tiles`` that are missing or stale, ``jobs`` at
+        a time.  Returns the number fetched and the number that failed.
+        """
+        now = time.time()
+        tiles = sorted(set(tiles))
+        known = self._known(tiles)
+        todo = [t for t in tiles if self._due(known.get(t), now)]
+
+        def fetch(tile):
+            try:
+                return self._fetch(tile)[1]
+            except (IOError, AssertionError):
+                return None
+
+        pool = ThreadPool(max(1, min(jobs, len(todo))))
+        try:
+            rows = [r for r in pool.map(fetch, todo) if r is not None]
+        finally:
+            pool.close()
+            pool.join()
+        self._record(rows)
+        return len(rows), len(todo) - len(rows)
+
+    def cone(self, ra, dec, radius):
+        """Catalog stars within ``radius`` degrees of ``ra``, ``dec``."""
+        parts = []
+        for stars in self.tiles(ra, dec, radius):
+            d = stars["decdeg"]
+            lo, hi = np.searchsorted(d, [dec - radius, dec + radius])
+            near = stars[lo:hi]
+            near = near[separation(ra, dec, near["radeg"], near["decdeg"])
+                        <= radius]
+            parts.append(np.asarray(near))
+        return np.concatenate(parts) if parts else np.empty(0, DTYPE)
+
+    def evict(self):
+        """Delete least recently used tiles until they fit ``max_bytes``."""
+        if not self.max_bytes:
+            return
+        with self._index() as db:
+            rows = db.execute("SELECT band, cell, path, nbytes FROM tiles "
+                              "ORDER BY used DESC").fetchall()
+            total = 0
+            for band, cell, path, nbytes in rows:
+                total += nbytes
+                if total > self.max_bytes:
+                    db.execute("DELETE FROM tiles WHERE band=? AND cell=?",
+                               (band, cell))
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
@@ -0,0 +1,247 @@
+# -*- coding:utf-8 -*-
+"""
+Reference catalogs for zeropointing, behind one interface.
+
+Every backend answers ``cone(ra, dec, radius)`` (degrees) with a numpy
+structured array of :data:`flipp.libs.refcache.COLUMNS`, missing values
+NaN.  ``settings.REFCAT`` picks the one :func:`get_catalog` returns:
+
+``"service"``
+    :class:`APASSService` asks the AAVSO web service every time.
+``"cache"``
+    :class:`flipp.libs.refcache.TileCache` keeps what it fetches in tiles
+    under ``CACHE_ROOT``.
+``"offline"``
+    :class:`OfflineCatalog` reads a local dump at ``REFCAT_PATH`` and never
+    touches the network, for processing nodes without one.
+
+Offline catalogs are built from the CSV files of an APASS (or similar)
+dump by :func:`build_catalog` (``flipp build-catalog``).  The stars are cut
+into declination zones ``zone_height`` degrees high and sorted by RA
+within each; every column is a ``.npy`` file, memory-mapped when read, and
+``zones.npy`` holds the row each zone starts at.  A cone query is a binary
+search on RA in the few zones the cone crosses, a slice and a distance cut,
+so only the pages holding those stars are ever read.
+
+Example
+-------
+.. code-block::
+
+    from flipp.libs.refcat import get_catalog
+
+    stars = get_catalog().cone(150.1, 2.2, 0.1)
+"""
+
+from __future__ import unicode_literals, division
+
+import io
+import os
+import json
+import shutil
+
+import numpy as np
+
+from flipp.libs.refcache import COLUMNS, DTYPE, TileCache, as_records, \
+    separation
+from flipp.libs.utils import mkdir
+from flipp.conf import settings
+
+REFCAT = settings.REFCAT
+REFCAT_PATH = settings.REFCAT_PATH
+
+ZONE_HEIGHT = 0.25
+"""Default height of the declination zones of an offline catalog."""
+
+STORAGE = np.dtype([(str(c), np.float64 if c in ("radeg", "decdeg")
+                     else np.float32) for c in COLUMNS])
+"""On-disk types of the offline catalog columns; float32 is plenty for
+magnitudes and their errors.
+"""
+
+
+class APASSService(object):
+    """The AAVSO APASS web service (:class:`flipp.libs.apass.Client`)."""
+
+    def cone(self, ra, dec, radius):
+        from flipp.libs.apass import Client
+        return as_records(Client.query(ra, dec, radius))
+
+
+class OfflineCatalog(object):
+    """A catalog built by :func:`build_catalog` in the directory ``root``."""
+
+    def __init__(self, root):
+        self.root = root
+        with io.open(os.path.join(root, "catalog.json")) as f:
+            self.meta = json.load(f)
+        self.zone_height = self.meta["zone_height"]
+        self.zones = np.load(os.path.join(root, "zones.npy"))
+        self.columns = {}
+        if self.meta["count"]:  # Empty arrays can't be memory-mapped
+            self.columns = {c: np.load(os.path.join(root, c + ".npy"),
+                                       mmap_mode="r")
+                            for c in self.meta["columns"]}
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def _ranges(self, ra, dec, radius):
+        """(start, stop) rows of every star in the RA/dec box around the
+        cone.
+        """
+        n_zones = len(self.zones) - 1
+        first = max(0, int((dec - radius + 90.) // self.zone_height))
+        last = min(n_zones - 1, int((dec + radius + 90.) // self.zone_height))
+        if abs(dec) + radius >= 90.:  # Around a pole: every RA
+            spans = [(0., 360.)]
+        else:
+            half = np.degrees(np.arcsin(min(1., np.sin(np.radians(radius)) /
+                                            np.cos(np.radians(dec)))))
+            lo, hi = (ra - half) % 360., (ra + half) % 360.
+            spans = [(lo, hi)] if lo <= hi else [(0., hi), (lo, 360.)]
+        ranges = []
+        ra_column = self.columns["radeg"]
+        for zone in range(first, last + 1):
+            start, stop = self.zones[zone], self.zones[zone + 1]
+            if start == stop:
+                continue
+            zone_ra = ra_column[start:stop]
+            for lo, hi in spans:
+                a = np.searchsorted(zone_ra, lo, side="left")
+                b = np.searchsorted(zone_ra, hi, side="right")
+                if a < b:
+                    ranges.append((start + a, start + b))
+        return ranges
+
+    def cone(self, ra, dec, radius):
+        """Catalog stars within ``radius`` degrees of ``ra``, ``dec``."""
+        ranges = self._ranges(ra, dec, radius) if len(self) else []
+        if not ranges:
+            return np.empty(0, DTYPE)
+        rows = np.concatenate([np.arange(a, b) for a, b in ranges])
+        near = separation(ra, dec, self.columns["radeg"][rows],
+                          self.columns["decdeg"][rows]) <= radius
+        rows = rows[near]
+        out = np.empty(len(rows), DTYPE)
+        for c in COLUMNS:
+            if c in self.columns:
+                out[c] = self.columns[c][rows]
+            else:
+                out[c] = np.nan
+        return out
+
+
+def read_csv(path, chunk_rows=1000000):
+    """Structured arrays of :data:`STORAGE`, ``chunk_rows`` at a time, from
+    an APASS CSV file; "NA" and empty values become NaN.
+    """
+    with io.open(path, "rb") as f:
+        names = [n.strip().decode("ascii")
+                 for n in f.readline().split(b",")]
+        lines = []
+        for line in f:
+            lines.append(line)
+            if len(lines) == chunk_rows:
+                yield _parse_rows(lines, names)
+                lines = []
+        if lines:
+            yield _parse_rows(lines, names)
+
+
+def _parse_rows(lines, names):
+    values = np.genfromtxt(lines, delimiter=b",", dtype=np.float64,
+                           missing_values=b"NA", filling_values=np.nan,
+                           invalid_raise=False).reshape(-1, len(names))
+    out = np.empty(len(values), STORAGE)
+    for c in COLUMNS:
+        out[c] = values[:, names.index(c)] if c in names else np.nan
+    return out
+
+
+def build_catalog(chunks, root, zone_height=ZONE_HEIGHT):
+    """Write the stars in ``chunks`` (structured arrays with
+    :data:`COLUMNS`, e.g. from :func:`read_csv`) as an offline catalog in
+    ``root``.  Only one zone is ever held in memory, so whole-sky dumps can
+    be converted.  Returns the number of stars.
+    """
+    n_zones = int(np.ceil(180. / zone_height))
+    scratch = os.path.join(root, "zones.tmp")
+    # Whatever an earlier, interrupted build left behind is started over
+    for name in ("catalog.json", "zones.npy"):
+        if os.path.exists(os.path.join(root, name)):
+            os.remove(os.path.join(root, name))
+    if os.path.exists(scratch):
+        shutil.rmtree(scratch)
+    mkdir(scratch)
+    counts = np.zeros(n_zones, dtype=np.int64)
+
+    def zone_path(z):
+        return os.path.join(scratch, "{:05d}".format(z))
+
+    # Pass 1: spread the stars over one scratch file per zone
+    for chunk in chunks:
+        stars = np.empty(len(chunk), STORAGE)
+        for c in COLUMNS:
+            stars[c] = chunk[c] if c in chunk.dtype.names else np.nan
+        stars = stars[np.isfinite(stars["radeg"]) &
+                      np.isfinite(stars["decdeg"])]
+        stars["radeg"] %= 360.
+        zone = np.clip(((stars["decdeg"] + 90.) // zone_height).astype(int),
+                       0, n_zones - 1)
+        order = np.argsort(zone, kind="mergesort")
+        stars, zone = stars[order], zone[order]
+        bounds = np.searchsorted(zone, np.arange(n_zones + 1))
+        for z in np.unique(zone):
+            with open(zone_path(z), "ab") as f:
+                stars[bounds[z]:bounds[z + 1]].tofile(f)
+        counts += np.diff(bounds)
+
+    # Pass 2: sort each zone by RA into the column files
+    zones = np.concatenate([[0], np.cumsum(counts)])
+    total = int(zones[-1])
+    columns = {}
+    if total:
+        columns = {c: np.lib.format.open_memmap(
+            os.path.join(root, c + ".npy"), mode="w+",
+            dtype=STORAGE[str(c)], shape=(total,)) for c in COLUMNS}
+    for z in np.flatnonzero(counts):
+        stars = np.fromfile(zone_path(z), dtype=STORAGE)
+        stars = stars[np.argsort(stars["radeg"], kind="mergesort")]
+        for c in COLUMNS:
+            columns[c][zones[z]:zones[z + 1]] = stars[c]
+    for column in columns.values():
+        column.flush()
+    del columns
+    shutil.rmtree(scratch)
+
+    np.save(os.path.join(root, "zones.npy"), zones)
+    # Written last: a catalog without it was not finished
+    with io.open(os.path.join(root, "catalog.json"), "w") as f:
+        f.write(unicode(json.dumps({"zone_height": zone_height,
+                                    "count": total,
+                                    "columns": list(COLUMNS)})))
+    return total
+
+
+_catalogs = {}
+
+
+def get_catalog(name=None, path=None):
+    """The reference catalog named by ``REFCAT`` (or ``name``), opened once
+    per process.
+    """
+    name = name or REFCAT
+    path = path or REFCAT_PATH
+    key = (name, path)
+    if key not in _catalogs:
+        if name == "service":
+            _catalogs[key] = APASSService()
+        elif name == "cache":
+            _catalogs[key] = TileCache()
+        elif name == "offline":
+            if not path:
+                raise ValueError("REFCAT 'offline' needs REFCAT_PATH")
+            _catalogs[key] = OfflineCatalog(path)
+        else:
+            raise ValueError("Unknown REFCAT: {}".format(name))
+    return _catalogs[key]
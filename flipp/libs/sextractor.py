@@ -6,18 +6,20 @@ import warnings
 import numpy as np
 import matplotlib.pyplot as plt
 
-from tempfile import mkstemp
-
+from astropy.io import fits
 from astropy.io.fits import hdu
 from astropy.table import Table
 
 from flipp.libs.fileio import plot_one_image
 from flipp.libs.utils import shMixin, FitsIOMixin
+from flipp.libs.workspace import Workspace
 from flipp.conf import settings
 
 
 SEXCONFPATH = settings.SEXCONFPATH
 SEXTRACTORPATH = settings.SEXTRACTORPATH
+CATALOG_TYPE = settings.SEXTRACTOR_CATALOG_TYPE
+PARAMETERS = settings.SEXTRACTOR_PARAMETERS
 # ================
 # DEVELOPMENT NOTE
 # ================
@@ -38,12 +40,41 @@ SEXTRACTOR_VALUE_RE = re.compile("\S*(?=\s)")
 SEXTRACTOR_SECTION_RE = re.compile("\#(\-+)(\w|\s)+")
 
 
+def check_image_bytes(header, n=1):
+    """Size on disk of ``n`` check images (float32) of the image with this
+    header.
+    """
+    pixels = header.get("NAXIS1", 0) * header.get("NAXIS2", 0)
+    data = pixels * 4
+    blocks = 1 + (data + 2879) // 2880  # One header block, plus the data
+    return n * blocks * 2880
+
+
+def read_catalog(path, catalog_type=CATALOG_TYPE):
+    """Read a sextractor catalog written as ``catalog_type``.
+
+    FITS catalogs (FITS_LDAC, FITS_1.0) are memory-mapped and copied into
+    the returned table, which stays valid after the file is removed.
+    """
+    if catalog_type.upper().startswith("FITS"):
+        with fits.open(path, memmap=True) as hdul:
+            try:
+                ext = hdul.index_of("LDAC_OBJECTS")
+            except KeyError:  # Plain FITS_1.0 table
+                ext = 1
+            return Table(hdul[ext].data)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return Table.read(path, format="ascii.sextractor")
+
+
 class Sextractor(shMixin, FitsIOMixin):
     """Sextractor wrapper with config built in."""
 
     cmd = SEXTRACTORPATH
 
-    def __init__(self, fp_or_buffer, telescope=None):
+    def __init__(self, fp_or_buffer, telescope=None, workspace=None,
+                 check_images=False):
         """Runs source extractor on a single fits file/image.
 
         Parameters
@@ -52,8 +83,21 @@ class Sextractor(shMixin, FitsIOMixin):
             filepath to image or astropy fits image
         telescope_config : str
             'kait', 'nickel' or user specified config
+        workspace : flipp.libs.workspace.Workspace, optional
+            where to write the catalog and check images; by default a
+            workspace of our own, removed by ``_gc``
+        check_images : bool
+            also write the OBJECTS and BACKGROUND check images
+            (``chk_objects``, ``chk_bkgrnd``); otherwise none are written,
+            and ``check_bytes_avoided`` tells how much that saved
         """
-        self.name, self.path, self.image = self._parse_input(fp_or_buffer)
+        self.check_images = check_images
+        self.chk_objects = self.chk_bkgrnd = None
+        self.check_bytes_avoided = 0
+        self.owns_workspace = workspace is None
+        self.workspace = workspace or Workspace(prefix="SEX-")
+        self.name, self.path, self.image = self._parse_input(
+            fp_or_buffer, workspace=self.workspace)
         self.telescope = telescope or self.get_telescope(self.image[0].header)
         telescope_config = self._parse_telescope_config(self.telescope,
                                                         "SEXTRACTOR_OPTIONS")
@@ -83,23 +127,38 @@ class Sextractor(shMixin, FitsIOMixin):
     @defaults.setter
     def defaults(self, value):
         defaults = {
-                    "CHECKIMAGE_TYPE": "OBJECTS,BACKGROUND",  # Objects
+                    "CATALOG_TYPE": CATALOG_TYPE,
+                    "CHECKIMAGE_TYPE": ("OBJECTS,BACKGROUND"
+                                        if self.check_images else "NONE"),
                     "FILTER_NAME": default_filter,
-                    "PARAMETERS_NAME": default_param,
                     "STARNNW_NAME": default_nnw,
                     "c": default_sex,
                     }
         defaults.update(value)
+        ws = self.workspace
+        if "PARAMETERS_NAME" not in defaults:
+            defaults.update(PARAMETERS_NAME = self._write_params(PARAMETERS)
+                            if PARAMETERS else default_param)
         if "CATALOG_NAME" not in defaults:
-            defaults.update(CATALOG_NAME = mkstemp(suffix=".txt", prefix="CATALOG_")[1])
-        if "CHECKIMAGE_NAME" not in defaults:
+            suffix = (".fits" if defaults["CATALOG_TYPE"].startswith("FITS")
+                      else ".txt")
+            defaults.update(CATALOG_NAME = ws.file(suffix=suffix, prefix="CATALOG_"))
+        if "CHECKIMAGE_NAME" not in defaults and self.check_images:
             defaults.update({
                 "CHECKIMAGE_NAME": "%s,%s" % (
-                    mkstemp(suffix=".fits", prefix="CHECK-OBJECTS_")[1],
-                    mkstemp(suffix=".fits", prefix="CHECK-BKGRND_")[1])})
+                    ws.file(suffix=".fits", prefix="CHECK-OBJECTS_"),
+                    ws.file(suffix=".fits", prefix="CHECK-BKGRND_"))})
 
         self._defaults = defaults
 
+    def _write_params(self, params):
+        """A PARAMETERS_NAME file asking for just ``params``."""
+        path = self.workspace.file(suffix=".param", prefix="PARAMS_")
+        with open(path, "w") as f:
+            f.write("\n".join(params) + "\n")
+        self.params_file = path
+        return path
+
     def _extract(self, flag_filter=True, *args, **kwargs):
         """Run source-extractor (sextractor) on the given image.
         If flag_filter == True, return only sources with FLAGS == 0
@@ -114,19 +173,21 @@ class Sextractor(shMixin, FitsIOMixin):
         output = self.sh(self.path, *args, **options)
         # ===========================================================
         # Keep track of the check images and outputs
-        chk_imgs = options.get("CHECKIMAGE_NAME").split(",")
-        for c in chk_imgs:
-            if 'OBJECTS' in c:
-                self.chk_objects = c
-            elif 'BKGRND' in c:
-                self.chk_bkgrnd = c
+        if options.get("CHECKIMAGE_TYPE", "NONE") == "NONE":
+            self.check_bytes_avoided += check_image_bytes(
+                self.image[0].header, 2)
+        else:
+            chk_imgs = options.get("CHECKIMAGE_NAME").split(",")
+            for c in chk_imgs:
+                if 'OBJECTS' in c:
+                    self.chk_objects = c
+                elif 'BKGRND' in c:
+                    self.chk_bkgrnd = c
         self.catalog_file = options.get("CATALOG_NAME")
         # ===========================================================
 
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore')
-            catalog = Table.read(options.get("CATALOG_NAME"),
-                                 format="ascii.sextractor")
+        catalog = read_catalog(options.get("CATALOG_NAME"),
+                               options.get("CATALOG_TYPE"))
 
         if flag_filter:
             catalog = catalog[catalog['FLAGS'] == 0]
@@ -135,9 +196,15 @@ class Sextractor(shMixin, FitsIOMixin):
     def _gc(self):
         """Removes Check-images and other to-disk outputs.
         """
-        to_remove = [self.chk_objects, self.chk_bkgrnd, self.catalog_file, self.path]
+        if self.owns_workspace:  # Everything we wrote is in there
+            self.workspace.cleanup()
+            return
+        to_remove = [self.chk_objects, self.chk_bkgrnd, self.catalog_file,
+                     getattr(self, "params_file", "")]
+        if self.owns_path:  # Never the caller's image
+            to_remove.append(self.path)
         for f in to_remove:
-            if os.path.exists(f):
+            if f and os.path.exists(f):
                 os.remove(f)
 
     def extract(self, clean_checkfiles=True, flag_filter=True, *args, **kwargs):
@@ -1,3 +1,63 @@
 # -*- coding:utf-8 -*-
 
 from unittest import TestCase
+
+import numpy as np
+
+from astropy.io import fits
+from astropy.table import Table
+
+from flipp.libs.astrometry import update_wcs, reproject
+
+
+def _solution(crval=(150., 20.), crpix=(50.5, 50.5), scale=0.8 / 3600):
+    header = fits.Header()
+    header["SIMPLE"] = True
+    header["BITPIX"] = 8
+    header["NAXIS"] = 0
+    header["CTYPE1"] = "RA---TAN"
+    header["CTYPE2"] = "DEC--TAN"
+    header["CRVAL1"], header["CRVAL2"] = crval
+    header["CRPIX1"], header["CRPIX2"] = crpix
+    header["CD1_1"], header["CD1_2"] = -scale, 0.
+    header["CD2_1"], header["CD2_2"] = 0., scale
+    header["DATE"] = "2016-01-21T10:00:00"  # Not part of the WCS
+    header["COMMENT"] = "Original key: \"NAXIS\""
+    return header
+
+
+class TestSolution(TestCase):
+    """Applying a solve-field solution to an image's header and catalog."""
+
+    def test_update_wcs(self):
+        image = fits.Header()
+        image["NAXIS"] = 2
+        image["OBJECT"] = "sn2014c"
+        image["CDELT1"] = 1.  # Stale WCS from the telescope
+        image["CRVAL1"] = 10.
+        image["DATE"] = "2015-06-09T09:52:10"
+        image["COMMENT"] = "Original key: \"NAXIS\""
+        header = update_wcs(image, _solution())
+        self.assertEqual(header["OBJECT"], "sn2014c")
+        self.assertEqual(header["NAXIS"], 2)
+        self.assertEqual(header["CRVAL1"], 150.)
+        self.assertNotIn("CDELT1", header)
+        self.assertEqual(header["DATE"], "2015-06-09T09:52:10")
+        keys = [k for k in header.keys() if k not in ("COMMENT", "HISTORY")]
+        self.assertEqual(len(keys), len(set(keys)))
+        self.assertEqual(len(header["COMMENT"]), 1)
+        self.assertEqual(image["CRVAL1"], 10.)  # The original is left alone
+
+    def test_reproject(self):
+        sources = Table([[50.5, 60.5], [50.5, 50.5], [0., 0.], [0., 0.]],
+                        names=("X_IMAGE_DBL", "Y_IMAGE_DBL", "ALPHA_J2000",
+                               "DELTA_J2000"))
+        moved = reproject(sources, _solution())
+        self.assertAlmostEqual(moved["ALPHA_J2000"][0], 150.)
+        self.assertAlmostEqual(moved["DELTA_J2000"][0], 20.)
+        # 10 pixels of 0.8" along +x, i.e. towards smaller RA as CD1_1 < 0
+        self.assertTrue(moved["ALPHA_J2000"][1] < 150.)
+        self.assertAlmostEqual(
+            (150. - moved["ALPHA_J2000"][1]) * np.cos(np.deg2rad(20.)),
+            8. / 3600, places=6)
+        self.assertEqual(sources["ALPHA_J2000"][0], 0.)
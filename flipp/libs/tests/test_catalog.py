@@ -0,0 +1,44 @@
+# -*- coding:utf-8 -*-
+import os
+import shutil
+
+import numpy as np
+
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from flipp.bench.stubs import write_ascii_head, write_fits_ldac
+from flipp.libs import sextractor as SE
+
+
+class TestReadCatalog(TestCase):
+    """ASCII_HEAD and FITS_LDAC catalogs read back the same."""
+
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.params = ["NUMBER", "X_IMAGE_DBL", "MAG_AUTO", "FLAGS"]
+        self.cols = {"NUMBER": np.arange(1, 4),
+                     "X_IMAGE_DBL": np.array([10.5, 20.25, 30.125]),
+                     "MAG_AUTO": np.array([-9.5, -8.25, -7.]),
+                     "FLAGS": np.array([0, 2, 0])}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_formats_agree(self):
+        ascii = os.path.join(self.tmp, "cat.txt")
+        ldac = os.path.join(self.tmp, "cat.fits")
+        write_ascii_head(ascii, self.params, self.cols)
+        write_fits_ldac(ldac, self.params, self.cols)
+        a = SE.read_catalog(ascii, "ASCII_HEAD")
+        b = SE.read_catalog(ldac, "FITS_LDAC")
+        os.remove(ldac)  # The table must not depend on the file
+        self.assertEqual(a.colnames, self.params)
+        self.assertEqual(b.colnames, self.params)
+        for p in self.params:
+            self.assertEqual(list(a[p]), list(b[p]))
+
+    def test_check_image_bytes(self):
+        # 100x100 float32 pixels fill 14 blocks, plus one header block
+        self.assertEqual(SE.check_image_bytes({"NAXIS1": 100, "NAXIS2": 100},
+                                              2), 2 * 15 * 2880)
@@ -0,0 +1,44 @@
+# -*- coding:utf-8 -*-
+from unittest import TestCase
+
+import numpy as np
+
+from flipp.libs import crossmatch
+
+
+class TestCrossmatch(TestCase):
+    """Matches agree with brute force, across RA = 0 and at the poles."""
+
+    def check(self, ra0, dec0):
+        rng = np.random.RandomState(0)
+        ra = (ra0 + rng.normal(0., 0.02, 500)) % 360.
+        dec = np.clip(dec0 + rng.normal(0., 0.02, 500), -89.999, 89.999)
+        ra2 = (ra + rng.normal(0., 5e-4, 500)) % 360.
+        dec2 = dec + rng.normal(0., 5e-4, 500)
+        idx, sep = crossmatch.match(ra2, dec2, ra, dec, 5. / 3600)
+        xyz, xyz2 = (crossmatch.unit_vectors(ra, dec),
+                     crossmatch.unit_vectors(ra2, dec2))
+        d = crossmatch.to_angle(np.sqrt(
+            ((xyz2[:, None, :] - xyz[None, :, :]) ** 2).sum(axis=2)))
+        found = d.min(axis=1) <= 5. / 3600
+        np.testing.assert_array_equal(idx >= 0, found)
+        np.testing.assert_allclose(sep[found], d.min(axis=1)[found])
+
+    def test_wraparound(self):
+        self.check(0.001, 20.)
+
+    def test_pole(self):
+        self.check(120., 89.98)
+
+    def test_fallback(self):
+        tree, crossmatch.cKDTree = crossmatch.cKDTree, None
+        try:
+            self.check(359.999, -45.)
+        finally:
+            crossmatch.cKDTree = tree
+
+    def test_bounding_cone(self):
+        ra, dec, radius = crossmatch.bounding_cone([359.9, 0.1], [0., 0.])
+        self.assertAlmostEqual(dec, 0.)
+        self.assertAlmostEqual(np.cos(np.radians(ra)), 1.)
+        self.assertAlmostEqual(radius, 0.1)
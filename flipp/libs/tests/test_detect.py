@@ -0,0 +1,33 @@
+# -*- coding:utf-8 -*-
+from unittest import TestCase
+
+import numpy as np
+
+from flipp.libs import detect
+
+
+class TestDetect(TestCase):
+    """In-process source counting for the validation gate."""
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.noise = rng.normal(1000., 10., (256, 256))
+        yy, xx = np.mgrid[:256, :256]
+        self.stars = self.noise.copy()
+        for x, y in [(40, 50), (120, 200), (200, 90), (60, 180), (230, 230)]:
+            self.stars += 800. * np.exp(-((xx - x) ** 2 + (yy - y) ** 2) / 4.5)
+
+    def test_count(self):
+        self.assertEqual(detect.count_sources(self.stars), 5)
+        self.assertEqual(detect.count_sources(self.noise), 0)
+
+    def test_constant_frame(self):
+        self.assertEqual(detect.count_sources(np.full((64, 64), 65535.)), 0)
+
+    def test_label_areas(self):
+        """The numpy fallback joins diagonal neighbours."""
+        mask = np.array([[1, 1, 0, 0, 0],
+                         [0, 0, 1, 0, 1],
+                         [0, 0, 0, 0, 1],
+                         [1, 0, 0, 0, 0]], dtype=bool)
+        self.assertEqual(sorted(detect._label_areas(mask)), [1, 2, 3])
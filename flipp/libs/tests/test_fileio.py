@@ -0,0 +1,48 @@
+# -*- coding:utf-8 -*-
+import os
+import subprocess
+
+from unittest import TestCase
+
+from astropy.io import fits
+
+from flipp.libs.fileio import read_header, get_zipped_fitsfile
+from flipp.conf import settings
+
+GOOD_KAIT = os.path.join(settings.FIXTURE_DIR, 'kait', 'goodkait.fits')
+BAD_KAIT = os.path.join(settings.FIXTURE_DIR, 'kait', 'badkait.fts.Z')
+
+
+class TestReadHeader(TestCase):
+    """Header-only reads agree with opening the whole image."""
+
+    def test_plain(self):
+        header = read_header(GOOD_KAIT)
+        self.assertEqual(header.tostring(), fits.getheader(GOOD_KAIT).tostring())
+
+    def test_compressed(self):
+        header = read_header(BAD_KAIT)
+        full = get_zipped_fitsfile(BAD_KAIT)[0].header
+        self.assertEqual(header["NAXIS1"], full["NAXIS1"])
+        self.assertEqual(header["DATE"], full["DATE"])
+        self.assertEqual(header["FILTERS"], full["FILTERS"])  # Unparsable
+
+    def test_not_fits(self):
+        self.assertRaises(IOError, read_header, __file__)
+
+
+class TestZippedFitsfile(TestCase):
+    """.Z images open whole, as decompressed by ``gzip -dc``."""
+
+    def test_open(self):
+        hdu = get_zipped_fitsfile(BAD_KAIT)
+        header = hdu[0].header
+        self.assertEqual(hdu[0].data.shape, (header["NAXIS2"],
+                                             header["NAXIS1"]))
+        try:
+            expected = subprocess.check_output(["gzip", "-dc", BAD_KAIT])
+        except (OSError, subprocess.CalledProcessError):
+            return  # No reference decoder on this machine
+        reference = fits.HDUList.fromstring(expected)
+        self.assertEqual(header["DATE"], reference[0].header["DATE"])
+        self.assertTrue((hdu[0].data == reference[0].data).all())
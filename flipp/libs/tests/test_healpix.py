@@ -0,0 +1,51 @@
+# -*- coding:utf-8 -*-
+from unittest import TestCase
+
+import numpy as np
+
+from flipp.libs import healpix
+from flipp.libs.refcache import separation
+
+
+class TestConeRanges(TestCase):
+    """The pixel ranges of a cone hold every position inside it, across
+    RA = 0 and at the poles."""
+
+    def test_cover(self):
+        rng = np.random.RandomState(0)
+        ra = rng.uniform(0., 360., 200000)
+        dec = np.degrees(np.arcsin(rng.uniform(-1., 1., 200000)))
+        nside = 2 ** 16
+        pixels = healpix.nested(nside, ra, dec)
+        for cra, cdec, radius in [(150., 2., 0.5), (0.01, -30., 1.),
+                                  (359.9, 60., 2.), (10., 89.9, 1.),
+                                  (200., -89.5, 3.)]:
+            ranges = healpix.cone_ranges(nside, cra, cdec, radius)
+            self.assertLessEqual(len(ranges), 12)
+            inside = separation(cra, cdec, ra, dec) <= radius
+            covered = np.zeros(len(ra), bool)
+            for start, stop in ranges:
+                covered |= (pixels >= start) & (pixels < stop)
+            self.assertTrue(covered[inside].all())
+
+    def test_cover_small(self):
+        """Arcsecond and arcminute cones, sampled densely around them."""
+        rng = np.random.RandomState(1)
+        nside = 2 ** 16
+        n = 5000
+        for cra, cdec in [(150., 2.), (0., 0.), (359.9999, -45.),
+                          (0.0001, 60.), (10., 89.99), (200., -89.999),
+                          (0., 90.), (123., -90.)]:
+            for radius in (20. / 3600, 1. / 60, 10. / 60):
+                ra, dec = healpix.destination(
+                    cra, cdec, 1.3 * radius * np.sqrt(rng.uniform(0., 1., n)),
+                    rng.uniform(0., 2 * np.pi, n))
+                pixels = healpix.nested(nside, ra, dec)
+                ranges = healpix.cone_ranges(nside, cra, cdec, radius)
+                self.assertLessEqual(len(ranges), 12)
+                inside = separation(cra, cdec, ra, dec) <= radius
+                self.assertTrue(inside.sum() > n / 2)
+                covered = np.zeros(n, bool)
+                for start, stop in ranges:
+                    covered |= (pixels >= start) & (pixels < stop)
+                self.assertTrue(covered[inside].all(), (cra, cdec, radius))
@@ -0,0 +1,40 @@
+# -*- coding:utf-8 -*-
+import os
+import subprocess
+
+from unittest import TestCase
+
+from flipp.libs import lzw
+from flipp.conf import settings
+
+BAD_KAIT = os.path.join(settings.FIXTURE_DIR, 'kait', 'badkait.fts.Z')
+
+
+class TestLZW(TestCase):
+    """In-process decoding of Unix compress (.Z) files."""
+
+    def setUp(self):
+        with open(BAD_KAIT, 'rb') as f:
+            self.compressed = f.read()
+
+    def test_fits_fixture(self):
+        data = lzw.decompress(self.compressed)
+        self.assertEqual(len(data) % 2880, 0)
+        self.assertTrue(bytes(data[:30]).startswith(b"SIMPLE  ="))
+        try:
+            expected = subprocess.check_output(["gzip", "-dc", BAD_KAIT])
+        except (OSError, subprocess.CalledProcessError):
+            return  # No reference decoder on this machine
+        self.assertEqual(bytes(data), expected)
+
+    def test_incremental(self):
+        """Feeding the stream in awkward pieces changes nothing."""
+        d = lzw.Decompressor()
+        data = bytearray()
+        for i in range(0, len(self.compressed), 1001):
+            data += d.decompress(self.compressed[i:i + 1001])
+        data += d.flush()
+        self.assertEqual(data, lzw.decompress(self.compressed))
+
+    def test_not_compressed(self):
+        self.assertRaises(lzw.LZWError, lzw.decompress, b"SIMPLE  =  T")
@@ -0,0 +1,71 @@
+# -*- coding:utf-8 -*-
+import os
+import shutil
+
+import numpy as np
+
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from flipp.libs.refcache import DTYPE, TileCache, separation
+
+
+class TestTileCache(TestCase):
+    """Cone queries answered from tiles find exactly the stars a brute
+    force search does, around the poles and across RA = 0 too."""
+
+    def setUp(self):
+        self.root = mkdtemp()
+        rng = np.random.RandomState(0)
+        n = 20000
+        stars = np.zeros(3 * n, DTYPE)
+        # Both polar caps above |dec| = 85, and a patch across RA = 0
+        cap = np.degrees(np.arcsin(rng.uniform(np.sin(np.radians(85.)), 1.,
+                                               2 * n)))
+        stars["decdeg"][:2 * n] = cap * np.repeat([1., -1.], n)
+        stars["radeg"][:2 * n] = rng.uniform(0., 360., 2 * n)
+        stars["radeg"][2 * n:] = rng.uniform(-3., 3., n) % 360.
+        stars["decdeg"][2 * n:] = rng.uniform(-3., 3., n)
+        self.stars = stars
+        self.fetches = 0
+
+        def fetch(ra, dec, radius):
+            self.fetches += 1
+            return stars[separation(ra, dec, stars["radeg"],
+                                    stars["decdeg"]) <= radius]
+
+        self.cache = TileCache(self.root, fetch, max_bytes=0, size=1.)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def check(self, ra, dec, radius):
+        found = self.cache.cone(ra, dec, radius)
+        expected = self.stars[separation(ra, dec, self.stars["radeg"],
+                                         self.stars["decdeg"]) <= radius]
+        self.assertEqual(sorted(found["radeg"]), sorted(expected["radeg"]),
+                         (ra, dec, radius))
+
+    def test_poles(self):
+        rng = np.random.RandomState(1)
+        for _ in range(40):
+            self.check(rng.uniform(0., 360.), rng.uniform(88.6, 89.5), 0.5)
+            sign = rng.choice([-1., 1.])
+            self.check(rng.uniform(0., 360.), sign * rng.uniform(87., 89.8),
+                       3.)
+
+    def test_wraparound(self):
+        self.check(0.01, 0.5, 1.)
+        self.check(359.5, -1., 2.)
+
+    def test_evicted_meanwhile(self):
+        self.check(0.5, 0.5, 0.3)
+        fetches = self.fetches
+        for dirpath, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith(".npy"):  # As another process's evict()
+                    os.remove(os.path.join(dirpath, name))
+        self.cache._known = lambda tiles: dict(
+            (tile, (self.cache._path(tile), 1e300)) for tile in tiles)
+        self.check(0.5, 0.5, 0.3)
+        self.assertTrue(self.fetches > fetches)
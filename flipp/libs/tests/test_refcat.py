@@ -0,0 +1,63 @@
+# -*- coding:utf-8 -*-
+import io
+import os
+import shutil
+
+import numpy as np
+
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from flipp.libs import refcat
+from flipp.libs.refcache import separation
+
+
+class TestOfflineCatalog(TestCase):
+    """Zoned cone queries find exactly the stars a brute force search does."""
+
+    def setUp(self):
+        self.root = mkdtemp()
+        rng = np.random.RandomState(0)
+        n = 20000
+        self.ra = rng.uniform(0., 360., n)
+        self.dec = np.degrees(np.arcsin(rng.uniform(-1., 1., n)))
+        stars = np.empty(n, refcat.STORAGE)
+        stars["Johnson_V"] = np.nan
+        stars["radeg"], stars["decdeg"] = self.ra, self.dec
+        self.chunks = [stars[:n // 2], stars[n // 2:]]
+        refcat.build_catalog(self.chunks, self.root)
+        self.catalog = refcat.OfflineCatalog(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_cone(self):
+        for ra, dec, radius in [(150., 2., 3.), (0.5, -30., 4.),
+                                (359., 60., 5.), (10., 88., 4.)]:
+            stars = self.catalog.cone(ra, dec, radius)
+            expected = separation(ra, dec, self.ra, self.dec) <= radius
+            self.assertEqual(sorted(stars["radeg"]),
+                             sorted(self.ra[expected]))
+            self.assertTrue(np.isnan(stars["Johnson_V"]).all())
+
+    def test_rebuild(self):
+        # Scratch files of a build that was killed half-way through
+        scratch = os.path.join(self.root, "zones.tmp")
+        os.mkdir(scratch)
+        with open(os.path.join(scratch, "00368"), "wb") as f:
+            self.chunks[0][:100].tofile(f)
+        self.assertEqual(refcat.build_catalog(self.chunks, self.root),
+                         len(self.ra))
+        stars = refcat.OfflineCatalog(self.root).cone(150., 2., 3.)
+        self.assertEqual(len(stars), len(self.catalog.cone(150., 2., 3.)))
+
+    def test_read_csv(self):
+        path = os.path.join(self.root, "dump.csv")
+        with io.open(path, "wb") as f:
+            f.write(b"radeg,decdeg,Sloan_i,NAME\n"
+                    b"10.5,-2.25,NA,NAN1\n"
+                    b"11.5,3.5,14.2,x\n")
+        stars, = list(refcat.read_csv(path))
+        self.assertEqual(list(stars["decdeg"]), [-2.25, 3.5])
+        self.assertTrue(np.isnan(stars["Sloan_i"][0]))
+        self.assertTrue(np.isnan(stars["Sloan_r"]).all())
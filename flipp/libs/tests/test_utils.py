@@ -1,3 +1,69 @@
 # -*- coding:utf-8 -*-
+import os
+import shutil
 
-from unittest import TestCase
\ No newline at end of file
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from astropy.io import fits
+
+from flipp.libs.utils import CommandFailed, FitsIOMixin, shMixin
+from flipp.conf import settings
+
+
+class TestParseInput(TestCase):
+    """``FitsIOMixin._parse_input`` only copies images when it has to."""
+
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.original = os.path.join(self.tmp, "goodkait.fits")
+        shutil.copyfile(os.path.join(settings.FIXTURE_DIR, 'kait',
+                                     'goodkait.fits'), self.original)
+        self.parser = FitsIOMixin()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_plain_fits_used_in_place(self):
+        name, path, image = self.parser._parse_input(self.original, copy=False)
+        self.assertEqual(path, self.original)
+        self.assertFalse(self.parser.owns_path)
+
+    def test_copy_mode(self):
+        name, path, image = self.parser._parse_input(self.original, copy=True)
+        self.assertNotEqual(path, self.original)
+        self.assertTrue(self.parser.owns_path)
+        os.remove(path)
+
+    def test_compressed_is_materialized(self):
+        bad_kait = os.path.join(settings.FIXTURE_DIR, 'kait', 'badkait.fts.Z')
+        name, path, image = self.parser._parse_input(bad_kait, copy=False)
+        self.assertTrue(self.parser.owns_path)
+        self.assertEqual(fits.getheader(path)["NAXIS"], 2)
+        os.remove(path)
+
+    def test_hdulist_is_copied(self):
+        name, path, image = self.parser._parse_input(
+            fits.open(self.original), copy=False)
+        self.assertNotEqual(path, self.original)
+        self.assertTrue(self.parser.owns_path)
+        os.remove(path)
+
+
+class ls(shMixin):
+
+    cmd = "ls"
+
+
+class TestSh(TestCase):
+    """A failing command raises with its stderr, not silently."""
+
+    def test_exit_status(self):
+        stdout, stderr = ls().sh(settings.FIXTURE_DIR)
+        self.assertIn(b"kait", stdout)
+        missing = os.path.join(settings.FIXTURE_DIR, "missing")
+        with self.assertRaises(CommandFailed) as caught:
+            ls().sh(missing)
+        self.assertNotEqual(caught.exception.returncode, 0)
+        self.assertIn(missing, unicode(caught.exception))
+        self.assertIn("No such file", unicode(caught.exception))
@@ -0,0 +1,37 @@
+# -*- coding:utf-8 -*-
+import os
+import shutil
+
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from flipp.libs.workspace import Workspace
+
+
+class TestWorkspace(TestCase):
+    """Everything made in a workspace goes away with it."""
+
+    def setUp(self):
+        self.root = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_lazy_and_cleanup(self):
+        ws = Workspace(root=os.path.join(self.root, "scratch"))
+        self.assertFalse(os.path.exists(ws.root))
+        f = ws.file(suffix=".fits")
+        d = ws.mkdir()
+        self.assertTrue(os.path.isfile(f))
+        self.assertTrue(os.path.isdir(d))
+        self.assertEqual(os.path.dirname(f), ws.path)
+        path = ws.path
+        ws.cleanup()
+        self.assertFalse(os.path.exists(path))
+        ws.cleanup()  # Idempotent
+
+    def test_context_manager(self):
+        with Workspace(root=self.root) as ws:
+            name = ws.join("SOLVED-x.fits")
+            self.assertFalse(os.path.exists(name))
+        self.assertFalse(os.path.exists(os.path.dirname(name)))
@@ -0,0 +1,64 @@
+# -*- coding:utf-8 -*-
+from unittest import TestCase
+
+import numpy as np
+
+from astropy.table import Table
+
+from flipp.libs import zeropoint
+from flipp.libs.refcache import DTYPE, separation
+
+
+class FakeCatalog(object):
+
+    def __init__(self, stars):
+        self.stars = stars
+        self.queries = 0
+
+    def cone(self, ra, dec, radius):
+        self.queries += 1
+        return self.stars[separation(ra, dec, self.stars["radeg"],
+                                     self.stars["decdeg"]) <= radius]
+
+
+class TestZeropointBatch(TestCase):
+    """One catalog query per field, one zeropoint per image."""
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        stars = np.empty(500, DTYPE)
+        stars["radeg"] = rng.uniform(-0.1, 0.1, 500) % 360.
+        stars["decdeg"] = rng.uniform(9.9, 10.1, 500)
+        for c in ("Johnson_B", "Johnson_V", "Sloan_g", "Sloan_r", "Sloan_i"):
+            stars[c] = rng.uniform(12., 16., 500)
+        self.catalog = FakeCatalog(stars)
+        self.get_catalog = zeropoint.get_catalog
+        zeropoint.get_catalog = lambda: self.catalog
+        self.images = []
+        for passband, zp in (("V", 24.5), ("I", 23.), ("clear", 25.)):
+            mags = zeropoint.reference_magnitudes(stars[:200], passband)[0]
+            self.images.append(Table(
+                [stars["radeg"][:200], stars["decdeg"][:200], mags - zp,
+                 np.full(200, 0.02)],
+                names=("ALPHA_J2000", "DELTA_J2000", "MAG_AUTO",
+                       "MAGERR_AUTO")))
+
+    def tearDown(self):
+        zeropoint.get_catalog = self.get_catalog
+
+    def test_batch(self):
+        results = zeropoint.Zeropoint_apass_batch(self.images,
+                                                  ["V", "I", "clear"])
+        self.assertEqual(self.catalog.queries, 1)
+        for (sources, zp, n, scatter), expected in zip(results,
+                                                       (24.5, 23., 25.)):
+            self.assertAlmostEqual(zp, expected)
+            self.assertEqual(n, 200)
+            self.assertAlmostEqual(scatter, 0.)
+            np.testing.assert_allclose(sources["MAG_AUTO_ZP"] - expected,
+                                       sources["MAG_AUTO"])
+
+    def test_closest_pairs(self):
+        keep = zeropoint._closest_pairs(np.array([3, -1, 3, 0]),
+                                        np.array([2., np.inf, 1., 5.]))
+        self.assertEqual(list(keep), [False, False, True, True])
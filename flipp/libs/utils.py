@@ -51,6 +51,26 @@ class ConfigurationError(Exception):
     pass
 
 
+class CommandFailed(subprocess.CalledProcessError):
+    """An external command exited with an error (or was killed); what it
+    wrote to stderr is kept, and shown, with it.
+    """
+
+    def __init__(self, returncode, cmd, output=None, stderr=None):
+        super(CommandFailed, self).__init__(returncode, cmd, output)
+        self.stderr = stderr
+
+    def __unicode__(self):
+        msg = "{} exited with status {}".format(self.cmd, self.returncode)
+        said = (self.stderr or b"").decode("utf-8", "replace").strip()
+        if said:
+            msg += ": " + said[-2000:]
+        return msg
+
+    def __str__(self):
+        return self.__unicode__().encode("utf-8")
+
+
 class shMixin(object):
 
     """Generic bash command wrapper with some option/argument parsing.
@@ -119,11 +139,25 @@ class shMixin(object):
         d.update(update_kwargs)
         return d
 
-    @classmethod
-    def sh(cls, *args, **kwargs):
-        cmd = cls.configure(*args, **kwargs)
-        stdout, stderr = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE).communicate(timeout=cls.timeout)
-        return cls.process_cmd(stdout, stderr)
+    def sh(self, *args, **kwargs):
+        """Run the command.  If it takes longer than ``timeout`` seconds
+        (which an instance may set for itself) it is killed, and
+        ``TimeoutExpired`` raised; if it fails, :class:`CommandFailed` is
+        raised with what it wrote to stderr.
+        """
+        cmd = self.configure(*args, **kwargs)
+        # exec, so that the process we kill is the command, not a shell
+        # that would leave it running.
+        proc = Popen("exec " + cmd, shell=True, stdout=PIPE, stderr=PIPE)
+        try:
+            stdout, stderr = proc.communicate(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise
+        if proc.returncode:
+            raise CommandFailed(proc.returncode, cmd, stdout, stderr)
+        return self.process_cmd(stdout, stderr)
 
 
 class FitsIOMixin(object):
@@ -131,40 +165,57 @@ class FitsIOMixin(object):
 
     required_config_keys = tuple()
 
-    def _parse_input(self, obj):
+    def _parse_input(self, obj, copy=None, workspace=None):
         """Sets instance attributes based on input type.
 
         If obj is string-like, assume it is a filepath, and open it as an
-        astropy HDUList.
+        astropy HDUList.  Plain FITS files are used in place; compressed
+        files, and files whose commentary cards had to be cleaned up, are
+        written once to a temp file.
 
         If obj is already an astropy HDUList, stay agnostic about origin of
-        file on disk, and create a temp file for it. This is potentially
-        very slow, but ensures that original images are never written over.
+        file on disk, and create a temp file for it.
+
+        With ``copy`` (default ``settings.COPY_INPUT_IMAGES``), always work
+        on a temp copy.  ``self.owns_path`` tells whether ``path`` is such a
+        copy, i.e. safe to delete; original images are never written over.
+        Copies are made in ``workspace`` (a
+        :class:`flipp.libs.workspace.Workspace`) when one is given.
         """
+        if copy is None:
+            copy = settings.COPY_INPUT_IMAGES
         if isinstance(obj, basestring):
             # Handle filepaths
             try:
                 image = fits.open(obj)
+                compressed = False
             except IOError:
                 # self.image = ZCat.open(obj)
                 image = get_zipped_fitsfile(obj)
+                compressed = True
             # strip out header commentary cards, which often have
             #  non-ascii characters
+            dirty = self._needs_fixing(image)
             image = self._strip_commentary_cards(image)
             name = os.path.split(obj)[1]
-            path = mkstemp(prefix="COPY-{0}".format(os.path.splitext(name)[0]),
-                suffix=".fits")[1]
-            with open(path, 'w') as f:
-                image.writeto(f, output_verify="silentfix+ignore")
+            if copy or compressed or dirty:
+                path = self._temp_fits(
+                    workspace, "COPY-{0}".format(os.path.splitext(name)[0]))
+                with open(path, 'wb') as f:
+                    image.writeto(f, output_verify="silentfix+ignore")
+                self.owns_path = True
+            else:
+                path = os.path.abspath(obj)
+                self.owns_path = False
 
         elif isinstance(obj, fits.hdu.hdulist.HDUList):
             # Add handling for this if we want to pass in a non-HDUList object
             image = obj
             fp = obj.filename()
-            z = mkstemp(suffix=".fits")[1]
-            with open(z, 'w') as f:
+            path = self._temp_fits(workspace, "COPY-")
+            with open(path, 'wb') as f:
                 obj.writeto(f, output_verify="silentfix+ignore")
-            path = z
+            self.owns_path = True
             if fp:
                 name = os.path.split(fp)[1]
             else:
@@ -177,6 +228,23 @@ class FitsIOMixin(object):
 
         return name, path, image
 
+    def _temp_fits(self, workspace, prefix):
+        """An empty, uniquely named .fits file to write a copy into."""
+        if workspace is not None:
+            return workspace.file(suffix=".fits", prefix=prefix)
+        fd, path = mkstemp(suffix=".fits", prefix=prefix)
+        os.close(fd)
+        return path
+
+    def _needs_fixing(self, image):
+        """True if :meth:`_strip_commentary_cards` will change ``image``."""
+        for c in image[0].header.get('COMMENT', []):
+            try:
+                c.encode('ascii')
+            except UnicodeError:
+                return True
+        return False
+
     def get_telescope(self, header):
         for h in settings.INSTRUMENT_HEADERS:
             telescope = dict(header).get(h, None)  # Try to get telescope name
@@ -247,20 +315,38 @@ class FileLoggerMixin(object):
 
     @property
     def logger(self):
-        return getattr(self, '_logger', self._configure_log())
+        if getattr(self, '_logger', None) is None:
+            self._logger = self._configure_log()
+        return self._logger
+
+    def close_log(self):
+        """Close the log file; the next use of ``logger`` reopens it."""
+        logger = getattr(self, '_logger', None)
+        if logger is not None:
+            self._close_handlers(logger)
+            self._logger = None
+
+    def _close_handlers(self, logger):
+        for h in logger.handlers:
+            h.close()
+        logger.handlers = []
 
     def _configure_log(self):
 
         logger = logging.getLogger(
             getattr(self, "LOGGER_NAME", "standalone_log")
             )
-        logger.handlers = []
+        self._close_handlers(logger)
         logger.setLevel(
             getattr(self, "LOGGER_LEVEL", logging.DEBUG)
             )
-        fh = logging.FileHandler(
-            getattr(self, "LOGGER_FILE", None) or mkstemp(suffix=".log", prefix=logger.name)[1]
-            )
+        log_file = getattr(self, "LOGGER_FILE", None)
+        if log_file:
+            mkdir(os.path.dirname(log_file))
+        else:
+            fd, log_file = mkstemp(suffix=".log", prefix=logger.name)
+            os.close(fd)
+        fh = logging.FileHandler(log_file)
         fh.setFormatter(
             logging.Formatter(
                 getattr(self, "LOGGER_FORMAT", "(%(levelname)s) - %(asctime)s ::: %(message)s")
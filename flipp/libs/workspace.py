@@ -0,0 +1,88 @@
+# -*- coding:utf-8 -*-
+"""
+Scratch space for the intermediate files of one image.
+
+Every temporary file the pipeline writes for an image (the working copy of
+a compressed input, sextractor catalogs and check images, solve-field's
+outputs) goes into one private directory under ``settings.SCRATCH_ROOT``,
+which is removed in one go when the image is done.  Point ``SCRATCH_ROOT``
+at a tmpfs (e.g. ``/dev/shm``) to keep that traffic off the disk.
+
+Example
+-------
+.. code-block::
+
+    with Workspace(prefix="goodkait-") as ws:
+        catalog = ws.file(suffix=".txt", prefix="CATALOG_")
+        ...
+"""
+
+from __future__ import unicode_literals
+
+import os
+import shutil
+
+from tempfile import mkstemp, mkdtemp
+
+from flipp.conf import settings
+
+
+class Workspace(object):
+    """A private scratch directory, created on first use.
+
+    Parameters
+    ----------
+    prefix : str
+        Prefix of the directory name, to tell workspaces apart.
+    root : str, optional
+        Where to create it; defaults to ``settings.SCRATCH_ROOT``, and to
+        the system temp directory if that is None.
+    """
+
+    def __init__(self, prefix="flipp-", root=None):
+        self.prefix = prefix
+        self.root = root or settings.SCRATCH_ROOT
+        self._path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cleanup()
+
+    def __repr__(self):
+        return "Workspace({!r})".format(self._path or self.prefix)
+
+    @property
+    def path(self):
+        """The directory itself; created the first time it is asked for."""
+        if self._path is None:
+            if self.root and not os.path.isdir(self.root):
+                os.makedirs(self.root)
+            self._path = mkdtemp(prefix=self.prefix, dir=self.root)
+        return self._path
+
+    def join(self, name):
+        """Path of ``name`` in the workspace; nothing is created.  The
+        directory is private, so unlike ``tempfile.mktemp`` no one else can
+        take the name first.
+        """
+        return os.path.join(self.path, name)
+
+    def file(self, suffix="", prefix="tmp"):
+        """Create an empty file with a unique name and return its path."""
+        fd, path = mkstemp(suffix=suffix, prefix=prefix, dir=self.path)
+        os.close(fd)
+        return path
+
+    def mkdir(self, prefix="tmp"):
+        """Create a uniquely named sub-directory and return its path."""
+        return mkdtemp(prefix=prefix, dir=self.path)
+
+    def cleanup(self):
+        """Remove the workspace and everything in it.  Safe to call more
+        than once; the workspace is recreated if used again.
+        """
+        if self._path is not None:
+            shutil.rmtree(self._path, ignore_errors=True)
+            self._path = None
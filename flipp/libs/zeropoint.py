@@ -1,8 +1,9 @@
 import numpy as np
-from astropy.coordinates import SkyCoord
-from astropy import units
+from astropy.table import Table
 
-from flipp.libs.apass import Client as APASS
+from flipp.libs.crossmatch import Catalog, bounding_cone
+from flipp.libs.refcache import separation
+from flipp.libs.refcat import get_catalog
 
 def gr2R( g,r ):
     """Use the Lupton 2005 transformations listed at
@@ -26,12 +27,39 @@ def ri2I( r,i ):
     sigma = 0.0078
     return I, sigma
 
+MAX_FIELD_SIZE = 5.0
+"""Degrees; a field apparently larger than this has bad coordinates."""
+
+TOLERANCE = 10.0/3600.
+"""Degrees between an image source and the APASS star it is matched to."""
+
+def reference_magnitudes( apass_cat, passband ):
+    """Magnitudes of the APASS stars ``apass_cat`` in ``passband``, and
+    the systematic error of the transformation to it.
+    """
+    if passband in ('clear', 'R'):
+        # transform the catalog values to R passband, and assume clear ~ R.
+        #  this is pretty close, but not at all exact - see discussion in Li+2003 (2003PASP..115..844L),
+        #  and also note that the camera has been changed since then.
+        return gr2R( np.array(apass_cat['Sloan_g'], dtype=float),
+                     np.array(apass_cat['Sloan_r'], dtype=float) )
+    elif passband == 'B':
+        return np.array(apass_cat['Johnson_B'], dtype=float), 0.0
+    elif passband == 'V':
+        return np.array(apass_cat['Johnson_V'], dtype=float), 0.0
+    elif passband == 'I':
+        return ri2I( np.array(apass_cat['Sloan_r'], dtype=float),
+                     np.array(apass_cat['Sloan_i'], dtype=float) )
+    else:
+        raise Exception('Passband not implemented.')
+
 def Zeropoint_apass( sources, passband='clear' ):
     """Given a source extractor catalog calculated from a single image,
     calculate the zero point (in magnitudes) of that image and return
     a catalog of sources with magnitudes and errors.
 
-    Uses the APASS catalog to calculate the zero point.
+    Uses the APASS catalog to calculate the zero point, from the backend
+    ``settings.REFCAT`` names (see flipp.libs.refcat).
 
     Example
     -------
@@ -49,49 +77,27 @@ def Zeropoint_apass( sources, passband='clear' ):
         sources = s.extract()
         sources,zp,N = Zeropoint_apass(sources)
     """
-    image_catalog_full = SkyCoord(ra=sources['ALPHA_J2000'], dec=sources['DELTA_J2000'])
-    # find the middle of the field found in the image
-    ra_c = np.mean( sources['ALPHA_J2000'] )*units.degree
-    dec_c = np.mean( sources['DELTA_J2000'] )*units.degree
-    # find the radius needed to capture the whole field
-    idx, sep2d, dist3d = image_catalog_full.match_to_catalog_sky( SkyCoord(ra=[ra_c], dec=[dec_c]) )
-    radius = np.max( sep2d )
+    image_catalog_full = Catalog(sources['ALPHA_J2000'], sources['DELTA_J2000'])
+    # find the middle of the field found in the image, and the radius
+    # needed to capture the whole field
+    ra_c, dec_c, radius = bounding_cone(sources['ALPHA_J2000'],
+                                        sources['DELTA_J2000'])
     # some error handling here:
-    if radius.value > 5.0:
+    if radius > MAX_FIELD_SIZE:
         # somehow we have a huge field query; that's wrong!
-        raise Exception('Apparent field size is {:.1f} degrees!'.format( radius.value))
-    radius += 1*units.arcmin # add some slack, just to be safe
-    apass_sources = APASS.query(ra_c.value, dec_c.value, radius.value)
-    
+        raise Exception('Apparent field size is {:.1f} degrees!'.format( radius))
+    radius += 1/60. # add some slack (an arcminute), just to be safe
+    apass_sources = Table(get_catalog().cone(ra_c, dec_c, radius))
+
     # cross match the two catalogs
-    apass_catalog_full = SkyCoord(ra=apass_sources['radeg']*units.degree, dec=apass_sources['decdeg']*units.degree)
-    id_image, sep2d, dist3d = apass_catalog_full.match_to_catalog_sky( image_catalog_full )
-    tolerance = 10.0 * units.arcsecond
-    id_image[ sep2d>tolerance ] = -1
+    id_image, sep = image_catalog_full.nearest(apass_sources['radeg'],
+                                               apass_sources['decdeg'],
+                                               TOLERANCE)
     # trim down to only the matches and re-order the image catalog to align with the apass catalog
-    apass_cat = apass_sources[ sep2d<=tolerance ]
+    apass_cat = apass_sources[ id_image>=0 ]
     image_cat = sources[ id_image[ id_image>=0 ] ]
 
-    if passband == 'clear':
-        # transform the catalog values to R passband, and assume clear ~ R.
-        #  this is pretty close, but not at all exact - see discussion in Li+2003 (2003PASP..115..844L),
-        #  and also note that the camera has been changed since then.
-        apass_cat_passband,transf_err = gr2R( np.array(apass_cat['Sloan_g']),
-                                              np.array(apass_cat['Sloan_r']) )
-    elif passband == 'B':
-        apass_cat_passband = apass_cat['Johnson_B']
-        transf_err = 0.0
-    elif passband == 'V':
-        apass_cat_passband = apass_cat['Johnson_V']
-        transf_err = 0.0
-    elif passband == 'R':
-        apass_cat_passband,transf_err = gr2R( np.array(apass_cat['Sloan_g']),
-                                              np.array(apass_cat['Sloan_r']) )
-    elif passband == 'I':
-        apass_cat_passband,transf_err = ri2I( np.array(apass_cat['Sloan_r']),
-                                              np.array(apass_cat['Sloan_i']) )
-    else:
-        raise Exception('Passband not implemented.')
+    apass_cat_passband,transf_err = reference_magnitudes( apass_cat, passband )
 
     # take the median as the zeropoint, careful to get rid of any
     #  nan values (which crop up if a passband is missing in APASS)
@@ -106,3 +112,106 @@ def Zeropoint_apass( sources, passband='clear' ):
     sources['MAG_AUTO_ZP'] = sources['MAG_AUTO']+zp
     sources['MAGERR_AUTO_ZP'] = sources['MAGERR_AUTO']
     return sources,zp,N
+
+def group_fields( catalogs ):
+    """Group source catalogs by field: each joins the first group whose
+    centre is within its own or the group's radius.  Catalogs without
+    sources are left out.  Returns lists of indices into ``catalogs``.
+    """
+    groups = []
+    for i, sources in enumerate(catalogs):
+        if not len(sources):
+            continue
+        ra, dec, radius = bounding_cone(sources['ALPHA_J2000'],
+                                        sources['DELTA_J2000'])
+        for group in groups:
+            sep = separation(ra, dec, group['ra'], group['dec'])
+            if sep <= max(radius, group['radius']):
+                group['members'].append(i)
+                break
+        else:
+            groups.append({'ra': ra, 'dec': dec, 'radius': radius,
+                           'members': [i]})
+    return [group['members'] for group in groups]
+
+def _closest_pairs( idx, sep ):
+    """Mask of the matches ``idx`` (-1 for none) to keep so that every
+    APASS star is matched to one source only, its closest.
+    """
+    keep = np.zeros(len(idx), dtype=bool)
+    matched = np.flatnonzero(idx >= 0)
+    order = matched[np.lexsort((sep[matched], idx[matched]))]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = idx[order][1:] != idx[order][:-1]
+    keep[order[first]] = True
+    return keep
+
+def Zeropoint_apass_batch( catalogs, passbands ):
+    """:func:`Zeropoint_apass` for many images at once, e.g. a night's
+    filters and repeat exposures of the same targets.
+
+    Images are grouped by field (:func:`group_fields`); each group fetches
+    the APASS stars around all its images once, indexes them once and
+    matches the sources of every image in one pass.  Each source is matched
+    to its nearest APASS star within ``TOLERANCE``, and each star to one
+    source only.
+
+    Parameters
+    ----------
+    catalogs : list of astropy.table.Table
+        source extractor catalogs, one per image
+    passbands : list of str
+        'clear', 'B', 'V', 'R' or 'I', one per image
+
+    Returns
+    -------
+    list of (sources, zp, N, scatter), one per image, in order; scatter is
+    the robust (MAD) standard deviation of the individual zeropoints.
+    """
+    results = [None] * len(catalogs)
+    for i, sources in enumerate(catalogs):
+        if not len(sources):
+            results[i] = _apply_zeropoint(sources, np.array([]))
+    for group in group_fields(catalogs):
+        ra = np.concatenate([np.asarray(catalogs[i]['ALPHA_J2000'])
+                             for i in group])
+        dec = np.concatenate([np.asarray(catalogs[i]['DELTA_J2000'])
+                              for i in group])
+        ra_c, dec_c, radius = bounding_cone(ra, dec)
+        if radius > MAX_FIELD_SIZE:
+            raise Exception('Apparent field size is {:.1f} degrees!'.format( radius))
+        apass_sources = get_catalog().cone(ra_c, dec_c, radius + 1/60.)
+        idx, sep = Catalog(apass_sources['radeg'],
+                           apass_sources['decdeg']).nearest(ra, dec, TOLERANCE)
+        # reference magnitude of every source's match, in its image's passband
+        reference = np.full(len(ra), np.nan)
+        mags = {}
+        start = 0
+        for i in group:
+            rows = slice(start, start + len(catalogs[i]))
+            start = rows.stop
+            if passbands[i] not in mags:
+                mags[passbands[i]] = reference_magnitudes(apass_sources,
+                                                          passbands[i])[0]
+            keep = _closest_pairs(idx[rows], sep[rows])
+            reference[rows][keep] = mags[passbands[i]][idx[rows][keep]]
+        zeropoints = reference - np.concatenate(
+            [np.asarray(catalogs[i]['MAG_AUTO'], dtype=float) for i in group])
+        start = 0
+        for i in group:
+            rows = slice(start, start + len(catalogs[i]))
+            start = rows.stop
+            results[i] = _apply_zeropoint(catalogs[i], zeropoints[rows])
+    return results
+
+def _apply_zeropoint( sources, zeropoints ):
+    """(sources, zp, N, scatter) from the individual ``zeropoints`` of the
+    matched ``sources`` (NaN where unmatched).
+    """
+    zeropoints = zeropoints[np.isfinite(zeropoints)]
+    N = len( zeropoints )
+    zp = np.median( zeropoints ) if N else np.nan
+    scatter = 1.4826 * np.median( np.abs(zeropoints - zp) ) if N else np.nan
+    sources['MAG_AUTO_ZP'] = sources['MAG_AUTO']+zp
+    sources['MAGERR_AUTO_ZP'] = sources['MAGERR_AUTO']
+    return sources,zp,N,scatter
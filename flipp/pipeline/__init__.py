@@ -1,14 +1,23 @@
 # -*- coding: utf-8 -*-
 
-from __future__ import unicode_literals
+from __future__ import unicode_literals, print_function
 
 import os
 import gc
 import re
+import time
 import argparse
 
 from flipp.pipeline.image import ImageParser
 from flipp.pipeline.match import SourceMatcher
+from flipp.pipeline.pool import WorkerPool
+from flipp.pipeline.staged import StagedPipeline
+from flipp.pipeline.manifest import Manifest
+from flipp.pipeline.results import ImageResult, summarize
+from flipp.pipeline.metrics import MetricsLog, summarize_metrics, total
+from flipp.pipeline.triage import FrameRejected, RejectionLog
+from flipp.libs.refcat import ZONE_HEIGHT
+from flipp.libs.utils import mkdir
 
 from flipp.conf import settings
 
@@ -18,77 +27,236 @@ def process_image(input_file, path_to_output,
                   skip_astrometry=False):
     """Processes a single image, goes through the following steps:
 
+    0.  The frame is triaged from its header and a sample of its pixels
+        (flipp.pipeline.triage); calibration, saturated or clouded-out
+        frames are "rejected" before any external tool runs
     1.  Goes to the ImageParser class
-        i.   Validates the image has at least 3 detectable sources
-        ii.  Image coordinates are corrected via astrometry.net solve-field
-        iii. Sources are extracted via SourceExtractor
+        i.   Validates the image has at least 3 detectable sources, and
+             extracts them via SourceExtractor, once
+        ii.  Image coordinates are corrected via astrometry.net solve-field,
+             from the extracted sources
+        iii. Source positions are re-projected through the new WCS
         iv.  A zeropoint is done by matching against the APASS catalog
     2.  Remaining sources that have been zeropoint-ed against APASS are cross
         referenced against existing sources in the FLIPP Database
         (flipp/conf/local.py:DB_URL)
 
     This can be considered the "main" entry-point to using the flipp codebase.
+
+    Returns
+    -------
+    flipp.pipeline.results.ImageResult
     """
+    start = time.time()
+    img = None
     try:
         img = ImageParser(input_file, path_to_output, telescope)
+        try:
+            img.triage()
+        except FrameRejected as e:
+            img.cleanup()
+            return ImageResult(input_file, "rejected", message=unicode(e),
+                               elapsed=time.time() - start,
+                               metrics=img.metrics.as_dict())
         sources = img.run(skip_astrometry=skip_astrometry)
         if not sources:
-            return
+            return ImageResult(input_file, "failed", message=img.error,
+                               elapsed=time.time() - start, stage=img.stage,
+                               output_file=img.output_file,
+                               metrics=img.metrics.as_dict())
         matcher = SourceMatcher(img)
-        n_created, n_updated = matcher.run()
-        return n_created, n_updated
+        n_updated, n_created = matcher.run()
+        return ImageResult(input_file, "done", n_created, n_updated,
+                           elapsed=time.time() - start, stage="ingested",
+                           output_file=img.output_file,
+                           metrics=img.metrics.as_dict())
     except Exception as e:
         msg = "{} encountered an unhandled exception: {}".format(input_file, e)
         print(msg)
+        return ImageResult(input_file, "error", message=unicode(e),
+                           elapsed=time.time() - start)
     finally:
+        if img is not None:
+            img.close_log()
         gc.collect()
 
 
+def iter_input_files(input_paths, extensions=[], recursive=False):
+    """Yield absolute paths of every image under ``input_paths``.
+
+    Files are yielded lazily so that very large archive folders can be
+    streamed into the pipeline.
+    """
+    R = re.compile('|'.join(map(re.escape, extensions)) + '$', flags=re.I)
+    for input_path in input_paths:
+        input_path = os.path.abspath(os.path.expanduser(input_path))
+        if os.path.isfile(input_path):
+            if R.search(input_path):
+                yield input_path
+        elif not recursive:  # Just check directory files
+            for name in sorted(os.listdir(input_path)):
+                p = os.path.join(input_path, name)
+                if os.path.isfile(p) and R.search(p):
+                    yield p
+        else:  # recursive == True
+            for (name, dirs, files) in os.walk(input_path):
+                for f in sorted(files):
+                    if R.search(f):
+                        yield os.path.join(name, f)
+
+
+def plan(input_paths, path_to_output=None, telescope=None, extensions=[],
+         recursive=False):
+    """Print where every input would be written, without processing or
+    writing anything.
+
+    Only image headers are read, so this runs over a whole archive at
+    header-read speed.  Inputs that would be written to the same output
+    file as an earlier input are reported as duplicates.
+
+    Returns a list of ``(path, output file or None, note)``.
+    """
+    path_to_output = os.path.abspath(os.path.expanduser(path_to_output))
+    planned = []
+    seen = {}
+    for f in iter_input_files(input_paths, extensions, recursive):
+        try:
+            img = ImageParser(f, path_to_output, telescope)
+            output_file = os.path.join(img.output_dir, img.output_name)
+        except Exception as e:
+            output_file, note = None, "unreadable: {}".format(e)
+        else:
+            note = ""
+            if output_file in seen:
+                note = "duplicate of {}".format(seen[output_file])
+            else:
+                seen[output_file] = f
+        print("{} -> {}{}".format(f, output_file or "-",
+                                  " ({})".format(note) if note else ""))
+        planned.append((f, output_file, note))
+    print("{} image(s): {} to process, {} duplicate(s), {} unreadable".format(
+        len(planned), len(seen),
+        sum(1 for p in planned if p[2].startswith("duplicate")),
+        sum(1 for p in planned if p[1] is None)))
+    return planned
+
+
+def init_worker():
+    """Runs first thing in every forked worker process."""
+    # Never reuse database connections inherited from the parent process.
+    from flipp.database import engine
+    from flipp.database.state import dispose_state_engines
+    engine.dispose()
+    dispose_state_engines()
+
+
 def run(input_paths, path_to_output=None, telescope=None, extensions=[],
-        recursive=False,  skip_astrometry=False):
+        recursive=False,  skip_astrometry=False, jobs=1, timeout=None,
+        staged=False, stage_workers=None, resume=False, checksum=False,
+        prefetch=False):
     """Business logic for running task.
 
+    With ``jobs`` > 1, images are processed by a pool of worker processes;
+    an image that crashes its worker or runs longer than ``timeout``
+    seconds is reported and the batch carries on.
+
+    With ``staged``, images instead flow through a
+    :class:`flipp.pipeline.staged.StagedPipeline`, with a separately sized
+    pool per stage (``stage_workers``, e.g. ``{"solve": 16}``).
+
+    Every outcome is recorded in a :class:`flipp.pipeline.manifest.Manifest`
+    in ``path_to_output``.  With ``resume``, images that are already done
+    (and unchanged since, by size and mtime, or sha1 with ``checksum``) are
+    skipped, and images that failed after astrometry restart from their
+    wcs-corrected output.
+
+    With ``prefetch``, the APASS tiles of every input's field are fetched
+    before any image is processed (see :mod:`flipp.pipeline.prefetch`).
+
+    Per-stage timings of every image are appended to ``flipp_metrics.jsonl``
+    in ``path_to_output`` and summarized at the end of the batch.
+
+    Returns a list of :class:`flipp.pipeline.results.ImageResult`, one per
+    image, in completion order.
+
     Example
     -------
     .. code-block::
         run("flipp/fixtures/kait/goodkait.fits",
-            "/home/ttu/Desktop/goodkait", telescope="kait")
+            "/home/ttu/Desktop/goodkait", telescope="kait", jobs=4)
     """
     path_to_output = os.path.abspath(os.path.expanduser(path_to_output))
-    R = re.compile('|'.join(map(re.escape, extensions)) + '$', flags=re.I)
-    for input_path in input_paths:
-        input_path = os.path.abspath(os.path.expanduser(input_path))
-        if os.path.isfile(input_path):
-            if not R.search(input_path):
-                continue
-            process_image(input_path, path_to_output,
-                          telescope, skip_astrometry)
-        else:  # os.path.isdir(input_path)
-            if not recursive:  # Just check directory files
-                paths = map(lambda x: os.path.abspath(
-                                      os.path.join(input_path, x)),
-                            os.listdir(input_path))
-                for p in filter(os.path.isfile, paths):
-                    if not R.search(p):
-                        continue
-                    process_image(p, path_to_output,
-                                  telescope, skip_astrometry)
-            else:  # recursive == True
-                for (name, dirs, files) in os.walk(input_path):
-                    for f in files:
-                        if not R.search(f):
-                            continue
-                        f = os.path.join(name, f)
-                        process_image(f, path_to_output,
-                                      telescope, skip_astrometry)
+    mkdir(path_to_output)
+    manifest = Manifest(path_to_output, checksum=checksum)
+    metrics_log = MetricsLog(os.path.join(path_to_output,
+                                          "flipp_metrics.jsonl"))
+    rejections = RejectionLog(path_to_output)
+    results = []
+    if prefetch:
+        from flipp.pipeline.prefetch import prefetch as prefetch_apass
+        prefetch_apass(iter_input_files(input_paths, extensions, recursive),
+                       telescope)
 
+    def tasks():
+        """(path, file to process, skip_astrometry) for every input."""
+        for f in iter_input_files(input_paths, extensions, recursive):
+            if resume:
+                action, entry = manifest.plan(f)
+                if action == "skip":
+                    results.append(ImageResult(f, "skipped", stage=entry.stage,
+                                               output_file=entry.output_file))
+                    continue
+                elif action == "resume":
+                    yield f, entry.output_file, True
+                    continue
+            yield f, f, skip_astrometry
 
-def console_run():
-    """Console script entry-point for flipp pipeline."""
-    parser = argparse.ArgumentParser(
-        description='Run flipp pipeline on a file with some output directory.',
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    def finish(result):
+        print(result)
+        manifest.record(result)
+        metrics_log.write(result)
+        rejections.add(result)
+        results.append(result)
 
+    try:
+        if staged:
+            pipeline = StagedPipeline.default(path_to_output, telescope,
+                                              skip_astrometry, stage_workers,
+                                              on_result=finish)
+            pipeline.run(tasks())
+        elif jobs > 1:
+            pool = WorkerPool(jobs, timeout=timeout, initializer=init_worker)
+            work = ((path, (f, path_to_output, telescope, skip))
+                    for path, f, skip in tasks())
+            for path, status, value in pool.imap_unordered(process_image,
+                                                           work):
+                finish(ImageResult.from_worker(path, status, value))
+        else:
+            for path, f, skip in tasks():
+                result = process_image(f, path_to_output, telescope, skip)
+                finish(result._replace(path=path))
+    finally:
+        manifest.flush()
+        rejections.flush()
+    print(summarize(results))
+    if rejections.summary():
+        print(rejections.summary())
+    table = summarize_metrics(results)
+    if table:
+        print(table)
+    avoided = total(results, "check_bytes_avoided")
+    if avoided:
+        print("Check images not written: {:.1f} MB".format(avoided / 1e6))
+    hits = total(results, "wcs_cache_hits")
+    misses = total(results, "wcs_cache_misses")
+    if hits or misses:
+        print("Cached WCS solutions: {} verified, {} re-solved".format(
+            hits, misses))
+    return results
+
+
+def _add_common_arguments(parser):
+    """Arguments shared by ``flipprun`` and ``flipp watch``."""
     parser.add_argument("input_files",
                         metavar="file1 file2 ...", type=str, nargs='+',
                         help="filepath or directory containing images.")
@@ -102,9 +270,6 @@ def console_run():
                               ' If none, guesses from fits header').format(
                             ', '.join(settings.TELESCOPES))
                         )
-    parser.add_argument("-r", "--recursive", action="store_true",
-                        help="If set, recurses through all directories within "
-                             "any input directories.")
     parser.add_argument("-e", "--extensions", type=str, metavar="ext",
                         help="valid extensions", nargs="*",
                         default=["fits", "fts", "fit",
@@ -112,8 +277,196 @@ def console_run():
     parser.add_argument("-s", "--skip_astrometry", action="store_true",
                         help="Assume wcs-coordinates are correct.  Warning : "
                              "Difficult to undo, please use with certainty!")
+    parser.add_argument("-j", "--jobs", type=int, metavar="N",
+                        default=settings.PIPELINE_JOBS,
+                        help="Number of images to process in parallel.")
+    parser.add_argument("--timeout", type=float, metavar="seconds",
+                        default=settings.PIPELINE_IMAGE_TIMEOUT,
+                        help="Kill an image's worker after this long.")
 
-    args = parser.parse_args()
 
+def _add_run_arguments(parser):
+    _add_common_arguments(parser)
+    parser.add_argument("-r", "--recursive", action="store_true",
+                        help="If set, recurses through all directories within "
+                             "any input directories.")
+    parser.add_argument("--staged", action="store_true",
+                        help="Run each pipeline stage (triage, extract, "
+                             "solve, zeropoint, ingest) in its own pool of "
+                             "workers.")
+    parser.add_argument("--stage-workers", type=str, nargs="*",
+                        metavar="stage=N", default=[],
+                        help="Pool sizes for --staged, overriding "
+                             "PIPELINE_STAGE_WORKERS, e.g. solve=16 ingest=1")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip images already processed in an earlier "
+                             "run into the same output directory, and restart "
+                             "failed ones from their last completed stage.")
+    parser.add_argument("--checksum", action="store_true",
+                        help="With --resume, detect changed inputs by sha1 "
+                             "instead of size and modification time.")
+    parser.add_argument("--prefetch", action="store_true",
+                        help="Fetch the APASS catalog of every image's field "
+                             "into the cache before processing any of them.")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+                        help="Only read headers and print where each image "
+                             "would be written, flagging duplicates.")
+
+
+def _add_watch_arguments(parser):
+    _add_common_arguments(parser)
+    parser.add_argument("--interval", type=float, metavar="seconds",
+                        default=settings.WATCH_INTERVAL,
+                        help="How often to look for new files.")
+    parser.add_argument("--settle", type=float, metavar="seconds",
+                        default=settings.WATCH_SETTLE,
+                        help="Only pick up files unchanged for this long.")
+
+
+def _check_database(parser):
+    """Stop before processing anything if ingest could not find Sources."""
+    from flipp.database import SourcesNotIndexed, check_sources_indexed
+    try:
+        check_sources_indexed()
+    except SourcesNotIndexed as e:
+        parser.error(unicode(e))
+
+
+def _run_from_args(parser, args):
+    stage_workers = {}
+    for s in args.stage_workers:
+        name, _, n = s.partition("=")
+        if name not in settings.PIPELINE_STAGE_WORKERS or not n.isdigit():
+            parser.error("Invalid --stage-workers value: {}".format(s))
+        stage_workers[name] = int(n)
+
+    if args.dry_run:
+        plan(args.input_files, args.output_dir, args.telescope,
+             args.extensions, args.recursive)
+        return
+    _check_database(parser)
     run(args.input_files, args.output_dir, args.telescope,
-        args.extensions, args.recursive, args.skip_astrometry)
+        args.extensions, args.recursive, args.skip_astrometry,
+        args.jobs, args.timeout, args.staged, stage_workers, args.resume,
+        args.checksum, args.prefetch)
+
+
+def _watch_from_args(parser, args):
+    from flipp.pipeline.watch import Watcher
+    _check_database(parser)
+    Watcher(args.input_files, args.output_dir, args.telescope,
+            args.extensions, True, args.skip_astrometry, args.jobs,
+            args.timeout, args.interval, args.settle).run()
+
+
+def _prefetch_from_args(parser, args):
+    from flipp.pipeline.prefetch import prefetch
+    prefetch(iter_input_files(args.input_files, args.extensions,
+                              args.recursive), args.telescope, args.jobs)
+
+
+def _build_catalog_from_args(parser, args):
+    from flipp.libs.refcat import build_catalog, read_csv
+    mkdir(args.output_dir)
+    chunks = (chunk for path in args.csv_files for chunk in read_csv(path))
+    n = build_catalog(chunks, args.output_dir, args.zone_height)
+    print("{} stars written to {}; set REFCAT = 'offline' and "
+          "REFCAT_PATH = {!r} to use it".format(n, args.output_dir,
+                                                args.output_dir))
+
+
+def _index_sources_from_args(parser, args):
+    from flipp.database import index_sources
+    print("HEALPix cells filled in for {} source(s)".format(index_sources()))
+
+
+def _solves_from_args(parser, args):
+    from flipp.pipeline.ladder import summarize_attempts
+    print(summarize_attempts(args.output_dir) or
+          "No solve-field attempts recorded in {}".format(args.output_dir))
+
+
+def console_run():
+    """Console script entry-point for flipp pipeline."""
+    parser = argparse.ArgumentParser(
+        description='Run flipp pipeline on a file with some output directory.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    _add_run_arguments(parser)
+    _run_from_args(parser, parser.parse_args())
+
+
+def console_flipp():
+    """Console script entry-point for the ``flipp`` command and its
+    sub-commands.
+    """
+    parser = argparse.ArgumentParser(description='FLIPP photometry pipeline.')
+    commands = parser.add_subparsers(dest="command")
+
+    sub = commands.add_parser(
+        "run", help="Run the pipeline once over files or directories "
+                    "(same as flipprun).",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    _add_run_arguments(sub)
+    sub.set_defaults(func=_run_from_args, parser=sub)
+
+    sub = commands.add_parser(
+        "watch", help="Keep running, processing new images as they appear "
+                      "in the given directories.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    _add_watch_arguments(sub)
+    sub.set_defaults(func=_watch_from_args, parser=sub)
+
+    sub = commands.add_parser(
+        "prefetch", help="Fetch the APASS catalog of the images' fields "
+                         "into the cache, ahead of a run.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    sub.add_argument("input_files", metavar="file1 file2 ...", type=str,
+                     nargs='+', help="filepath or directory containing images.")
+    sub.add_argument("-t", "--telescope", metavar="kait/nickel/etc",
+                     choices=settings.TELESCOPES.keys(), default=None,
+                     help="Optional telescope name; if none, guesses from "
+                          "fits header")
+    sub.add_argument("-e", "--extensions", type=str, metavar="ext",
+                     help="valid extensions", nargs="*",
+                     default=["fits", "fts", "fit",
+                              "fits.Z", "fts.Z", "fit.Z"])
+    sub.add_argument("-r", "--recursive", action="store_true",
+                     help="Recurse through all directories within any input "
+                          "directories.")
+    sub.add_argument("-j", "--jobs", type=int, metavar="N",
+                     default=settings.APASS_PREFETCH_JOBS,
+                     help="Number of requests to make at a time.")
+    sub.set_defaults(func=_prefetch_from_args, parser=sub)
+
+    sub = commands.add_parser(
+        "build-catalog", help="Convert the CSV files of an APASS dump into "
+                              "an offline reference catalog (REFCAT_PATH).",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    sub.add_argument("csv_files", metavar="dump1.csv dump2.csv ...", type=str,
+                     nargs='+', help="CSV files with the APASS columns.")
+    sub.add_argument("-o", "--output_dir", metavar="/path/to/catalog",
+                     type=str, required=True,
+                     help="Directory to write the catalog to.")
+    sub.add_argument("--zone-height", type=float, metavar="degrees",
+                     default=ZONE_HEIGHT, help="Height of the declination zones.")
+    sub.set_defaults(func=_build_catalog_from_args, parser=sub)
+
+    sub = commands.add_parser(
+        "index-sources", help="Add the HEALPix cell column (and its index) "
+                              "to a DB_URL source table made before it "
+                              "existed, and fill it in.")
+    sub.set_defaults(func=_index_sources_from_args, parser=sub)
+
+    sub = commands.add_parser(
+        "solves", help="Summarize solve-field attempts by telescope and "
+                       "rung of ASTROMETRY_LADDER, with the timeouts "
+                       "learned so far.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    sub.add_argument("-o", "--output_dir",
+                     metavar="/path/to/output/directory", type=str,
+                     default=settings.OUTPUT_ROOT,
+                     help="Output directory of the runs to summarize")
+    sub.set_defaults(func=_solves_from_args, parser=sub)
+
+    args = parser.parse_args()
+    args.func(args.parser, args)
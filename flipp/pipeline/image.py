@@ -4,6 +4,7 @@ from __future__ import unicode_literals
 
 import os
 import re
+import shutil
 import dateutil
 import errno
 import logging
@@ -16,15 +17,26 @@ from datetime import datetime, timedelta
 from glob import glob
 
 from flipp.libs.sextractor import Sextractor
-from flipp.libs.astrometry import Astrometry
+from flipp.libs.astrometry import (Astrometry, update_wcs, write_solved,
+                                   reproject)
 from flipp.libs.zeropoint import Zeropoint_apass
 from flipp.libs.utils import FitsIOMixin, FileLoggerMixin, mkdir
-from flipp.libs.fileio import plot_one_image
+from flipp.libs.workspace import Workspace
+from flipp.libs.fileio import plot_one_image, read_header, open_image
+from flipp.libs.detect import count_sources
+from flipp.pipeline.metrics import StageMetrics, timed
+from flipp.pipeline.triage import triage as check_quality
+from flipp.pipeline.wcscache import SolutionCache
+from flipp.pipeline.ladder import SolveLadder
 
 from flipp.conf import settings
 
 from subprocess32 import TimeoutExpired
 
+VALIDATION_DETECTOR = settings.VALIDATION_DETECTOR
+WCS_CACHE = settings.WCS_CACHE
+SAVE_REVIEW = settings.ASTROMETRY_SAVE_REVIEW
+
 REVIEW_DIR = os.path.join(settings.OUTPUT_ROOT, "REVIEW")
 """Copy images that fail to a separate directory for manual review."""
 
@@ -45,15 +57,31 @@ class ValidationError(Exception):
     pass
 
 
+STAGES = ("validated", "solved", "extracted", "zeropointed", "ingested")
+"""Pipeline stages, in order; ``ImageParser.stage`` is the last one completed."""
+
+
 class ImageParser(FitsIOMixin, FileLoggerMixin, object):
 
     def __init__(self, input_image, output_dir=None, telescope=None):
-        name, path, image = self._parse_input(input_image)
-        self.name = name
-        self.file = path
-        self.image = image
+        self.metrics = StageMetrics()
+        self._input = input_image
+        self._image = None
+        self._opened = None  # Read-only HDUList, see ``data``
+        # Every intermediate file for this image goes here; see cleanup()
+        self.workspace = Workspace(prefix="flipp-")
+        if isinstance(input_image, basestring):
+            # Only the header is needed to name and route the image; the
+            # pixels are loaded the first time a stage asks for them.
+            with self.metrics.stage("header"):
+                self._header = read_header(input_image)
+            self.input_file = os.path.abspath(input_image)
+            self.name = os.path.split(input_image)[1]
+        else:
+            self._load()
+            self.input_file = None
+            self.name = self._name
         # Preprocessing?  see META
-        self.header = self.image[0].header
         self.telescope = telescope or self.get_telescope(self.header)
         self.output_root = output_dir or settings.OUTPUT_ROOT
         self.output_dir = os.path.join(
@@ -61,10 +89,57 @@ class ImageParser(FitsIOMixin, FileLoggerMixin, object):
             '{:%Y%m%d}'.format(self.META['DATETIME'])
         )
         self.output_file = None  # Filled in at solve_field
-        mkdir(self.output_dir)
+        self.quality = None  # Triage statistics, see triage()
+        self.catalog = None  # Every source sextractor finds, see extract_catalog
         self.sources = None
+        self.error = None  # Reason the image was dropped, if it was
+        self.stage = None  # Last of STAGES completed
         self._set_log_conf()
 
+    def _load(self):
+        """Read the image (and copy it, if need be; see ``owns_path``)."""
+        if self._image is None:
+            source = self._input
+            if self._opened is not None:
+                if self._opened.filename() is None:
+                    # Decompressed in memory already; copy that instead
+                    source = self._strip_commentary_cards(self._opened)
+                else:
+                    self._opened.close()
+                self._opened = None
+            with self.metrics.stage("load"):
+                self._name, self._file, self._image = self._parse_input(
+                    source, workspace=self.workspace)
+
+    @property
+    def image(self):
+        self._load()
+        return self._image
+
+    @property
+    def file(self):
+        """The input itself, or our copy (``owns_path``)."""
+        self._load()
+        return self._file
+
+    @property
+    def data(self):
+        """Pixel data of the input image.  Reading it does not make the
+        working copy the external tools need (see ``file``).
+        """
+        if self._image is not None:
+            return self._image[0].data
+        if self._opened is None:
+            with self.metrics.stage("read"):
+                self._opened = open_image(self._input)
+        return self._opened[0].data
+
+    @property
+    def header(self):
+        if self._image is not None:
+            return self._image[0].header
+        return self._header
+
     def __str__(self):
         return str(unicode(self))
 
@@ -76,6 +151,10 @@ class ImageParser(FitsIOMixin, FileLoggerMixin, object):
         """Declare logging variables for FileLoggerMixin."""
         self.LOGGER_NAME = self.name
         self.LOGGER_LEVEL = logging.INFO
+        # Several images (and worker processes) share the nightly log file,
+        # so tag every record with the image it belongs to.
+        self.LOGGER_FORMAT = ("(%(levelname)s) - %(asctime)s - %(name)s "
+                              "::: %(message)s")
         self.LOGGER_FILE = os.path.join(
             self.output_dir,
             "flipp_{}.log".format(self.output_dir.split('/')[-1])
@@ -138,50 +217,114 @@ class ImageParser(FitsIOMixin, FileLoggerMixin, object):
         )
         return name
 
+    def extract_catalog(self):
+        """Run sextractor on the input image, once; the pixel-space catalog
+        is reused for validation, astrometry and photometry.
+        """
+        if self.catalog is None:
+            with self.metrics.stage("sextractor"):
+                se = Sextractor(self.file, self.telescope, self.workspace)
+                self.catalog = se.extract(flag_filter=False)
+            self.metrics.add("sextractor", "check_bytes_avoided",
+                             se.check_bytes_avoided)
+        return self.catalog
+
+    @staticmethod
+    def _unflagged(catalog):
+        return catalog[catalog['FLAGS'] == 0]
+
+    @timed("triage")
+    def triage(self):
+        """Reject calibration, saturated, clouded-out or empty frames from
+        the header and a sample of the pixels; see
+        :mod:`flipp.pipeline.triage`.  Raises
+        :class:`flipp.pipeline.triage.FrameRejected`.
+        """
+        self.quality = check_quality(self.header, lambda: self.data,
+                                     self.telescope)
+
+    @timed("validate")
     def validate(self):
         """TEMPORARY!  Validate image and continue to run.
         """
         threshold = 3
-        sources = Sextractor(self.image, self.telescope).extract()
-        msg = "Source Extractor failed to detect at least {0} sources"
-        if len(sources) <= threshold:
+        if VALIDATION_DETECTOR == "sextractor":
+            n_sources = len(self._unflagged(self.extract_catalog()))
+        else:
+            n_sources = count_sources(self.data) if self.data is not None else 0
+        msg = "Failed to detect at least {0} sources"
+        if n_sources <= threshold:
             raise ValidationError(msg.format(threshold))
-
-    def solve_field(self, save_review=False):
-        """Perform astrometry, write image and extract sources."""
-        astrometry = Astrometry(self.image, self.telescope)
-        img = astrometry.solve()
+        self.stage = "validated"
+
+    @timed("solve_field")
+    def solve_field(self, save_review=None):
+        """Perform astrometry and write the wcs-corrected image.
+
+        solve-field is given the sources already extracted (as an xylist)
+        instead of detecting them again itself.  A field solved before is
+        first tried with its earlier solution (see
+        :mod:`flipp.pipeline.wcscache`), then ever wider searches (see
+        :mod:`flipp.pipeline.ladder`).  An image none of them solves is
+        copied to REVIEW unless ``save_review`` (by default
+        ``ASTROMETRY_SAVE_REVIEW``) is False.
+        """
+        if save_review is None:
+            save_review = SAVE_REVIEW
+        astrometry = Astrometry(self.file, self.telescope, self.workspace)
+        sources = self.extract_catalog()
+        guess = None
+        if WCS_CACHE:
+            cache = SolutionCache(self.output_root)
+            guess = cache.lookup(self.telescope, self.META['OBJECT'],
+                                 self.header)
+        ladder = SolveLadder(self.output_root, self.telescope)
+        solution, rung = ladder.solve(astrometry, sources, guess,
+                                      self.input_file or self.name)
+        self.metrics.add("solve_field", "attempts", len(ladder.attempts))
+        if guess is not None:
+            self.metrics.add("solve_field", "wcs_cache_hits"
+                             if rung == "verify" else "wcs_cache_misses", 1)
+        if solution is not None and WCS_CACHE:
+            cache.store(self.telescope, self.META['OBJECT'], self.header,
+                        solution, rung == "verify")
 
         # self.logger.info("Successfully performed astrometry on %(img)s",
         #    {"img" : self.name})
 
-        if not img and save_review:
-            REVIEW_DIR = os.path.join(self.output_root, "REVIEW", '{:%Y%m%d}'.format(self.META['DATETIME']))
-            mkdir(REVIEW_DIR)
-            output_file = os.path.join(REVIEW_DIR, self.output_name)
-            with open(output_file, 'w') as f:
-                self.image.writeto(f)
+        if solution is None:
+            if save_review:
+                REVIEW_DIR = os.path.join(self.output_root, "REVIEW", '{:%Y%m%d}'.format(self.META['DATETIME']))
+                mkdir(REVIEW_DIR)
+                output_file = os.path.join(REVIEW_DIR, self.output_name)
+                shutil.copyfile(self.file, output_file)
                 self.output_file = output_file
-            raise AstrometryFailedError("Unable to correct image coordinates.")
+            raise AstrometryFailedError(
+                "Unable to correct image coordinates ({})".format(
+                    ladder.describe()))
 
+        mkdir(self.output_dir)
         output_file = os.path.join(self.output_dir, self.output_name)
-        with open(output_file, 'w') as f:
-            img.writeto(f)
-            self.output_file = output_file
-            img = fits.open(output_file)
-            # This always exists if solve has been run
-            os.remove(astrometry.outpath)
+        write_solved(self.file, output_file,
+                     update_wcs(self.image[0].header, solution))
+        self.output_file = output_file
+        img = fits.open(output_file)
+        self.stage = "solved"
         self.logger.info("Saved wcs-corrected image %(img)s to %(out)s",
                          {"img": self.name,
                           "out": os.path.basename(output_file)})
         return img
 
+    @timed("extract_stars")
     def extract_stars(self, img, *args, **kwargs):
+        """Sources in ``img``, a filepath (read in place) or HDUList."""
         # because the SE star/galaxy classifications are not trustworthy,
         # extract everything for now
         # return SE.extract_stars(img, *args, **kwargs)
-        return Sextractor(img, self.telescope).extract(*args, **kwargs)
+        return Sextractor(img, self.telescope, self.workspace).extract(
+            *args, **kwargs)
 
+    @timed("zeropoint")
     def zeropoint(self, sources):
         threshold = 3
         f = self.META['FILTER']
@@ -199,7 +342,8 @@ class ImageParser(FitsIOMixin, FileLoggerMixin, object):
         """
         img = self.solve_field()
         stellar_sources = self.extract_stars(img, *args, **kwargs)
-        SE = Sextractor(img, self.telescope)
+        SE = Sextractor(img, self.telescope, self.workspace,
+                        check_images=True)
         all_sources = SE.extract( clean_checkfiles=False )
 
         fig0 = plot_one_image(self.image, title='Input Image')
@@ -214,36 +358,69 @@ class ImageParser(FitsIOMixin, FileLoggerMixin, object):
                     c='firebrick', marker='x', s=50)
         plt.show()
 
-    def run(self, skip_astrometry=False, *args, **kwargs):
-        try:
-            self.validate()
-            if not skip_astrometry:
-                sources = self.extract_stars(self.solve_field())
-            else:
-                output_file = os.path.join(self.output_dir, self.output_name)
-                with open(output_file, 'w') as f:
-                    self.image.writeto(f)
-                    self.output_file = output_file
-                sources = self.extract_stars(self.image)
-            self.sources = self.zeropoint(sources)
-            os.remove(self.file)
-            return self.sources
-        except ImageFailedError as e:
+    def solve_and_extract(self, skip_astrometry=False):
+        """Write the wcs-corrected image and return its sources, i.e. the
+        input's catalog with sky positions from the new WCS.
+        """
+        sources = self._unflagged(self.extract_catalog())
+        if not skip_astrometry:
+            img = self.solve_field()
+            sources = reproject(sources, img[0].header)
+            img.close()
+        else:
+            output_file = os.path.join(self.output_dir, self.output_name)
+            # When resuming from our own output, it is already in place.
+            # Otherwise ``self.file`` holds exactly ``self.image``, so a
+            # plain file copy does instead of re-serializing it.
+            if output_file != self.input_file:
+                mkdir(self.output_dir)
+                shutil.copyfile(self.file, output_file)
+            self.output_file = output_file
+            self.stage = "solved"
+        self.stage = "extracted"
+        return sources
+
+    def handle_error(self, e):
+        """Log why this image was dropped from the pipeline."""
+        if isinstance(e, ImageFailedError):
+            self.error = unicode(e)
             self.logger.error("%(img)s encountered an error: %(e)s",
                               {"img": self.name, "e": unicode(e)})
-        except ValidationError as e:
+        elif isinstance(e, ValidationError):
+            self.error = "failed validation: {}".format(e)
             self.logger.error("%(img)s failed validation: %(e)s",
                               {"img": self.name, "e": unicode(e)})
-        except (AstrometryFailedError, TimeoutExpired) as e:
+        elif isinstance(e, (AstrometryFailedError, TimeoutExpired)):
+            self.error = "astrometry failed: {}".format(e)
             self.logger.error(
                 "Failed to run astrometry on %(img)s. Copied to %(out)s",
                 {"img": self.name, "out": self.output_file})
             if isinstance(e, TimeoutExpired):
                 self.logger.error("astrometry timed out on %(img)s: %(e)s",
                                   {"img": self.name, "e": unicode(e)})
-        except Exception as e:
+        else:
             # Handle specific errors
+            self.error = unicode(e)
             self.logger.exception(e)
+
+    def cleanup(self):
+        """Close the image and remove every intermediate file made for it,
+        including the temporary copy of the input image, if one was made.
+        """
+        for hdul in (self._image, self._opened):
+            if hdul is not None:
+                hdul.close()
+        self.workspace.cleanup()
+        self.close_log()
+
+    def run(self, skip_astrometry=False, *args, **kwargs):
+        try:
+            self.validate()
+            sources = self.solve_and_extract(skip_astrometry)
+            self.sources = self.zeropoint(sources)
+            self.stage = "zeropointed"
+            return self.sources
+        except Exception as e:
+            self.handle_error(e)
         finally:
-            if os.path.exists(self.file):
-                os.remove(self.file)
+            self.cleanup()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Escalating solve-field attempts, with timeouts learned from past solves.
+
+Most images solve in seconds given their header pointing and the
+telescope's pixel scale; a few need a wider search, and a very few a blind
+one.  Rather than giving every image one fixed timeout, :class:`SolveLadder`
+tries the rungs of ``settings.ASTROMETRY_LADDER`` in order, each searching
+wider (and allowed longer) than the one before, and only for the images
+the previous rung failed on.  An earlier solution of the field (see
+:mod:`flipp.pipeline.wcscache`) is verified before any of them.
+
+Every attempt is recorded in the state database
+(:class:`flipp.database.state.SolveAttempt`).  Once a rung has enough
+solves for a telescope, its timeout is ``ASTROMETRY_TIMEOUT_FACTOR`` times
+a high percentile of their recent run times, capped by the rung's own
+``"timeout"``, so hopeless attempts are cut short as the pipeline learns.
+``flipp solves`` prints the numbers to tune the ladder from.
+
+Example
+-------
+.. code-block::
+
+    ladder = SolveLadder("/path/to/output", "kait")
+    solution, rung = ladder.solve(astrometry, sources)
+"""
+
+from __future__ import unicode_literals, division
+
+import math
+import time
+
+import numpy as np
+
+from collections import OrderedDict
+
+from subprocess32 import TimeoutExpired
+
+from flipp.database.state import SolveAttempt, get_state_session
+from flipp.conf import settings
+
+LADDER = settings.ASTROMETRY_LADDER
+TIMEOUT_SAMPLES = settings.ASTROMETRY_TIMEOUT_SAMPLES
+TIMEOUT_HISTORY = settings.ASTROMETRY_TIMEOUT_HISTORY
+TIMEOUT_PERCENTILE = settings.ASTROMETRY_TIMEOUT_PERCENTILE
+TIMEOUT_FACTOR = settings.ASTROMETRY_TIMEOUT_FACTOR
+TIMEOUT_MIN = settings.ASTROMETRY_TIMEOUT_MIN
+
+VERIFY = {"name": "verify", "timeout": settings.WCS_VERIFY_CPULIMIT}
+"""The rung that checks a cached solution, ahead of the ladder."""
+
+
+def rung_options(rung, scale_low, scale_high):
+    """solve-field options for ``rung``, given the telescope's pixel scale
+    range; False leaves an option out (see ``Astrometry._run``).
+    """
+    options = {"t": rung.get("tweak", 2)}  # --tweak-order
+    if rung.get("radius") is None:  # Search the whole sky
+        options.update({"3": False, "4": False, "5": False})
+    else:
+        options["5"] = rung["radius"]  # --radius
+    margin = rung.get("scale_margin", 0.)
+    if margin is None:  # Any pixel scale
+        options.update({"u": False, "L": False, "H": False})
+    else:
+        options["L"] = scale_low * (1. - margin)
+        options["H"] = scale_high * (1. + margin)
+    return options
+
+
+def recent_times(session, telescope, rung, n=TIMEOUT_HISTORY):
+    """Run times of the last ``n`` successful attempts of ``rung``."""
+    rows = (session.query(SolveAttempt.elapsed)
+            .filter_by(telescope=telescope, rung=rung, outcome="solved")
+            .order_by(SolveAttempt.pk.desc()).limit(n))
+    return [r.elapsed for r in rows]
+
+
+def learned_timeout(times, rung):
+    """Timeout for ``rung`` given the recent solve ``times``; the rung's
+    own ``"timeout"`` until there are enough of them.
+    """
+    limit = rung["timeout"]
+    if len(times) < TIMEOUT_SAMPLES:
+        return float(limit)
+    t = TIMEOUT_FACTOR * np.percentile(times, TIMEOUT_PERCENTILE)
+    return float(min(limit, max(TIMEOUT_MIN, t)))
+
+
+class SolveLadder(object):
+    """Solve images of ``telescope`` rung by rung, recording every attempt
+    in the state database of ``output_root``.
+    """
+
+    def __init__(self, output_root, telescope, rungs=None):
+        self.output_root = output_root
+        self.telescope = telescope
+        self.rungs = LADDER if rungs is None else rungs
+        self.attempts = []  # (rung, outcome, elapsed) of the last solve
+
+    def _attempt(self, astrometry, sources, rung, guess, timeout):
+        astrometry.timeout = timeout
+        cpulimit = int(math.ceil(timeout))  # The engine stops on its own
+        if rung is VERIFY:
+            return astrometry.verify_xylist(sources, guess, cpulimit)
+        options = rung_options(rung, astrometry.telescope['L'],
+                               astrometry.telescope['H'])
+        options["l"] = cpulimit  # --cpulimit
+        return astrometry.solve_xylist(sources, **options)
+
+    def solve(self, astrometry, sources, guess=None, path=None):
+        """Solve ``sources`` (see ``Astrometry.solve_xylist``) with
+        ``astrometry``, verifying ``guess`` (a WCS header) first if given.
+
+        Returns
+        -------
+        (solution, rung) : (astropy.io.fits.Header or None, str or None)
+            the solution and the name of the rung that found it.
+        """
+        rungs = ([VERIFY] if guess is not None else []) + list(self.rungs)
+        self.attempts = []
+        session = get_state_session(self.output_root)
+        try:
+            for rung in rungs:
+                name = rung["name"]
+                timeout = learned_timeout(
+                    recent_times(session, self.telescope, name), rung)
+                start = time.time()
+                try:
+                    solution = self._attempt(astrometry, sources, rung,
+                                             guess, timeout)
+                    outcome = "solved" if solution is not None else "failed"
+                except TimeoutExpired:
+                    solution, outcome = None, "timeout"
+                elapsed = time.time() - start
+                self.attempts.append((name, outcome, elapsed))
+                session.add(SolveAttempt(
+                    path=path, telescope=self.telescope, rung=name,
+                    outcome=outcome, elapsed=elapsed, timeout=timeout,
+                    created=time.time()))
+                if solution is not None:
+                    return solution, name
+            return None, None
+        finally:
+            session.commit()
+            session.close()
+
+    def describe(self):
+        """The attempts of the last solve, e.g. "narrow: timeout, ..."."""
+        return ", ".join("{}: {}".format(name, outcome)
+                         for name, outcome, _ in self.attempts)
+
+
+def summarize_attempts(output_root):
+    """Text table of attempts by telescope and rung: how often each
+    solved, how long solves took and the timeout it would get now.
+    """
+    rungs = {r["name"]: r for r in [VERIFY] + list(LADDER)}
+    session = get_state_session(output_root)
+    try:
+        groups = OrderedDict()
+        for row in session.query(SolveAttempt).order_by(SolveAttempt.pk):
+            groups.setdefault((row.telescope, row.rung), []).append(row)
+        if not groups:
+            return ""
+        lines = ["{:<10} {:<8} {:>7} {:>7} {:>8} {:>9} {:>9} {:>9}".format(
+            "telescope", "rung", "n", "solved", "timeouts", "solve p50",
+            "solve p95", "timeout")]
+        for (telescope, name), rows in sorted(groups.items()):
+            times = [r.elapsed for r in rows if r.outcome == "solved"]
+            p50, p95 = (np.percentile(times, (50, 95)) if times
+                        else (np.nan, np.nan))
+            timeout = (learned_timeout(times[::-1][:TIMEOUT_HISTORY],
+                                       rungs[name])
+                       if name in rungs else np.nan)
+            lines.append(
+                "{:<10} {:<8} {:>7d} {:>7.0%} {:>8d} {:>9.1f} {:>9.1f} "
+                "{:>9.1f}".format(
+                    telescope, name, len(rows), len(times) / len(rows),
+                    sum(r.outcome == "timeout" for r in rows), p50, p95,
+                    timeout))
+        return "\n".join(lines)
+    finally:
+        session.close()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent record of every input file the pipeline has processed, so that a
+rerun over an archive (``flipprun --resume``) only does the work that is
+left.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import time
+import hashlib
+
+from flipp.database.state import ProcessedFile, get_state_session
+
+# Stages after which the wcs-corrected image exists in the output directory,
+# so a failed image can pick up from there instead of re-solving.
+RESUMABLE_STAGES = ("solved", "extracted", "zeropointed")
+
+
+def fingerprint(path, checksum=False):
+    """(size, mtime, sha1-or-None) identifying the current contents of
+    ``path``.
+    """
+    st = os.stat(path)
+    digest = None
+    if checksum:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+    return st.st_size, st.st_mtime, digest
+
+
+class Manifest(object):
+    """What happened the last time each input file went through the
+    pipeline.
+
+    Entries are loaded with a single query up front and updates are
+    committed in batches, so checking tens of thousands of files costs a
+    ``stat`` each rather than a database round trip.
+
+    Example
+    -------
+    .. code-block::
+
+        manifest = Manifest("/path/to/output")
+        action, entry = manifest.plan("/path/to/image.fits")
+        ...
+        manifest.record(result)
+        manifest.flush()
+    """
+
+    commit_every = 50
+
+    def __init__(self, output_root, checksum=False):
+        self.checksum = checksum
+        self.session = get_state_session(output_root)
+        self.entries = {e.path: e for e in
+                        self.session.query(ProcessedFile)}
+        self._pending = 0
+
+    def _matches(self, entry, fp):
+        size, mtime, digest = fp
+        if self.checksum and entry.checksum:
+            return entry.checksum == digest
+        return entry.size == size and entry.mtime == mtime
+
+    def plan(self, path):
+        """Decide what to do with ``path``.
+
+        Returns
+        -------
+        (action, entry) : (str, ProcessedFile or None)
+            action is "skip" (already done, or rejected in triage, and
+            unchanged since),
+            "resume" (failed after astrometry; restart from ``entry.output_file``)
+            or "process" (new, changed, or failed before astrometry finished).
+        """
+        entry = self.entries.get(path)
+        if entry is None:
+            return "process", None
+        if not self._matches(entry, fingerprint(path, self.checksum)):
+            return "process", entry
+        if entry.outcome in ("done", "rejected"):
+            return "skip", entry
+        if (entry.stage in RESUMABLE_STAGES and entry.output_file and
+                os.path.exists(entry.output_file)):
+            return "resume", entry
+        return "process", entry
+
+    def record(self, result):
+        """Store an :class:`flipp.pipeline.results.ImageResult`."""
+        path = result.path
+        try:
+            size, mtime, digest = fingerprint(path, self.checksum)
+        except OSError:  # Input vanished in the meantime
+            return
+        entry = self.entries.get(path)
+        if entry is None:
+            entry = ProcessedFile(path=path)
+            self.session.add(entry)
+            self.entries[path] = entry
+        entry.size = size
+        entry.mtime = mtime
+        entry.checksum = digest
+        # A killed worker can't tell us how far it got
+        if result.stage or result.status not in ("crashed", "timeout"):
+            entry.stage = result.stage
+        entry.outcome = result.status
+        entry.output_file = result.output_file or entry.output_file
+        entry.message = (result.message or "")[:999]
+        entry.updated = time.time()
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        self.session.commit()
+        self._pending = 0
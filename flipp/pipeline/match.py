@@ -3,65 +3,52 @@
 from __future__ import unicode_literals
 
 import os
+import uuid
 import numpy as np
 
-from flipp.database import engine, models
+from flipp.database import engine, models, check_sources_indexed
+from flipp.libs import healpix
+from flipp.libs.crossmatch import Catalog, bounding_cone, match
+from flipp.pipeline.metrics import timed
 
-from astropy.coordinates import SkyCoord
-from astropy import units
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import func, text
+from sqlalchemy import or_, func
 
 Session = sessionmaker(bind=engine)
 
 
+def sky_cone(ra, dec, radius):
+    """Filter for Sources in the HEALPix pixels covering the cone of
+    ``radius`` degrees (a superset of it), as a few range scans of the
+    ``hpix`` index; RA = 0 and the poles need no special casing.
+    """
+    return or_(*[models.Source.hpix.between(start, stop - 1)
+                 for start, stop in healpix.cone_ranges(
+                     models.HPIX_NSIDE, ra, dec, radius)])
+
+
 class SourceMatcher(object):
+    """Ingest the zeropointed sources of an image: each is matched to a
+    known Source within ``tolerance`` arcseconds, or becomes a new one, and
+    gets an Observation in this image.
+
+    :meth:`run` does the whole image in bulk: every known Source in the
+    image footprint is loaded in one query and matched in memory, and the
+    new Sources and the Observations are bulk inserted in one transaction.
+    """
+
+    tolerance = 10.0  # arcseconds
 
     def __init__(self, imgparser):
+        check_sources_indexed(engine)
         self.img = imgparser
         self.logger = imgparser.logger
         self.sources = imgparser.sources
         self.telescope = imgparser.telescope
         self.meta = imgparser.META
+        self.metrics = imgparser.metrics
         self.session = Session()
 
-    def find_or_create_source(self, source, tolerance=10.0):
-        ra = source['ALPHA_J2000']
-        dec = source['DELTA_J2000']
-        # calculate rough extreme RA/Decl pairs to use in query
-        t = (2*tolerance)/(3600.0) # in degrees
-        raMin = ra - t/np.cos(np.deg2rad(dec))
-        raMax = ra + t/np.cos(np.deg2rad(dec))
-        decMin = dec - t
-        decMax = dec + t
-        dist = func.sqrt(func.pow(models.Source.ra - ra, 2) +
-                         func.pow(models.Source.decl - dec, 2))
-        objects = self.session.query(models.Source).filter(
-                    models.Source.ra.between(raMin,raMax),
-                    models.Source.decl.between(decMin,decMax)).order_by(dist)
-        obj = None
-        created = False
-        if not objects.count() == 0:
-            o = objects.first()
-            c_source = SkyCoord(ra=[ra*units.degree],dec=[dec*units.degree])
-            c_object = SkyCoord(ra=[o.ra*units.degree],dec=[o.decl*units.degree])
-            idx, sep2d, dist3d = c_source.match_to_catalog_sky( c_object )
-            if sep2d[0] <= tolerance*units.arcsecond:
-                obj = o
-        if not obj:
-            obj = self.create_source(source)
-            created = True
-        return obj, created
-
-    def create_source(self, source, name="", classification=""):
-        ra = source['ALPHA_J2000']
-        dec = source['DELTA_J2000']
-        s = models.Source(
-            ra=ra, decl=dec, name=name, classification=classification)
-        self.session.add(s)
-        self.session.commit()
-        return s
-
     def get_or_create_image(self):
         # self.session.query(models.Image).filter(name=)
         created = False
@@ -75,37 +62,123 @@ class SourceMatcher(object):
             q.update(mjd = round(self.meta['MJD'], 5))
             img = models.Image(**q)
             self.session.add(img)
-            self.session.commit()
+            self.session.flush()  # For its pk; committed by the caller
             created = True
             #self.logger.info('Created new database entries for %(img)s', {'img':os.path.basename(img.name)})
         return created, img
 
-    def add_observation(self, source, obj):
+    @timed("footprint_query")
+    def known_sources(self, ra, dec):
+        """(pk, ra, decl) arrays of the Sources that may match ``ra``,
+        ``dec``: those in a cone around the image footprint.
+        """
+        t = (2*self.tolerance)/(3600.0) # in degrees
+        ra_c, dec_c, radius = bounding_cone(ra, dec)
+        rows = self.session.query(
+            models.Source.pk, models.Source.ra, models.Source.decl).filter(
+                sky_cone(ra_c, dec_c, radius + t)).all()
+        if not rows:
+            return np.empty(0, int), np.empty(0), np.empty(0)
+        pk, known_ra, known_dec = zip(*rows)
+        return (np.asarray(pk), np.asarray(known_ra, dtype=float),
+                np.asarray(known_dec, dtype=float))
+
+    @timed("match")
+    def match_sources(self, ra, dec):
+        """For every detection, the pk of the known Source it matches or
+        None, and for unmatched ones the index of the detection whose new
+        Source it joins (itself, unless an earlier one is within the
+        tolerance, as if the detections had been ingested one by one).
+        """
+        tolerance = self.tolerance/3600.0
+        pk, known_ra, known_dec = self.known_sources(ra, dec)
+        idx, sep = Catalog(known_ra, known_dec).nearest(ra, dec, tolerance)
+        matched = [pk[i] if i >= 0 else None for i in idx]
+        new = np.flatnonzero(idx < 0)
+        owner = {}  # New detection -> detection whose Source it joins
+        if len(new):
+            neighbours = Catalog(ra[new], dec[new]).within(ra[new], dec[new],
+                                                           tolerance)
+            for k, near in zip(new, neighbours):
+                earlier = [new[j] for j in near
+                           if new[j] < k and owner[new[j]] == new[j]]
+                if earlier:
+                    i = match([ra[k]], [dec[k]], ra[earlier], dec[earlier],
+                              tolerance)[0][0]
+                    owner[k] = earlier[i]
+                else:
+                    owner[k] = k
+        return matched, owner
+
+    def new_sources(self, token, after):
+        """{detection index: pk} of the Sources inserted under ``token``
+        (see :meth:`insert`), whose pks are all above ``after``.
+        """
+        rows = self.session.query(models.Source.pk, models.Source.name).filter(
+            models.Source.pk > after,
+            models.Source.name.startswith(token + ":"))
+        return {int(name.rpartition(":")[2]): pk for pk, name in rows}
+
+    @timed("insert")
+    def insert(self, sources, matched, owner):
+        """Bulk insert the new Sources and the Observations of the image in
+        one transaction.
+
+        The Sources go in as one executemany; asking for their pks back
+        (``return_defaults``) would make most drivers insert them one row
+        at a time.  Instead each is named after this batch and its
+        detection, found again by that name among the pks above the
+        previous maximum, and its name cleared, before anything commits.
+        """
         img_created, img = self.get_or_create_image()
-        q = {
-            'source' : obj.pk,
-            'image' : img.pk,
-        }
-        if not self.session.query(models.Observation).filter_by(**q).first():
-            q.update({
-                    'magnitude' : source['MAG_AUTO_ZP'],
-                    'error' : source['MAGERR_AUTO_ZP']
-                    })
-            obs = models.Observation(**q)
-            self.session.add(obs)
-            self.session.commit()
-
+        creators = sorted(k for k, v in owner.items() if k == v)
+        new_pk = {}
+        if creators:
+            ra = np.asarray(sources['ALPHA_J2000'], dtype=float)[creators]
+            dec = np.asarray(sources['DELTA_J2000'], dtype=float)[creators]
+            hpix = healpix.nested(models.HPIX_NSIDE, ra, dec)
+            after = self.session.query(
+                func.max(models.Source.pk)).scalar() or 0
+            token = "ingest-{}".format(uuid.uuid4().hex)
+            self.session.bulk_insert_mappings(models.Source, [
+                {'ra': float(r), 'decl': float(d), 'hpix': int(h),
+                 'name': "{}:{}".format(token, k), 'classification': ""}
+                for k, r, d, h in zip(creators, ra, dec, hpix)])
+            new_pk = self.new_sources(token, after)
+            self.session.query(models.Source).filter(
+                models.Source.pk > after,
+                models.Source.name.startswith(token + ":")).update(
+                    {'name': ""}, synchronize_session=False)
+        seen = set(pk for pk, in self.session.query(
+            models.Observation.source).filter_by(image=img.pk))
+        observations = []
+        for k, pk in enumerate(matched):
+            if pk is None:
+                pk = new_pk[owner[k]]
+            if pk in seen:  # Already observed in this image
+                continue
+            seen.add(pk)
+            observations.append({'source': int(pk), 'image': img.pk,
+                                 'magnitude': float(sources['MAG_AUTO_ZP'][k]),
+                                 'error': float(sources['MAGERR_AUTO_ZP'][k])})
+        self.session.bulk_insert_mappings(models.Observation, observations)
+        self.session.commit()
 
     def run(self):
-        n_updated = 0
-        n_created = 0
-        for source in self.sources:
-            obj, created = self.find_or_create_source(source)
-            if created:
-                n_created += 1
-            else:
-                n_updated += 1
-            self.add_observation(source, obj)
+        sources = self.sources
+        ra = np.asarray(sources['ALPHA_J2000'], dtype=float)
+        dec = np.asarray(sources['DELTA_J2000'], dtype=float)
+        if not len(ra):
+            return 0, 0
+        try:
+            matched, owner = self.match_sources(ra, dec)
+            self.insert(sources, matched, owner)
+        except Exception:
+            self.session.rollback()
+            raise
+        finally:
+            self.session.close()
+        n_created = sum(1 for k, v in owner.items() if k == v)
+        n_updated = len(matched) - n_created
         self.logger.info('Added %(nc)s new sources to database and updated photometry for %(nu)s others', {'nu':n_updated, 'nc':n_created})
         return n_updated, n_created
-
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing and resource accounting for the pipeline.
+
+Every :class:`flipp.pipeline.image.ImageParser` carries a
+:class:`StageMetrics`; each stage it runs (and each database call made by
+:class:`flipp.pipeline.match.SourceMatcher`) is wrapped in
+``metrics.stage(name)``, which records:
+
+- ``wall`` : elapsed seconds
+- ``cpu`` : user+system seconds of this process
+- ``subprocess`` : user+system seconds of finished child processes
+  (solve-field, sextractor)
+- ``maxrss_kb`` : peak resident memory so far, of this process or any child
+- ``read_bytes``/``write_bytes`` : bytes read/written by this process
+  (``/proc/self/io``, Linux only) plus block I/O of children
+
+A stage that runs inside another -- ``sextractor`` is first run from
+``validate`` or ``solve_field``, ``load`` from whichever stage needs the
+pixels -- is counted only under its own name: the enclosing stage records
+what it used outside of it, so the stages of an image add up to its total
+rather than counting the inner work twice.
+
+Stages can also carry counters of their own (:meth:`StageMetrics.add`),
+e.g. ``check_bytes_avoided`` for the check images sextractor no longer
+writes; :func:`total` sums one over a batch.
+
+Note that CPU and I/O counters are per process, so with ``--staged`` (where
+images share one process) they include whatever the other threads did.
+"""
+
+from __future__ import unicode_literals
+
+import json
+import time
+import resource
+import functools
+
+import numpy as np
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+FIELDS = ("wall", "cpu", "subprocess", "maxrss_kb", "read_bytes",
+          "write_bytes")
+
+
+def _proc_io():
+    try:
+        with open("/proc/self/io") as f:
+            d = dict(line.split(":") for line in f)
+        return int(d["rchar"]), int(d["wchar"])
+    except (IOError, OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def snapshot():
+    """Current values of the counters :class:`StageMetrics` tracks."""
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+    rchar, wchar = _proc_io()
+    return {"wall": time.time(),
+            "cpu": me.ru_utime + me.ru_stime,
+            "subprocess": kids.ru_utime + kids.ru_stime,
+            "maxrss_kb": max(me.ru_maxrss, kids.ru_maxrss),
+            "read_bytes": rchar + kids.ru_inblock * 512,
+            "write_bytes": wchar + kids.ru_oublock * 512,
+            }
+
+
+class StageMetrics(object):
+    """Resource usage accumulated per named stage.
+
+    Example
+    -------
+    .. code-block::
+
+        metrics = StageMetrics()
+        with metrics.stage("solve_field"):
+            ...
+        metrics.as_dict()
+        # {"solve_field": {"calls": 1, "wall": 12.1, "cpu": 0.2, ...}}
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self._inner = []  # Usage of the stages nested in each open one
+
+    def _get(self, name):
+        return self.stages.setdefault(
+            name, OrderedDict([("calls", 0)] + [(k, 0) for k in FIELDS]))
+
+    @contextmanager
+    def stage(self, name):
+        before = snapshot()
+        inner = dict.fromkeys(FIELDS, 0)
+        self._inner.append(inner)
+        try:
+            yield
+        finally:
+            after = snapshot()
+            self._inner.pop()
+            s = self._get(name)
+            s["calls"] += 1
+            for k in FIELDS:
+                if k == "maxrss_kb":
+                    s[k] = max(s[k], after[k])
+                else:
+                    used = after[k] - before[k]
+                    s[k] += used - inner[k]
+                    if self._inner:  # Not the enclosing stage's to count
+                        self._inner[-1][k] += used
+
+    def add(self, name, key, value):
+        """Add ``value`` to the counter ``key`` of stage ``name``."""
+        s = self._get(name)
+        s[key] = s.get(key, 0) + value
+
+    def as_dict(self):
+        return OrderedDict((k, dict(v)) for k, v in self.stages.items())
+
+
+def timed(name):
+    """Method decorator recording calls under ``self.metrics.stage(name)``."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.stage(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class MetricsLog(object):
+    """Append one JSON record per image to ``path``."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, result):
+        record = OrderedDict([("path", result.path),
+                              ("status", result.status),
+                              ("elapsed", result.elapsed),
+                              ("timestamp", time.time()),
+                              ("stages", result.metrics or {})])
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def total(results, key):
+    """Sum of the counter ``key`` over every stage of every result."""
+    return sum(s.get(key, 0) for r in results
+               for s in (r.metrics or {}).values())
+
+
+def summarize_metrics(results, percentiles=(50, 90, 99)):
+    """Text table of per-stage percentiles over a batch of results."""
+    by_stage = OrderedDict()
+    for r in results:
+        for name, s in (r.metrics or {}).items():
+            by_stage.setdefault(name, []).append(s)
+    if not by_stage:
+        return ""
+    head = "{:<22} {:>6} ".format("stage", "n") + " ".join(
+        "{:>9}".format("wall p{}".format(p)) for p in percentiles) + \
+        " {:>9} {:>9} {:>9} {:>10}".format("cpu p50", "subp p50", "total",
+                                            "MB r/w p50")
+    lines = [head]
+    for name, stats in by_stage.items():
+        wall = np.array([s["wall"] for s in stats])
+        cpu = np.array([s["cpu"] for s in stats])
+        subp = np.array([s["subprocess"] for s in stats])
+        rw = np.array([s["read_bytes"] + s["write_bytes"]
+                       for s in stats]) / 1e6
+        lines.append(
+            "{:<22} {:>6d} ".format(name, len(stats)) + " ".join(
+                "{:>9.3f}".format(v) for v in np.percentile(wall, percentiles))
+            + " {:>9.3f} {:>9.3f} {:>9.1f} {:>10.2f}".format(
+                np.median(cpu), np.median(subp), wall.sum(), np.median(rw)))
+    return "\n".join(lines)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+A small process pool for running whole images in parallel.
+
+``multiprocessing.Pool`` hangs forever when a worker dies (segfaults in
+astropy/numpy, the OOM killer, ...) and has no per-task timeout, so instead
+we fork one short-lived process per image.  Each worker runs in its own
+process group, which lets a timeout take down the solve-field and sextractor
+subprocesses it spawned along with it.  Forking from the parent means the
+heavy imports (astropy, matplotlib, sqlalchemy) are paid only once.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import time
+import signal
+import traceback
+import multiprocessing
+
+
+def _worker(conn, initializer, func, args, kwargs):
+    """Entry-point of a forked worker: run ``func`` and report back."""
+    try:
+        os.setpgrp()
+    except OSError:
+        pass
+    try:
+        if initializer is not None:
+            initializer()
+        msg = ("ok", func(*args, **kwargs))
+    except BaseException:
+        msg = ("error", traceback.format_exc())
+    try:
+        conn.send(msg)
+    finally:
+        conn.close()
+
+
+class WorkerPool(object):
+    """Run callables in at most ``jobs`` forked processes at a time.
+
+    Results come back as ``(key, status, value)`` tuples, where status is
+    one of "ok" (value is the return value), "error" (value is the
+    traceback), "crashed" (value is the exit code) or "timeout" (value is
+    the elapsed time).  A failure in one task never affects the others.
+
+    Example
+    -------
+    .. code-block::
+
+        pool = WorkerPool(jobs=8, timeout=600)
+        for key, status, value in pool.imap_unordered(process_image, tasks):
+            print(key, status)
+    """
+
+    poll_interval = 0.05
+
+    def __init__(self, jobs=1, timeout=None, initializer=None):
+        self.jobs = max(1, int(jobs))
+        self.timeout = timeout
+        self.initializer = initializer
+        self._running = {}
+
+    def __len__(self):
+        return len(self._running)
+
+    @property
+    def full(self):
+        return len(self._running) >= self.jobs
+
+    def submit(self, key, func, *args, **kwargs):
+        """Start ``func(*args, **kwargs)`` in a new worker process."""
+        recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+        p = multiprocessing.Process(
+            target=_worker,
+            args=(send_conn, self.initializer, func, args, kwargs))
+        p.daemon = False  # workers may themselves spawn subprocesses
+        p.start()
+        send_conn.close()
+        self._running[key] = (p, recv_conn, time.time())
+
+    def _kill(self, p):
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:  # Worker never made it to setpgrp
+            p.terminate()
+        p.join()
+
+    def collect(self, block=True):
+        """Return the tasks that finished since the last call.
+
+        If ``block`` is set, wait until at least one task finishes (unless
+        nothing is running).
+        """
+        while True:
+            finished = []
+            for key, (p, conn, started) in list(self._running.items()):
+                result = None
+                if conn.poll():
+                    try:
+                        result = conn.recv()
+                    except EOFError:
+                        p.join()
+                        result = ("crashed", p.exitcode)
+                    else:
+                        p.join()
+                elif not p.is_alive():
+                    p.join()
+                    result = ("crashed", p.exitcode)
+                elif self.timeout and time.time() - started > self.timeout:
+                    self._kill(p)
+                    result = ("timeout", time.time() - started)
+                if result is not None:
+                    conn.close()
+                    del self._running[key]
+                    finished.append((key,) + tuple(result))
+            if finished or not block or not self._running:
+                return finished
+            time.sleep(self.poll_interval)
+
+    def terminate(self):
+        """Kill every running worker (and its subprocesses)."""
+        for key, (p, conn, started) in list(self._running.items()):
+            self._kill(p)
+            conn.close()
+        self._running.clear()
+
+    def imap_unordered(self, func, tasks):
+        """Run ``func(*args)`` for every ``(key, args)`` in ``tasks``,
+        yielding results in completion order.  ``tasks`` is consumed lazily,
+        so it can be a generator over a very large archive.
+        """
+        tasks = iter(tasks)
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and not self.full:
+                    try:
+                        key, args = next(tasks)
+                    except StopIteration:
+                        exhausted = True
+                    else:
+                        self.submit(key, func, *args)
+                if exhausted and not self._running:
+                    return
+                for result in self.collect(block=True):
+                    yield result
+        finally:
+            self.terminate()
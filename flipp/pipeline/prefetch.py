@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Warm the APASS tile cache for a batch of images before processing it.
+
+Every frame's pointing is in its header, so the catalog stars a night's
+zeropoints need are known before the first image is extracted.
+:func:`prefetch` reads only the headers, works out the field each image
+covers from its pointing, size and the telescope's pixel scale, and merges
+the fields into the set of :mod:`flipp.libs.refcache` tiles they overlap --
+one request per tile however many images share it -- which are then
+fetched ``APASS_PREFETCH_JOBS`` at a time over one pooled HTTP session
+(see ``flipp.libs.apass.Client.session``).  Tiles already cached, and
+fresh, are not fetched again.
+
+Example
+-------
+.. code-block::
+
+    prefetch(["/path/to/night/"], jobs=8)
+"""
+
+from __future__ import unicode_literals, print_function, division
+
+import numpy as np
+
+from flipp.libs.astrometry import pointing
+from flipp.libs.fileio import read_header
+from flipp.libs.refcache import tiles_for_cone
+from flipp.libs.refcat import get_catalog
+from flipp.libs.utils import FitsIOMixin
+from flipp.conf import settings
+
+PREFETCH_JOBS = settings.APASS_PREFETCH_JOBS
+PREFETCH_MARGIN = settings.APASS_PREFETCH_MARGIN
+
+
+def field_cone(header, telescope=None, margin=PREFETCH_MARGIN):
+    """(ra, dec, radius) in degrees of a cone around the whole image, from
+    its header pointing and size and the telescope's largest pixel scale;
+    None if the header does not say.
+    """
+    where = pointing(header)
+    if where is None:
+        return None
+    try:
+        telescope = telescope or FitsIOMixin().get_telescope(header)
+        scale = settings.TELESCOPES[telescope]["ASTROMETRY_OPTIONS"]["H"]
+        diagonal = np.hypot(header["NAXIS1"], header["NAXIS2"])
+    except (KeyError, ValueError):
+        return None
+    return where[0], where[1], diagonal / 2. * scale / 3600. + margin
+
+
+def plan_tiles(paths, telescope=None):
+    """The tiles overlapping the fields of the images ``paths``.
+
+    Returns
+    -------
+    (tiles, n_fields, unusable) : (set, int, list)
+        the tiles, the number of images they cover and the paths whose
+        field could not be worked out.
+    """
+    tiles, n, unusable = set(), 0, []
+    for path in paths:
+        try:
+            cone = field_cone(read_header(path), telescope)
+        except IOError:
+            cone = None
+        if cone is None:
+            unusable.append(path)
+            continue
+        tiles.update(tiles_for_cone(*cone))
+        n += 1
+    return tiles, n, unusable
+
+
+def prefetch(paths, telescope=None, jobs=PREFETCH_JOBS, cache=None):
+    """Fetch the APASS tiles of the images ``paths`` that are not cached
+    yet, ``jobs`` at a time.  Returns the number fetched and failed.
+    """
+    cache = cache or get_catalog()
+    if not hasattr(cache, "prefetch"):  # Not the "cache" REFCAT
+        print("APASS prefetch: nothing to do for REFCAT {!r}".format(
+            settings.REFCAT))
+        return 0, 0
+    tiles, n, unusable = plan_tiles(paths, telescope)
+    fetched, failed = cache.prefetch(tiles, jobs)
+    print("APASS prefetch: {} field(s) in {} tile(s); {} fetched, {} failed, "
+          "{} already cached".format(n, len(tiles), fetched, failed,
+                                     len(tiles) - fetched - failed))
+    if unusable:
+        print("No pointing or field size for {} image(s), e.g. {}".format(
+            len(unusable), unusable[0]))
+    return fetched, failed
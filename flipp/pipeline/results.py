@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Per-image outcomes reported by the pipeline entry-points."""
+
+from __future__ import unicode_literals
+
+from collections import namedtuple, Counter
+
+
+_ImageResult = namedtuple("ImageResult", ("path", "status", "n_created",
+                                          "n_updated", "message", "elapsed",
+                                          "stage", "output_file", "metrics"))
+
+
+class ImageResult(_ImageResult):
+    """Outcome of pushing a single image through the pipeline.
+
+    ``status`` is one of :data:`STATUSES`; ``message`` holds the reason for
+    anything that did not finish as "done".  ``stage`` is the last pipeline
+    stage the image completed and ``output_file`` its wcs-corrected image,
+    if one was written.  ``metrics`` holds the per-stage resource usage of
+    :class:`flipp.pipeline.metrics.StageMetrics`.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, path, status, n_created=0, n_updated=0, message="",
+                elapsed=0., stage=None, output_file=None, metrics=None):
+        return super(ImageResult, cls).__new__(
+            cls, path, status, n_created, n_updated, message, elapsed,
+            stage, output_file, metrics)
+
+    @classmethod
+    def from_worker(cls, path, status, value):
+        """Build a result from a :class:`flipp.pipeline.pool.WorkerPool`
+        ``(key, status, value)`` triple for ``process_image``.
+        """
+        if status == "ok":
+            return value._replace(path=path)
+        elif status == "error":
+            return cls(path, "error", message=value)
+        elif status == "crashed":
+            return cls(path, "crashed",
+                       message="worker exited with code {}".format(value))
+        return cls(path, "timeout", message="killed after {:.0f}s".format(value),
+                   elapsed=value)
+
+    @property
+    def ok(self):
+        return self.status == "done"
+
+    def __unicode__(self):
+        line = "[{0}] {1} ({2:.1f}s)".format(self.status, self.path,
+                                             self.elapsed)
+        if self.ok:
+            line += " created {0}, updated {1}".format(self.n_created,
+                                                        self.n_updated)
+        elif self.message:
+            line += " : {0}".format(self.message)
+        return line
+
+    def __str__(self):
+        return str(unicode(self))
+
+
+STATUSES = ("done",     # made it into the database
+            "failed",   # pipeline rejected the image (logged in its log file)
+            "rejected", # failed pre-flight triage (see flipp_rejected.tsv)
+            "error",    # unhandled exception in the pipeline
+            "crashed",  # worker process died without reporting back
+            "timeout",  # worker process exceeded the per-image timeout
+            "skipped",  # already done in an earlier run (see --resume)
+            )
+
+
+def summarize(results):
+    """One-line count of results by status."""
+    counts = Counter(r.status for r in results)
+    parts = ["{0} {1}".format(counts[s], s) for s in STATUSES if counts[s]]
+    return "Processed {0} images: {1}".format(sum(counts.values()),
+                                              ", ".join(parts) or "none")
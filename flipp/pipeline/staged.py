@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+Staged pipeline: each step of :func:`flipp.pipeline.process_image` gets its
+own pool of workers, connected by bounded queues.
+
+The stages have very different cost profiles -- triage reads the header
+and a sample of the pixels in-process, extraction and astrometry are
+CPU-bound subprocesses (sextractor, then solve-field on its catalog, by far
+the slowest step), zeropointing waits on the APASS web service, and ingest
+is bound by database locks -- so sizing them independently keeps the
+solvers busy while a slow APASS response is outstanding.  Each stage does
+only the work its name says, so its ``PIPELINE_STAGE_WORKERS`` entry and
+its throughput in the progress reports describe that one cost.  Bounded queues provide backpressure: a stage that falls behind
+stalls the stages feeding it instead of piling decoded images up in memory.
+
+The heavy lifting of every stage happens in subprocesses, sockets or the
+database driver, all of which release the GIL, so the workers are threads;
+this also lets an image's ``ImageParser`` move between stages without being
+pickled.  Note that the ingest stage opens its own database connection, so
+it needs a real database server (an in-memory "sqlite://" DB_URL is only
+visible to the thread that created it).
+
+Example
+-------
+.. code-block::
+
+    pipeline = StagedPipeline.default("/path/to/output", telescope="kait",
+                                      workers={"solve": 16})
+    results = pipeline.run(iter_input_files(["/path/to/night/"]))
+"""
+
+from __future__ import unicode_literals
+
+import time
+import threading
+
+from Queue import Queue, Empty
+
+from flipp.pipeline.image import ImageParser
+from flipp.pipeline.triage import FrameRejected
+from flipp.pipeline.match import SourceMatcher
+from flipp.pipeline.results import ImageResult
+
+from flipp.conf import settings
+
+_DONE = object()  # Sentinel telling a stage's workers to shut down
+
+
+class _Job(object):
+    """An image travelling through the stages."""
+
+    def __init__(self, path, source=None, skip_astrometry=None):
+        self.path = path
+        self.source = source or path  # File actually processed
+        self.skip_astrometry = skip_astrometry
+        self.parser = None
+        self.sources = None
+        self.started = time.time()
+
+
+class Stage(object):
+    """A named step with ``workers`` threads pulling from a bounded queue.
+
+    ``func`` takes a job and updates it in place; if it raises, the job is
+    dropped from the pipeline and reported as failed.
+    """
+
+    def __init__(self, name, func, workers=1, maxsize=8):
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+        self.queue = Queue(maxsize=maxsize)
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0  # Workers currently inside ``func``
+        self.busy_time = 0.
+        self._lock = threading.Lock()
+
+    def stats(self, elapsed):
+        """Snapshot of this stage's queue depth and throughput."""
+        with self._lock:
+            return {"stage": self.name,
+                    "workers": self.workers,
+                    "queued": self.queue.qsize(),
+                    "busy": self.busy,
+                    "processed": self.processed,
+                    "failed": self.failed,
+                    "throughput": self.processed / elapsed if elapsed else 0.,
+                    "utilization": (self.busy_time /
+                                    (elapsed * self.workers)
+                                    if elapsed else 0.),
+                    }
+
+
+class StagedPipeline(object):
+    """Run jobs through a sequence of :class:`Stage` objects."""
+
+    report_interval = 30.  # Seconds between progress reports
+
+    def __init__(self, stages, finish=None, on_result=None):
+        self.stages = stages
+        self.finish = finish
+        self.on_result = on_result
+        self.started = None
+        self._results = Queue()
+        self._threads = []
+        self._alive = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def default(cls, path_to_output, telescope=None, skip_astrometry=False,
+                workers=None, maxsize=None, on_result=None):
+        """The standard triage / extract / solve / zeropoint / ingest
+        pipeline.
+
+        ``workers`` maps stage names to pool sizes, falling back to
+        ``settings.PIPELINE_STAGE_WORKERS`` (and to 1).
+        """
+        sizes = dict(settings.PIPELINE_STAGE_WORKERS)
+        sizes.update(workers or {})
+        maxsize = maxsize or settings.PIPELINE_STAGE_QUEUE_SIZE
+
+        def triage(job):
+            job.parser = ImageParser(job.source, path_to_output, telescope)
+            job.parser.triage()
+            # In-process, unless VALIDATION_DETECTOR is "sextractor"
+            job.parser.validate()
+
+        def extract(job):
+            job.parser.extract_catalog()
+
+        def solve(job):
+            skip = job.skip_astrometry
+            if skip is None:
+                skip = skip_astrometry
+            job.sources = job.parser.solve_and_extract(skip)
+
+        def zeropoint(job):
+            job.parser.sources = job.parser.zeropoint(job.sources)
+            job.parser.stage = "zeropointed"
+            job.sources = None
+
+        def ingest(job):
+            n_updated, n_created = SourceMatcher(job.parser).run()
+            job.parser.stage = "ingested"
+            return ImageResult(job.path, "done", n_created, n_updated)
+
+        stages = [Stage(name, func, sizes.get(name, 1), maxsize)
+                  for name, func in (("triage", triage),
+                                     ("extract", extract),
+                                     ("solve", solve),
+                                     ("zeropoint", zeropoint),
+                                     ("ingest", ingest))]
+        return cls(stages, finish=cls._finish, on_result=on_result)
+
+    @staticmethod
+    def _finish(job, result, exc):
+        """Default per-job wrap-up: log failures and drop the temp copy."""
+        if job.parser is None:
+            return ImageResult(job.path, "error", message=unicode(exc))
+        if isinstance(exc, FrameRejected):
+            result = ImageResult(job.path, "rejected", message=unicode(exc))
+        elif exc is not None:
+            job.parser.handle_error(exc)
+            result = ImageResult(job.path, "failed",
+                                 message=job.parser.error)
+        job.parser.cleanup()
+        return result._replace(stage=job.parser.stage,
+                               output_file=job.parser.output_file,
+                               metrics=job.parser.metrics.as_dict())
+
+    def stats(self):
+        """Per-stage queue depth and throughput, in pipeline order."""
+        elapsed = time.time() - self.started if self.started else 0.
+        return [s.stats(elapsed) for s in self.stages]
+
+    def format_stats(self):
+        return " | ".join(
+            "{stage}: {queued} queued, {busy}/{workers} busy, "
+            "{processed} done ({throughput:.2f}/s)".format(**s)
+            for s in self.stats())
+
+    def _complete(self, job, result=None, exc=None):
+        if self.finish is not None:
+            result = self.finish(job, result, exc)
+        elif exc is not None:
+            result = ImageResult(job.path, "error", message=unicode(exc))
+        result = result._replace(elapsed=time.time() - job.started)
+        self._results.put(result)
+
+    def _work(self, i):
+        stage = self.stages[i]
+        last = i == len(self.stages) - 1
+        while True:
+            job = stage.queue.get()
+            if job is _DONE:
+                break
+            with stage._lock:
+                stage.busy += 1
+            t0 = time.time()
+            exc = result = None
+            try:
+                result = stage.func(job)
+            except Exception as e:
+                exc = e
+            with stage._lock:
+                stage.busy -= 1
+                stage.busy_time += time.time() - t0
+                if exc is None:
+                    stage.processed += 1
+                else:
+                    stage.failed += 1
+            if exc is not None:
+                self._complete(job, exc=exc)
+            elif last:
+                self._complete(job, result)
+            else:
+                # Blocks when the next stage is backed up
+                self.stages[i + 1].queue.put(job)
+        # The last worker out tells the next stage to shut down
+        with self._lock:
+            self._alive[i] -= 1
+            closing = self._alive[i] == 0
+        if closing and not last:
+            nxt = self.stages[i + 1]
+            for _ in range(nxt.workers):
+                nxt.queue.put(_DONE)
+
+    def _feed(self, paths):
+        first = self.stages[0]
+        try:
+            for path in paths:
+                if isinstance(path, tuple):  # (path, source, skip_astrometry)
+                    first.queue.put(_Job(*path))
+                else:
+                    first.queue.put(_Job(path))
+        finally:
+            for _ in range(first.workers):
+                first.queue.put(_DONE)
+
+    def run(self, paths):
+        """Push every path through the stages; returns the list of
+        :class:`flipp.pipeline.results.ImageResult` in completion order.
+
+        Items may also be ``(path, source, skip_astrometry)`` tuples, to
+        process ``source`` (e.g. a resumed wcs-corrected image) but report
+        it as ``path``.
+        """
+        self.started = time.time()
+        for i, stage in enumerate(self.stages):
+            self._alive[i] = stage.workers
+            for _ in range(stage.workers):
+                t = threading.Thread(target=self._work, args=(i,),
+                                     name="flipp-{}".format(stage.name))
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+        feeder = threading.Thread(target=self._feed, args=(paths,),
+                                  name="flipp-feed")
+        feeder.daemon = True
+        feeder.start()
+
+        results = []
+        last_report = time.time()
+        while True:
+            try:
+                result = self._results.get(timeout=1.)
+            except Empty:
+                if (not any(t.is_alive() for t in self._threads) and
+                        self._results.empty()):
+                    break
+            else:
+                results.append(result)
+                if self.on_result is not None:
+                    self.on_result(result)
+            if time.time() - last_report > self.report_interval:
+                print(self.format_stats())
+                last_report = time.time()
+        feeder.join()
+        print(self.format_stats())
+        return results
@@ -0,0 +1,43 @@
+# -*- coding:utf-8 -*-
+
+from astropy.io import fits
+
+
+def solution(crval=(150., 20.)):
+    """A WCS header like solve-field's ``--wcs`` output."""
+    header = fits.Header()
+    header["CTYPE1"], header["CTYPE2"] = "RA---TAN", "DEC--TAN"
+    header["CRVAL1"], header["CRVAL2"] = crval
+    header["CRPIX1"], header["CRPIX2"] = 250.5, 250.5
+    header["CD1_1"], header["CD1_2"] = -0.8 / 3600, 0.
+    header["CD2_1"], header["CD2_2"] = 0., 0.8 / 3600
+    return header
+
+
+class FakeAstrometry(object):
+    """Stands in for :class:`flipp.libs.astrometry.Astrometry`.
+
+    ``results`` maps what is tried -- "verify" for a cached solution,
+    otherwise the ``--radius`` of the rung (False when blind) -- to the
+    solution it finds, None, or an exception to raise.
+    """
+
+    telescope = {"L": 0.7, "H": 0.8}
+
+    def __init__(self, results):
+        self.results = results
+        self.timeout = None
+        self.calls = []  # (what was tried, timeout it was given)
+
+    def _result(self, key):
+        self.calls.append((key, self.timeout))
+        result = self.results.get(key)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def verify_xylist(self, sources, guess, cpulimit=None):
+        return self._result("verify")
+
+    def solve_xylist(self, sources, **options):
+        return self._result(options["5"])
@@ -0,0 +1,82 @@
+# -*- coding:utf-8 -*-
+import os
+import shutil
+
+import numpy as np
+
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from astropy.io import fits
+
+from flipp.conf import settings
+from flipp.pipeline import image
+from flipp.pipeline.image import AstrometryFailedError, ImageParser
+
+from .factories import FakeAstrometry
+
+KAIT = os.path.join(settings.FIXTURE_DIR, 'kait')
+
+
+class TestImageData(TestCase):
+    """Scaled 16-bit frames, plain or .Z, are read for triage and
+    validation without a working copy."""
+
+    def setUp(self):
+        self.root = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def parse(self, path):
+        img = ImageParser(path, self.root)
+        self.addCleanup(img.cleanup)
+        return img
+
+    def test_scaled(self):
+        good = fits.open(os.path.join(KAIT, 'goodkait.fits'))
+        pixels = np.clip(good[0].data, 0, 65535).astype(np.uint16)
+        path = os.path.join(self.root, "scaled.fits")
+        fits.PrimaryHDU(pixels, good[0].header).writeto(path)
+        self.assertEqual(fits.getheader(path)["BZERO"], 32768)
+
+        img = self.parse(path)
+        self.assertTrue((img.data == pixels).all())
+        img.triage()
+        img.validate()
+        self.assertEqual(img.stage, "validated")
+        self.assertIsNone(img._image)  # No working copy made for it
+
+    def test_compressed(self):
+        img = self.parse(os.path.join(KAIT, 'badkait.fts.Z'))
+        self.assertEqual(img.data.shape, (500, 500))
+        self.assertEqual(img.data.dtype, np.uint16)
+
+
+class TestSolveField(TestCase):
+    """Images no rung solves are copied to REVIEW."""
+
+    def setUp(self):
+        self.root = mkdtemp()
+        astrometry = image.Astrometry
+        image.Astrometry = lambda *args: FakeAstrometry({})
+        self.addCleanup(setattr, image, "Astrometry", astrometry)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def unsolved(self, **kwargs):
+        img = ImageParser(os.path.join(KAIT, 'goodkait.fits'), self.root)
+        self.addCleanup(img.cleanup)
+        img.extract_catalog = lambda: None
+        self.assertRaises(AstrometryFailedError, img.solve_field, **kwargs)
+        return img
+
+    def test_review(self):
+        img = self.unsolved()
+        self.assertEqual(os.path.dirname(os.path.dirname(img.output_file)),
+                         os.path.join(self.root, "REVIEW"))
+        self.assertTrue(os.path.isfile(img.output_file))
+
+        img = self.unsolved(save_review=False)
+        self.assertIsNone(img.output_file)
@@ -0,0 +1,84 @@
+# -*- coding:utf-8 -*-
+import time
+import shutil
+
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from subprocess32 import TimeoutExpired
+
+from flipp.database.state import SolveAttempt, get_state_session
+from flipp.pipeline import ladder
+from flipp.pipeline.ladder import SolveLadder, learned_timeout
+
+from .factories import FakeAstrometry, solution
+
+RUNGS = [{"name": "narrow", "radius": 0.15, "scale_margin": 0., "timeout": 30},
+         {"name": "wide", "radius": 1., "scale_margin": 0.1, "timeout": 60},
+         {"name": "blind", "radius": None, "scale_margin": None,
+          "timeout": 300}]
+
+
+class TestSolveLadder(TestCase):
+    """Rungs escalate, and their timeouts follow recorded solve times."""
+
+    def setUp(self):
+        self.root = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def record(self, telescope, rung, elapsed, n, outcome="solved"):
+        session = get_state_session(self.root)
+        for _ in range(n):
+            session.add(SolveAttempt(telescope=telescope, rung=rung,
+                                     outcome=outcome, elapsed=elapsed,
+                                     created=time.time()))
+        session.commit()
+        session.close()
+
+    def test_escalation(self):
+        found = solution()
+        astrometry = FakeAstrometry({
+            0.15: TimeoutExpired("solve-field", 30), 1.: None, False: found})
+        solver = SolveLadder(self.root, "kait", RUNGS)
+        self.assertEqual(solver.solve(astrometry, None), (found, "blind"))
+        # No history yet: every rung gets its own timeout
+        self.assertEqual(astrometry.calls, [(0.15, 30.), (1., 60.),
+                                            (False, 300.)])
+        self.assertEqual(solver.describe(),
+                         "narrow: timeout, wide: failed, blind: solved")
+        session = get_state_session(self.root)
+        self.assertEqual(
+            [(a.rung, a.outcome, a.timeout) for a in
+             session.query(SolveAttempt).order_by(SolveAttempt.pk)],
+            [("narrow", "timeout", 30.), ("wide", "failed", 60.),
+             ("blind", "solved", 300.)])
+        session.close()
+
+        # Once a rung solves, the wider ones are never tried
+        astrometry = FakeAstrometry({0.15: found})
+        self.assertEqual(solver.solve(astrometry, None), (found, "narrow"))
+        self.assertEqual(len(astrometry.calls), 1)
+
+    def test_learned_timeout(self):
+        rung = RUNGS[0]
+        n = ladder.TIMEOUT_SAMPLES
+        self.assertEqual(learned_timeout([], rung), 30.)
+        self.assertEqual(learned_timeout([4.] * (n - 1), rung), 30.)
+        self.assertEqual(learned_timeout([4.] * n, rung),
+                         ladder.TIMEOUT_FACTOR * 4.)
+        self.assertEqual(learned_timeout([0.1] * n, rung),
+                         ladder.TIMEOUT_MIN)
+        self.assertEqual(learned_timeout([100.] * n, rung), 30.)
+
+    def test_timeout_from_history(self):
+        n = ladder.TIMEOUT_SAMPLES
+        self.record("kait", "narrow", 4., n)
+        self.record("kait", "narrow", 25., n, outcome="timeout")
+        self.record("nickel", "wide", 4., n)  # Another telescope's
+        astrometry = FakeAstrometry({})
+        SolveLadder(self.root, "kait", RUNGS).solve(astrometry, None)
+        self.assertEqual(astrometry.calls,
+                         [(0.15, ladder.TIMEOUT_FACTOR * 4.), (1., 60.),
+                          (False, 300.)])
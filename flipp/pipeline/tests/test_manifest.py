@@ -0,0 +1,63 @@
+# -*- coding:utf-8 -*-
+import os
+import shutil
+
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from flipp.pipeline.manifest import Manifest
+from flipp.pipeline.results import ImageResult
+
+
+class TestManifest(TestCase):
+    """A rerun skips what is finished and redoes what changed."""
+
+    def setUp(self):
+        self.root = mkdtemp()
+        self.paths = {}
+        for name in ("done", "rejected", "failed", "solved", "changed",
+                     "new"):
+            path = os.path.join(self.root, name + ".fits")
+            with open(path, "wb") as f:
+                f.write(b"\0" * 2880)
+            self.paths[name] = path
+        self.solved = os.path.join(self.root, "solved_wcs.fits")
+        open(self.solved, "wb").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_resume(self):
+        manifest = Manifest(self.root)
+        for name, status, stage, output in [
+                ("done", "done", "ingested", None),
+                ("rejected", "rejected", None, None),
+                ("failed", "failed", None, None),
+                ("solved", "failed", "solved", self.solved),
+                ("changed", "done", "ingested", None)]:
+            manifest.record(ImageResult(self.paths[name], status,
+                                        stage=stage, output_file=output))
+        manifest.flush()
+        manifest.session.close()
+
+        changed = self.paths["changed"]
+        with open(changed, "ab") as f:
+            f.write(b"\0" * 2880)
+
+        manifest = Manifest(self.root)  # As a later run would see it
+        actions = dict((name, manifest.plan(path)[0])
+                       for name, path in self.paths.items())
+        self.assertEqual(actions, {"done": "skip", "rejected": "skip",
+                                   "failed": "process", "solved": "resume",
+                                   "changed": "process", "new": "process"})
+        self.assertEqual(manifest.plan(self.paths["solved"])[1].output_file,
+                         self.solved)
+
+    def test_touched(self):
+        manifest = Manifest(self.root)
+        path = self.paths["done"]
+        manifest.record(ImageResult(path, "done", stage="ingested"))
+        manifest.flush()
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + 10))
+        self.assertEqual(manifest.plan(path)[0], "process")
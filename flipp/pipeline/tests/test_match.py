@@ -0,0 +1,142 @@
+# -*- coding:utf-8 -*-
+import logging
+
+import numpy as np
+
+from unittest import TestCase, SkipTest
+
+from astropy.table import Table
+from sqlalchemy import create_engine, event
+
+from flipp.database import (engine, models, SourcesNotIndexed,
+                            check_sources_indexed, index_sources)
+from flipp.libs import healpix
+from flipp.pipeline.match import SourceMatcher, Session, sky_cone
+from flipp.pipeline.metrics import StageMetrics
+
+ARCSEC = 1 / 3600.
+
+
+class FakeImage(object):
+    """What :class:`SourceMatcher` needs of an ``ImageParser``."""
+
+    logger = logging.getLogger("flipp.tests")
+    telescope = "kait"
+    output_root = "/output"
+    META = {"FILTER": "V", "MJD": 57000.5}
+
+    def __init__(self, name, positions):
+        ra, dec = np.transpose(positions)
+        self.output_file = "/output/20150101/" + name
+        self.sources = Table([ra, dec, np.full(len(ra), 15.),
+                              np.full(len(ra), 0.02)],
+                             names=("ALPHA_J2000", "DELTA_J2000",
+                                    "MAG_AUTO_ZP", "MAGERR_AUTO_ZP"))
+        self.metrics = StageMetrics()
+
+
+class TestSourceMatcher(TestCase):
+    """Ingest into the in-memory database of the default DB_URL."""
+
+    def setUp(self):
+        if str(engine.url) != "sqlite://":
+            raise SkipTest("needs the in-memory DB_URL")
+        models.Base.metadata.drop_all(engine)
+        models.Base.metadata.create_all(engine)
+
+    def ingest(self, name, positions):
+        return SourceMatcher(FakeImage(name, positions)).run()
+
+    def test_run(self):
+        a, b = (359.9999, 0.5), (10., -30.)  # a is just short of RA = 360
+        near_b = (b[0], b[1] + 2 * ARCSEC)
+        inserts = []
+
+        def count(conn, cursor, statement, parameters, context, many):
+            if statement.startswith("INSERT INTO flipp_source"):
+                inserts.append(many)
+        event.listen(engine, "before_cursor_execute", count)
+        try:
+            # New: a and b; near_b is b again, so it joins b's new Source
+            self.assertEqual(self.ingest("one.fits", [a, b, near_b]), (1, 2))
+        finally:
+            event.remove(engine, "before_cursor_execute", count)
+        self.assertEqual(inserts, [True])  # One executemany
+
+        # a matched 1" away, across RA = 0; c is new
+        a_moved = ((a[0] + 1 * ARCSEC) % 360., a[1])
+        c = (10., -30. + 30 * ARCSEC)
+        self.assertEqual(self.ingest("two.fits", [a_moved, c]), (1, 1))
+
+        # The same image again adds nothing
+        self.assertEqual(self.ingest("two.fits", [a_moved, c]), (2, 0))
+
+        session = Session()
+        sources = session.query(models.Source).order_by(models.Source.pk)
+        self.assertEqual([(s.ra, s.decl) for s in sources], [a, b, c])
+        for s in sources:
+            self.assertEqual(s.hpix, healpix.nested(models.HPIX_NSIDE,
+                                                    s.ra, s.decl))
+            self.assertEqual(s.name, "")
+        observed = sorted(
+            (i.name, o.source) for o, i in session.query(
+                models.Observation, models.Image).filter(
+                    models.Observation.image == models.Image.pk))
+        pk = dict((s.pk, (s.ra, s.decl)) for s in sources)
+        self.assertEqual([(name, pk[p]) for name, p in observed],
+                         [("20150101/one.fits", a), ("20150101/one.fits", b),
+                          ("20150101/two.fits", a), ("20150101/two.fits", c)])
+        session.close()
+
+    def test_concurrent_twin(self):
+        """A Source another process inserts at the very same position
+        meanwhile is not mistaken for ours."""
+        a = (150.123456789, 2.5)
+
+        def twin(conn, cursor, statement, parameters, context, many):
+            if statement.startswith("INSERT INTO flipp_source"):
+                cursor.execute("INSERT INTO flipp_source (name, "
+                               "classification, ra, decl, hpix) VALUES "
+                               "('twin', '', ?, ?, ?)",
+                               a + (healpix.nested(models.HPIX_NSIDE, *a),))
+        event.listen(engine, "after_cursor_execute", twin)
+        try:
+            self.assertEqual(self.ingest("one.fits", [a]), (0, 1))
+        finally:
+            event.remove(engine, "after_cursor_execute", twin)
+        session = Session()
+        observed, = session.query(models.Observation.source)
+        self.assertEqual(session.query(models.Source.name).filter_by(
+            pk=observed.source).scalar(), "")
+        self.assertEqual(session.query(models.Source).filter_by(
+            name="twin").count(), 1)
+        session.close()
+
+
+class TestIndexSources(TestCase):
+    """A flipp_source made before hpix is refused until it is indexed."""
+
+    def test_unindexed(self):
+        old = create_engine("sqlite://")
+        old.execute("CREATE TABLE flipp_source (pk INTEGER PRIMARY KEY, "
+                    "name VARCHAR(255), classification VARCHAR(255), "
+                    "ra FLOAT, decl FLOAT)")
+        positions = [(359.9999, 0.5), (10., -30.), (45., 89.999)]
+        for ra, dec in positions:
+            old.execute("INSERT INTO flipp_source (ra, decl) VALUES (?, ?)",
+                        ra, dec)
+        self.assertRaises(SourcesNotIndexed, check_sources_indexed, old)
+
+        # Added but not filled in: cone searches would find nothing
+        old.execute("ALTER TABLE flipp_source ADD COLUMN hpix BIGINT")
+        self.assertRaises(SourcesNotIndexed, check_sources_indexed, old)
+
+        self.assertEqual(index_sources(old, chunk=2), 3)
+        self.assertEqual(index_sources(old), 0)
+        check_sources_indexed(old)
+        session = Session(bind=old)
+        for ra, dec in positions:
+            found = session.query(models.Source.ra, models.Source.decl).filter(
+                sky_cone(ra, dec, ARCSEC))
+            self.assertEqual(found.all(), [(ra, dec)])
+        session.close()
@@ -0,0 +1,31 @@
+# -*- coding:utf-8 -*-
+import time
+
+from unittest import TestCase
+
+from flipp.pipeline.metrics import StageMetrics
+
+
+class TestStageMetrics(TestCase):
+    """Nested stages are counted once."""
+
+    def test_nested(self):
+        metrics = StageMetrics()
+        t0 = time.time()
+        with metrics.stage("validate"):
+            time.sleep(0.1)
+            with metrics.stage("sextractor"):
+                time.sleep(0.2)
+        with metrics.stage("solve_field"):
+            with metrics.stage("sextractor"):  # Already run; costs nothing
+                pass
+            time.sleep(0.1)
+        elapsed = time.time() - t0
+        stages = metrics.as_dict()
+        self.assertEqual(list(stages), ["sextractor", "validate",
+                                        "solve_field"])
+        self.assertEqual(stages["sextractor"]["calls"], 2)
+        self.assertAlmostEqual(stages["sextractor"]["wall"], 0.2, places=1)
+        self.assertAlmostEqual(stages["validate"]["wall"], 0.1, places=1)
+        self.assertAlmostEqual(stages["solve_field"]["wall"], 0.1, places=1)
+        self.assertTrue(sum(s["wall"] for s in stages.values()) <= elapsed)
@@ -0,0 +1,82 @@
+# -*- coding:utf-8 -*-
+import os
+import time
+import shutil
+import subprocess
+
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from flipp.pipeline.pool import WorkerPool
+
+
+def _nap(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def _fail():
+    raise ValueError("bad image")
+
+
+def _hang(pidfile):
+    """Start a grandchild that outlives us unless its group is killed."""
+    child = subprocess.Popen(["sleep", "60"])
+    with open(pidfile, "w") as f:
+        f.write(str(child.pid))
+    child.wait()
+
+
+def _running(pid):
+    """Whether ``pid`` is a live process (zombies count as dead)."""
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except IOError:
+        return False
+
+
+class TestWorkerPool(TestCase):
+    """Results per task, whatever happens to the others."""
+
+    def setUp(self):
+        self.root = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_completion_order(self):
+        pool = WorkerPool(jobs=3)
+        tasks = [("slow", (0.6,)), ("fast", (0.,)), ("medium", (0.3,))]
+        results = list(pool.imap_unordered(_nap, tasks))
+        self.assertEqual([k for k, _, _ in results],
+                         ["fast", "medium", "slow"])
+        self.assertEqual([s for _, s, _ in results], ["ok"] * 3)
+        self.assertEqual(dict((k, v) for k, _, v in results),
+                         {"slow": 0.6, "fast": 0., "medium": 0.3})
+        self.assertEqual(len(pool), 0)
+
+    def test_error(self):
+        pool = WorkerPool(jobs=2)
+        results = dict((k, (s, v)) for k, s, v in pool.imap_unordered(
+            lambda name: _fail() if name == "bad" else name,
+            [("bad", ("bad",)), ("good", ("good",))]))
+        self.assertEqual(results["good"], ("ok", "good"))
+        status, value = results["bad"]
+        self.assertEqual(status, "error")
+        self.assertIn("ValueError: bad image", value)
+
+    def test_timeout_kills_process_group(self):
+        pidfile = os.path.join(self.root, "pid")
+        pool = WorkerPool(jobs=1, timeout=1.)
+        (key, status, value), = pool.imap_unordered(
+            _hang, [("hung", (pidfile,))])
+        self.assertEqual((key, status), ("hung", "timeout"))
+        self.assertTrue(value >= 1.)
+        with open(pidfile) as f:
+            pid = int(f.read())
+        for _ in range(50):  # The kernel may take a moment to reap it
+            if not _running(pid):
+                break
+            time.sleep(0.1)
+        self.assertFalse(_running(pid))
@@ -0,0 +1,67 @@
+# -*- coding:utf-8 -*-
+import os
+import shutil
+
+import numpy as np
+
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from astropy.io import fits
+
+from flipp.libs.healpix import destination
+from flipp.libs.refcache import DTYPE, TileCache, separation
+from flipp.pipeline.prefetch import field_cone, prefetch
+
+
+class TestPrefetch(TestCase):
+    """Prefetched tiles answer every cone in the field without network,
+    close to the pole too."""
+
+    def setUp(self):
+        self.root = mkdtemp()
+        rng = np.random.RandomState(0)
+        n = 20000
+        stars = np.zeros(n, DTYPE)
+        stars["decdeg"] = np.degrees(np.arcsin(
+            rng.uniform(np.sin(np.radians(85.)), 1., n)))
+        stars["radeg"] = rng.uniform(0., 360., n)
+        self.stars = stars
+
+        def fetch(ra, dec, radius):
+            return stars[separation(ra, dec, stars["radeg"],
+                                    stars["decdeg"]) <= radius]
+
+        self.cache = TileCache(os.path.join(self.root, "cache"), fetch,
+                               max_bytes=0, size=1.)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_polar_field(self):
+        path = os.path.join(self.root, "image.fits")
+        # A field about 0.5 degrees across, a degree from the pole
+        hdu = fits.PrimaryHDU(np.zeros((2896, 2896), dtype=np.uint8))
+        hdu.header["RA"], hdu.header["DEC"] = 209.6, 89.1
+        hdu.writeto(path)
+        # A star on its edge, in a tile that radius / cos(dec) degrees of RA
+        # either side of the centre would not reach
+        self.stars[0]["radeg"], self.stars[0]["decdeg"] = 179.6, 88.995
+        self.assertEqual(prefetch([path], "kait", jobs=2, cache=self.cache)[1],
+                         0)
+
+        def offline(ra, dec, radius):
+            raise IOError("no network")
+        self.cache.fetch = offline
+
+        ra, dec, radius = field_cone(hdu.header, "kait")
+        self.assertTrue(separation(ra, dec, 179.6, 88.995) < radius)
+        rng = np.random.RandomState(1)
+        for _ in range(20):  # Cones anywhere inside the field's
+            offset = rng.uniform(0., radius)
+            ra_c, dec_c = destination(ra, dec, offset,
+                                      rng.uniform(0., 2 * np.pi))
+            found = self.cache.cone(ra_c, dec_c, radius - offset)
+            expected = separation(ra_c, dec_c, self.stars["radeg"],
+                                  self.stars["decdeg"]) <= radius - offset
+            self.assertEqual(len(found), expected.sum())
@@ -0,0 +1,74 @@
+# -*- coding:utf-8 -*-
+import time
+import threading
+
+from unittest import TestCase
+
+from flipp.pipeline.results import ImageResult
+from flipp.pipeline.staged import Stage, StagedPipeline
+
+
+def _wait_for(condition, timeout=5.):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestStagedPipeline(TestCase):
+    """Stub stages: backpressure, failures and shutdown."""
+
+    def test_backpressure(self):
+        release = threading.Event()
+        fed = []
+
+        def paths():
+            for i in range(20):
+                fed.append(i)
+                yield "image{}.fits".format(i)
+
+        def last(job):
+            release.wait()
+            return ImageResult(job.path, "done")
+
+        pipeline = StagedPipeline([Stage("first", lambda job: None, 1, 2),
+                                   Stage("last", last, 1, 2)])
+        out = []
+        runner = threading.Thread(
+            target=lambda: out.extend(pipeline.run(paths())))
+        runner.start()
+        try:
+            # One job in "last", two queued for it, one held by "first"
+            # waiting to queue it, two queued for "first", one in the feeder
+            self.assertTrue(_wait_for(
+                lambda: pipeline.stages[1].queue.full() and
+                pipeline.stages[0].queue.full()))
+            time.sleep(0.2)
+            self.assertTrue(len(fed) <= 7)
+            self.assertTrue(pipeline.stages[0].processed <= 4)
+        finally:
+            release.set()
+        runner.join(10.)
+        self.assertFalse(runner.is_alive())
+        self.assertEqual(sorted(r.path for r in out),
+                         sorted("image{}.fits".format(i) for i in range(20)))
+
+    def test_errors_and_shutdown(self):
+        def check(job):
+            if "bad" in job.path:
+                raise ValueError("no stars in " + job.path)
+
+        pipeline = StagedPipeline(
+            [Stage("check", check, 3, 2),
+             Stage("ingest", lambda job: ImageResult(job.path, "done"), 2, 2)])
+        results = pipeline.run(["good1.fits", "bad.fits", "good2.fits"])
+        by_path = dict((r.path, r) for r in results)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(by_path["good1.fits"].status, "done")
+        self.assertEqual(by_path["bad.fits"].status, "error")
+        self.assertIn("no stars in bad.fits", by_path["bad.fits"].message)
+        self.assertEqual([s["failed"] for s in pipeline.stats()], [1, 0])
+        self.assertEqual([s["processed"] for s in pipeline.stats()], [2, 2])
+        for t in pipeline._threads:
+            t.join(5.)
+        self.assertFalse(any(t.is_alive() for t in pipeline._threads))
@@ -0,0 +1,89 @@
+# -*- coding:utf-8 -*-
+import io
+import os
+import shutil
+
+import numpy as np
+
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from astropy.io import fits
+
+from flipp.pipeline import triage
+from flipp.pipeline.results import ImageResult
+from flipp.pipeline.triage import FrameRejected, RejectionLog
+
+
+def _frame(n=1024, sky=1000., stars=True):
+    rng = np.random.RandomState(0)
+    data = rng.normal(sky, 10., (n, n)).astype(np.float32)
+    if stars:
+        y, x = np.mgrid[-4:5, -4:5]
+        star = 5000. * np.exp(-(x ** 2 + y ** 2) / 4.)
+        for cy in range(n // 16, n, n // 8):  # An 8 x 8 grid of stars
+            for cx in range(n // 16, n, n // 8):
+                data[cy - 4:cy + 5, cx - 4:cx + 5] += star
+    return data
+
+
+class TestTriage(TestCase):
+    """Header and pixel rules, with the default TRIAGE_RULES."""
+
+    def setUp(self):
+        self.header = fits.Header([("IMAGETYP", "object"),
+                                   ("OBJECT", "sn2014c")])
+
+    def check(self, header, data):
+        try:
+            triage.triage(header, data, None)
+        except FrameRejected as e:
+            return e.category
+
+    def test_calibration(self):
+        self.header["IMAGETYP"] = "Dome Flat"
+        # Rejected from the header alone: the pixels are never asked for
+        self.assertEqual(self.check(self.header, lambda: 1 / 0),
+                         "calibration")
+
+    def test_flat(self):
+        self.assertEqual(self.check(self.header,
+                                    _frame(sky=20000., stars=False)),
+                         "no_stars")
+
+    def test_saturated(self):
+        data = _frame()
+        data[:, :128] = 65535.
+        self.assertEqual(self.check(self.header, data), "saturated")
+
+    def test_good(self):
+        self.assertIsNone(self.check(self.header, _frame()))
+        stats = triage.pixel_stats(_frame(), 256)
+        self.assertAlmostEqual(stats["background"], 1000., delta=5.)
+        self.assertEqual(stats["stars"], 16)  # Those in the central 512^2
+
+
+class TestRejectionLog(TestCase):
+
+    def setUp(self):
+        self.root = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_flush(self):
+        log = RejectionLog(self.root)
+        log.add(ImageResult("a.fits", "rejected",
+                            message="calibration: IMAGETYP = 'flat'"))
+        log.add(ImageResult("b.fits", "done"))
+        log.add(ImageResult("c.fits", "rejected",
+                            message="saturated: 9.0% of pixels saturated"))
+        self.assertFalse(os.path.exists(log.path))  # Written in bulk
+        log.flush()
+        log.flush()
+        with io.open(log.path, encoding="utf-8") as f:
+            self.assertEqual(f.read().splitlines(),
+                             ["a.fits\tcalibration\tIMAGETYP = 'flat'",
+                              "c.fits\tsaturated\t9.0% of pixels saturated"])
+        self.assertIn("Rejected 2 frames in triage: 1 calibration, "
+                      "1 saturated", log.summary())
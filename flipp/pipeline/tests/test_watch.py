@@ -0,0 +1,48 @@
+# -*- coding:utf-8 -*-
+import os
+import time
+import shutil
+
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from flipp.pipeline.watch import Watcher
+
+
+class TestWatcher(TestCase):
+    """New files are queued once, after they stop changing."""
+
+    settle = 0.3
+
+    def setUp(self):
+        self.root = mkdtemp()
+        self.incoming = os.path.join(self.root, "incoming")
+        os.mkdir(self.incoming)
+        self.watcher = Watcher([self.incoming],
+                               os.path.join(self.root, "output"),
+                               extensions=[".fits"], settle=self.settle)
+
+    def tearDown(self):
+        self.watcher.manifest.session.close()
+        shutil.rmtree(self.root)
+
+    def test_settle(self):
+        path = os.path.join(self.incoming, "image.fits")
+        with open(path, "wb") as f:
+            f.write(b"\0" * 2880)
+        self.watcher.scan()  # First sighting
+        self.assertEqual(self.watcher._queue, [])
+
+        time.sleep(self.settle * 1.5)
+        with open(path, "ab") as f:  # Still being copied over
+            f.write(b"\0" * 2880)
+        self.watcher.scan()
+        self.assertEqual(self.watcher._queue, [])
+
+        time.sleep(self.settle * 1.5)
+        self.watcher.scan()
+        self.assertEqual(self.watcher._queue, [(path, path, False)])
+
+        time.sleep(self.settle * 1.5)
+        self.watcher.scan()
+        self.assertEqual(len(self.watcher._queue), 1)
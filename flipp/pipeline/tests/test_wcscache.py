@@ -0,0 +1,73 @@
+# -*- coding:utf-8 -*-
+import shutil
+
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from astropy.io import fits
+from subprocess32 import TimeoutExpired
+
+from flipp.database.state import CachedSolution, get_state_session
+from flipp.pipeline.ladder import SolveLadder
+from flipp.pipeline.wcscache import SolutionCache
+
+from .factories import FakeAstrometry, solution
+
+
+def _image(ra=150., dec=20.):
+    return fits.Header([("NAXIS1", 500), ("NAXIS2", 500), ("RA", ra),
+                        ("DEC", dec)])
+
+
+class TestSolutionCache(TestCase):
+    """Solutions are found again by field, and re-solved when stale."""
+
+    def setUp(self):
+        self.root = mkdtemp()
+        self.cache = SolutionCache(self.root, radius=0.1)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_store_lookup(self):
+        self.cache.store("kait", "SN2014c", _image(), solution())
+        guess = self.cache.lookup("kait", "SN2014c", _image(150.05, 20.02))
+        self.assertEqual(guess["CRVAL1"], 150.)
+        self.assertIsNone(self.cache.lookup("kait", "SN2014c",
+                                            _image(150.5, 20.)))
+        self.assertIsNone(self.cache.lookup("nickel", "SN2014c", _image()))
+        self.assertIsNone(self.cache.lookup("kait", "SN2016x", _image()))
+        small = _image()
+        small["NAXIS1"] = 250
+        self.assertIsNone(self.cache.lookup("kait", "SN2014c", small))
+
+        # A verified solution replaces the one it was tweaked from
+        self.cache.store("kait", "SN2014c", _image(150.02, 20.),
+                         solution((150.02, 20.)), verified=True)
+        session = get_state_session(self.root)
+        rows = session.query(CachedSolution).all()
+        self.assertEqual([(r.ra, r.hits) for r in rows], [(150.02, 1)])
+        session.close()
+        self.assertEqual(self.cache.lookup("kait", "SN2014c",
+                                           _image())["CRVAL1"], 150.02)
+
+    def test_verify_fallback(self):
+        ladder = SolveLadder(self.root, "kait")
+        guess = solution()
+
+        # The cached solution fits: nothing else is tried
+        astrometry = FakeAstrometry({"verify": guess})
+        self.assertEqual(ladder.solve(astrometry, None, guess),
+                         (guess, "verify"))
+        self.assertEqual([c for c, _ in astrometry.calls], ["verify"])
+
+        # It doesn't, or times out: the image is solved from scratch
+        for verified in (None, TimeoutExpired("solve-field", 10)):
+            fresh = solution((150.3, 20.))
+            astrometry = FakeAstrometry({"verify": verified, 0.15: fresh})
+            self.assertEqual(ladder.solve(astrometry, None, guess),
+                             (fresh, "narrow"))
+            self.assertEqual([c for c, _ in astrometry.calls],
+                             ["verify", 0.15])
+            self.assertEqual([o for _, o, _ in ladder.attempts][-1],
+                             "solved")
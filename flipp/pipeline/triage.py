@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-flight quality triage: reject frames that are not worth sending to
+sextractor and solve-field.
+
+Flats, darks, clouded-out and saturated exposures are recognised from the
+header and a small sample of the pixels, by the rules in
+``settings.TRIAGE_RULES`` (overridable per telescope with a ``"TRIAGE"``
+entry in ``settings.TELESCOPES``).  A rejected frame raises
+:class:`FrameRejected`, whose ``category`` says which rule it broke;
+:class:`RejectionLog` collects the rejections of a run and writes them out
+in one go, instead of one log file entry per image.
+"""
+
+from __future__ import unicode_literals, division
+
+import io
+import os
+import re
+
+import numpy as np
+
+from collections import Counter
+
+from flipp.libs.detect import count_sources
+from flipp.conf import settings
+
+CATEGORIES = ("calibration",    # IMAGETYP/OBJECT says flat, dark, bias...
+              "saturated",      # too many pixels at the saturation level
+              "background",     # sky level out of range (clouds, twilight)
+              "dynamic_range",  # nothing stands out of the noise
+              "no_stars",       # too few stars even in a binned sample
+              )
+
+
+class FrameRejected(Exception):
+    """Raised by :func:`triage` for a frame that fails a rule."""
+
+    def __init__(self, category, reason):
+        super(FrameRejected, self).__init__(
+            "{}: {}".format(category, reason))
+        self.category = category
+        self.reason = reason
+
+
+def rules_for(telescope):
+    """``settings.TRIAGE_RULES`` updated with the telescope's own."""
+    rules = dict(settings.TRIAGE_RULES)
+    rules.update(settings.TELESCOPES.get(telescope, {}).get("TRIAGE", {}))
+    return rules
+
+
+def check_header(header, rules):
+    for key, pattern in rules.get("HEADER_PATTERNS", {}).items():
+        value = header.get(key)
+        if value is not None and re.search(pattern, str(value).strip(),
+                                           flags=re.I):
+            raise FrameRejected("calibration",
+                                "{} = '{}'".format(key, str(value).strip()))
+
+
+STAR_BINNING = 2
+"""Binning of the central cutout stars are counted on, see :func:`pixel_stats`."""
+
+
+def _centre(data, n):
+    """The central ``n`` x ``n`` pixels of ``data`` (or all of it)."""
+    y0, x0 = (max(0, (m - n) // 2) for m in data.shape)
+    return data[y0:y0 + n, x0:x0 + n]
+
+
+def _bin(data, factor):
+    """Block-average ``data`` by ``factor`` along both axes."""
+    ny, nx = (n // factor * factor for n in data.shape)
+    return data[:ny, :nx].reshape(ny // factor, factor, nx // factor,
+                                  factor).mean(axis=(1, 3))
+
+
+def pixel_stats(data, size=256, saturation=None):
+    """Quality numbers from a ``size`` x ``size`` sample of ``data``.
+
+    Levels come from every n-th pixel.  Stars are counted on the central
+    ``size * STAR_BINNING`` pixels binned ``STAR_BINNING`` x
+    ``STAR_BINNING``, where point sources keep their flux and the noise
+    drops, so however large the frame only that cutout is read in full.
+    """
+    data = np.asarray(data)
+    if data.ndim > 2:
+        data = data.reshape((-1,) + data.shape[-2:])[0]
+    step = max(1, max(data.shape) // size)
+    sample = np.asarray(data[::step, ::step], dtype=np.float32)
+    median = float(np.median(sample))
+    rms = 1.4826 * float(np.median(np.abs(sample - median)))
+    top = float(np.percentile(sample, 99.9))
+    stats = {"background": median,
+             "rms": rms,
+             "dynamic_range": (top - median) / rms if rms > 0 else 0.,
+             "saturated_fraction": (float(np.mean(sample >= saturation))
+                                    if saturation else 0.),
+             }
+    if step > 1:
+        factor = min(step, STAR_BINNING)
+        binned = _bin(np.asarray(_centre(data, size * factor),
+                                 dtype=np.float32), factor)
+    else:
+        binned = sample
+    stats["stars"] = count_sources(binned, minarea=1)
+    return stats
+
+
+def check_pixels(stats, rules):
+    fraction = rules.get("MAX_SATURATED_FRACTION")
+    if fraction is not None and stats["saturated_fraction"] > fraction:
+        raise FrameRejected("saturated", "{:.1%} of pixels saturated".format(
+            stats["saturated_fraction"]))
+    low, high = rules.get("MIN_BACKGROUND"), rules.get("MAX_BACKGROUND")
+    if ((low is not None and stats["background"] < low) or
+            (high is not None and stats["background"] > high)):
+        raise FrameRejected("background", "background {:.0f}".format(
+            stats["background"]))
+    dr = rules.get("MIN_DYNAMIC_RANGE")
+    if dr is not None and stats["dynamic_range"] < dr:
+        raise FrameRejected("dynamic_range", "dynamic range {:.1f}".format(
+            stats["dynamic_range"]))
+    stars = rules.get("MIN_STARS")
+    if stars is not None and stats["stars"] < stars:
+        raise FrameRejected("no_stars", "{} stars in the binned sample".format(
+            stats["stars"]))
+
+
+def triage(header, data, telescope):
+    """Check a frame against its telescope's rules.
+
+    ``data`` may be a callable returning the pixels, so that frames
+    rejected on their header alone are never read.  Returns the
+    :func:`pixel_stats`; raises :class:`FrameRejected`.
+    """
+    rules = rules_for(telescope)
+    check_header(header, rules)
+    if callable(data):
+        data = data()
+    if data is None:
+        raise FrameRejected("no_stars", "no image data")
+    stats = pixel_stats(data, rules.get("SAMPLE_SIZE", 256),
+                        rules.get("SATURATION_LEVEL"))
+    check_pixels(stats, rules)
+    return stats
+
+
+class RejectionLog(object):
+    """Rejected frames of a run, appended to ``flipp_rejected.tsv`` in the
+    output directory in bulk by :meth:`flush`.
+    """
+
+    def __init__(self, path_to_output):
+        self.path = os.path.join(path_to_output, "flipp_rejected.tsv")
+        self.pending = []
+        self.counts = Counter()
+
+    def add(self, result):
+        if result.status != "rejected":
+            return
+        category, _, reason = result.message.partition(": ")
+        self.pending.append((result.path, category, reason))
+        self.counts[category] += 1
+
+    def flush(self):
+        if not self.pending:
+            return
+        lines = "".join("{}\t{}\t{}\n".format(*p) for p in self.pending)
+        with io.open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+        self.pending = []
+
+    def summary(self):
+        """One line of rejections by category, or "" if there were none."""
+        if not self.counts:
+            return ""
+        return "Rejected {} frames in triage: {} (see {})".format(
+            sum(self.counts.values()),
+            ", ".join("{} {}".format(self.counts[c], c)
+                      for c in CATEGORIES if self.counts[c]),
+            self.path)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Long-running ingest of new images as they land on disk (``flipp watch``).
+
+Compared to running ``flipprun`` once per file, the watcher pays for the
+interpreter, the astropy/matplotlib/sqlalchemy imports and the database
+table checks once, then forks a worker per image from the warm process.
+"""
+
+from __future__ import unicode_literals, print_function
+
+import os
+import time
+import signal
+
+from flipp.pipeline import process_image, iter_input_files, init_worker
+from flipp.pipeline.pool import WorkerPool
+from flipp.pipeline.manifest import Manifest
+from flipp.pipeline.results import ImageResult
+from flipp.pipeline.metrics import MetricsLog
+from flipp.pipeline.triage import RejectionLog
+from flipp.libs.utils import mkdir
+
+from flipp.conf import settings
+
+
+class Watcher(object):
+    """Poll folders for new images and feed them to the pipeline.
+
+    A file is only picked up once its size and modification time have not
+    changed for ``settle`` seconds, so images still being written (or
+    copied over from the telescope) are never read half-way.  Files are
+    remembered in the run's :class:`flipp.pipeline.manifest.Manifest`, so
+    restarting the watcher does not reprocess anything.
+
+    Example
+    -------
+    .. code-block::
+
+        Watcher(["/data/kait/incoming"], "/data/flipp", jobs=4).run()
+    """
+
+    def __init__(self, input_paths, path_to_output, telescope=None,
+                 extensions=[], recursive=True, skip_astrometry=False,
+                 jobs=1, timeout=None, interval=None, settle=None):
+        self.input_paths = input_paths
+        self.path_to_output = os.path.abspath(
+            os.path.expanduser(path_to_output))
+        self.telescope = telescope
+        self.extensions = extensions
+        self.recursive = recursive
+        self.skip_astrometry = skip_astrometry
+        self.interval = interval or settings.WATCH_INTERVAL
+        self.settle = settle or settings.WATCH_SETTLE
+        mkdir(self.path_to_output)
+        self.manifest = Manifest(self.path_to_output)
+        self.metrics_log = MetricsLog(os.path.join(self.path_to_output,
+                                                   "flipp_metrics.jsonl"))
+        self.rejections = RejectionLog(self.path_to_output)
+        self.pool = WorkerPool(jobs, timeout=timeout, initializer=init_worker)
+        self._candidates = {}  # path -> ((size, mtime), first seen unchanged)
+        self._handled = {}  # path -> (size, mtime) when it was queued
+        self._queue = []
+        self._stopping = False
+
+    def stop(self, *args):
+        """Stop picking up new files; in-flight images are finished."""
+        if self._stopping:  # Second signal: give up on in-flight images
+            self.pool.terminate()
+        self._stopping = True
+
+    def scan(self):
+        """Queue every file that appeared or changed and has settled."""
+        now = time.time()
+        for path in iter_input_files(self.input_paths, self.extensions,
+                                     self.recursive):
+            try:
+                st = os.stat(path)
+            except OSError:  # Moved away while we were looking
+                continue
+            key = (st.st_size, st.st_mtime)
+            if self._handled.get(path) == key:
+                continue
+            seen = self._candidates.get(path)
+            if seen is None or seen[0] != key:
+                self._candidates[path] = (key, now)
+                continue
+            if now - seen[1] < self.settle or now - st.st_mtime < self.settle:
+                continue
+            del self._candidates[path]
+            self._handled[path] = key
+            action, entry = self.manifest.plan(path)
+            if action == "skip":
+                continue
+            elif action == "resume":
+                self._queue.append((path, entry.output_file, True))
+            else:
+                self._queue.append((path, path, self.skip_astrometry))
+
+    def _finish(self, result):
+        print(result)
+        self.manifest.record(result)
+        self.manifest.flush()
+        self.metrics_log.write(result)
+        self.rejections.add(result)
+
+    def run(self):
+        """Watch until SIGINT/SIGTERM."""
+        previous = {sig: signal.signal(sig, self.stop)
+                    for sig in (signal.SIGINT, signal.SIGTERM)}
+        print("Watching {} for new images".format(", ".join(self.input_paths)))
+        last_scan = 0
+        try:
+            while not self._stopping or len(self.pool):
+                if not self._stopping and time.time() - last_scan > self.interval:
+                    self.rejections.flush()
+                    self.scan()
+                    last_scan = time.time()
+                while self._queue and not self.pool.full and not self._stopping:
+                    path, f, skip = self._queue.pop(0)
+                    self.pool.submit(path, process_image, f,
+                                     self.path_to_output, self.telescope, skip)
+                for path, status, value in self.pool.collect(block=False):
+                    self._finish(ImageResult.from_worker(path, status, value))
+                time.sleep(0.2)
+        finally:
+            self.pool.terminate()
+            self.manifest.flush()
+            self.rejections.flush()
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
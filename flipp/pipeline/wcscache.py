@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Astrometric solutions of earlier images, reused for repeat fields.
+
+KAIT and Nickel come back to the same fields every few nights at almost the
+same pointing.  Rather than solving each of those images blind, the WCS found
+for an earlier image of the field is handed to solve-field (``--verify``) to
+check and tweak against the new image's sources, under a short CPU limit;
+only if that fails is the image solved from scratch.
+
+Solutions are kept in the state database (:mod:`flipp.database.state`),
+keyed by telescope, OBJECT, image size and the pointing in the header.
+
+Example
+-------
+.. code-block::
+
+    cache = SolutionCache("/path/to/output")
+    guess = cache.lookup("kait", "SN2017abc", header)
+    ...
+    cache.store("kait", "SN2017abc", header, solution)
+"""
+
+from __future__ import unicode_literals, division
+
+import time
+
+import numpy as np
+
+from astropy.io import fits
+
+from flipp.libs.astrometry import pointing
+from flipp.database.state import CachedSolution, get_state_session
+from flipp.conf import settings
+
+WCS_CACHE_RADIUS = settings.WCS_CACHE_RADIUS
+
+
+def separation(a, b):
+    """Angle between the pointings ``a`` and ``b``, in degrees; fine for
+    the fraction of a degree that matters here.
+    """
+    dra = (a[0] - b[0] + 180.) % 360. - 180.
+    dra *= np.cos(np.radians((a[1] + b[1]) / 2.))
+    return float(np.hypot(dra, a[1] - b[1]))
+
+
+class SolutionCache(object):
+    """WCS solutions by field, in the state database of ``output_root``."""
+
+    def __init__(self, output_root, radius=WCS_CACHE_RADIUS):
+        self.output_root = output_root
+        self.radius = radius
+
+    def _nearest(self, session, telescope, obj, header):
+        where = pointing(header)
+        if where is None:
+            return None
+        rows = session.query(CachedSolution).filter_by(
+            telescope=telescope, object=obj, width=header.get("NAXIS1"),
+            height=header.get("NAXIS2"))
+        best, best_sep = None, self.radius
+        for row in rows:
+            sep = separation(where, (row.ra, row.dec))
+            if sep <= best_sep:
+                best, best_sep = row, sep
+        return best
+
+    def lookup(self, telescope, obj, header):
+        """Header of the solution of the nearest earlier pointing of
+        ``obj``, within ``radius`` degrees, or None.
+        """
+        session = get_state_session(self.output_root)
+        try:
+            row = self._nearest(session, telescope, obj, header)
+            return fits.Header.fromstring(row.header) if row else None
+        finally:
+            session.close()
+
+    def store(self, telescope, obj, header, solution, verified=False):
+        """Remember ``solution`` for the pointing in image ``header``,
+        replacing the nearest one within ``radius``; ``verified`` says it
+        was tweaked from that one rather than solved blind.
+        """
+        where = pointing(header)
+        if where is None:
+            return
+        session = get_state_session(self.output_root)
+        try:
+            row = self._nearest(session, telescope, obj, header)
+            if row is None:
+                row = CachedSolution(telescope=telescope, object=obj,
+                                     width=header.get("NAXIS1"),
+                                     height=header.get("NAXIS2"), hits=0)
+                session.add(row)
+            elif verified:
+                row.hits = (row.hits or 0) + 1
+            row.ra, row.dec = where
+            row.header = solution.tostring()
+            row.updated = time.time()
+            session.commit()
+        finally:
+            session.close()
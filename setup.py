@@ -58,6 +58,8 @@ setup(
     entry_points={
         'console_scripts': [
             'flipprun=flipp.pipeline:console_run',
+            'flipp=flipp.pipeline:console_flipp',
+            'flippbench=flipp.bench.run:console_bench',
         ],
     },
 )